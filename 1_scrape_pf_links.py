@@ -12,6 +12,23 @@ Description: Scrape Politifact raw data. This gets links and some basic fields a
 - 'raw_desc': the string description of the statement
 - 'truth_value': truth value of the statement
 - 'tags': tags of the statement. This is only returned if add argument --t
+
+Updated:
+- `--workers N` fetches listing pages N at a time over one pooled session, with at most one request started every
+  `--min_interval` seconds. Rows are still collected in page order and we stop at the first page that reaches
+  `earliest_date`. `--base_url` points the scraper at another host, e.g. a local server of saved listing pages.
+- Articles for `--t` are kept in an on-disk cache (`--cache_fn`, see `http_cache.py`), so a re-scrape only downloads
+  articles it has not seen. Tags are extracted in their own pool of `--tag_workers` threads while the listing crawl
+  continues, with or without `--workers`.
+- `--parser` picks how listing pages are parsed: BeautifulSoup with 'html.parser' (the original), 'lxml' or a
+  'strainer' that only builds the listicle items, or 'lxml-native' which skips BeautifulSoup. All four give the same
+  rows, see `bench_pf_parsing.py`.
+- `--update FN` adds what is new since an earlier scrape: the crawl stops at the first page with a URL already in FN
+  and only rows with new URLs are appended to FN.
+- A listing page that still fails after `--page_attempts` attempts ends the crawl there and the rows before it are
+  still written. An article that can't be fetched for `--t` gets no tags (None) instead of stopping the crawl.
+- 'is_twitter' comes from `pf_filters.is_twitter`. It used to be 1 for every row, because a bare `or "en x"` is always
+  true.
 """
 
 import argparse
@@ -19,110 +36,438 @@ import requests
 import time
 import pandas as pd
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import numpy as np
 import logging
 import os
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+
+from http_cache import HTTPCache
+from pf_filters import is_twitter
+
+PF_URL = "https://www.politifact.com"
+PARSERS = ['html.parser', 'lxml', 'strainer', 'lxml-native']
 
 
-def extract_tags_from_url(url):
-    time.sleep(random.random()*1.5)
-    response = requests.get(url)
-    soup = BeautifulSoup(response.content, 'html.parser')
+def parse_tags(html):
+    soup = BeautifulSoup(html, 'html.parser')
     tags = soup.find_all('a', class_='c-tag')
     extracted_tags = [tag.get_text().strip() for tag in tags]
     return extracted_tags
 
+
+def extract_tags_from_url(url, cache=None, session=None, limiter=None):
+    """
+    Tags of a fact-check article
+
+    Args:
+        url: Article url
+        cache: Optional HTTPCache. Cached articles are not requested again.
+        session: Optional requests Session for the request
+        limiter: Optional RateLimiter, used instead of the random sleep before a request. Cache hits skip both.
+    Returns:
+        List of tags, or None if the article could not be fetched (e.g. a 404)
+    """
+    pause = limiter if limiter else RandomPause(1.5)
+    try:
+        if cache is not None:
+            return parse_tags(cache.get(session if session else requests, url, limiter=pause))
+        pause.wait()
+        response = (session if session else requests).get(url, timeout=60)
+        response.raise_for_status()
+        return parse_tags(response.content)
+    except requests.RequestException as e:
+        logging.info(f"Failed to extract tags from {url}: {e}")
+        return None
+
 def convert_date(date_str):
     try:
         return datetime.strptime(date_str, '%Y-%m-%d')
     except ValueError:
         return None
 
-def categorize_where(desc):
-    try:
-        desc = desc.lower()
-        if "twitter" in desc or "tweet" in desc or "post on x" in desc or "x-post" in desc or "x post" in desc or "en x":
-            return 1
-        else:
-            return 0
-    except:
-        return np.NaN
-
-def scrape_politifact(earliest_date, extract_tags=False, pause=2):
+def _has_class(el, class_):
+    # Same rule as BeautifulSoup's class_: any one class, or the whole attribute
+    classes = el.get('class')
+    return classes is not None and (class_ in classes.split() or classes == class_)
+
+
+class LxmlNode:
+    """
+    Wraps an lxml element in the bits of the BeautifulSoup Tag API that `parse_listing_item` uses
+    """
+
+    def __init__(self, el):
+        self.el = el
+
+    def find(self, name, class_=None, href=None):
+        for el in self.el.iterdescendants(name):
+            if class_ is not None and not _has_class(el, class_):
+                continue
+            if href and el.get('href') is None:
+                continue
+            return LxmlNode(el)
+        return None
+
+    @property
+    def text(self):
+        return self.el.text_content()
+
+    def __getitem__(self, key):
+        return self.el.attrib[key]
+
+
+def listing_items(html, parser='html.parser'):
+    """
+    The `o-listicle__item` elements of a listing page, parsed with one of `PARSERS`
+    """
+    if parser == 'lxml-native':
+        import lxml.html
+        if not html.strip():
+            return []
+        return [LxmlNode(el) for el in lxml.html.fromstring(html).iter('li') if _has_class(el, "o-listicle__item")]
+    if parser == 'strainer':
+        # The strainer sees the raw class string, so match a token of it rather than the whole string
+        strainer = SoupStrainer("li", class_=lambda c: c is not None and "o-listicle__item" in c.split())
+        soup = BeautifulSoup(html, 'html.parser', parse_only=strainer)
+    elif parser in ('html.parser', 'lxml'):
+        soup = BeautifulSoup(html, parser)
+    else:
+        raise ValueError(f"Unknown parser {parser}, use one of {PARSERS}")
+    return soup.find_all("li", class_="o-listicle__item")
+
+
+def parse_listing_item(item, base_url=PF_URL):
+    """
+    Parses one `o-listicle__item` of a listing page (a BeautifulSoup Tag or LxmlNode) into a `scraped_info` dict,
+    without tags
+    """
+    meter_div = item.find("div", class_="m-statement__meter")
+    truth_value_img = meter_div.find("img") if meter_div else None
+    truth_value = truth_value_img['alt'] if truth_value_img else 'Truth value not found'
+    footer = item.find("footer", class_="m-statement__footer")
+    author, date_str = (footer.text.strip().split(" • ") if footer else ('Unknown', 'Unknown'))
+    date_object = datetime.strptime(date_str, '%B %d, %Y')
+    date = date_object.strftime('%Y-%m-%d')
+
+    quote_div = item.find("div", class_="m-statement__quote")
+    url_anchor = quote_div.find("a", href=True) if quote_div else None
+    url = url_anchor['href'] if url_anchor else 'URL not found'
+    if url and not url.startswith('http'):
+        url = f"{base_url}{url}"
+
+    type_anchor = item.find("a", class_="m-statement__name")
+    title = quote_div.text.strip() if quote_div else 'Unknown'
+
+    desc = item.find("div", class_="m-statement__desc").text.strip()
+
+    scraped_info = {
+        'type': type_anchor.text.strip() if type_anchor else 'Unknown',
+        'date': date,
+        'title': title,
+        'author': author.replace("By ", ""),
+        'url': url,
+        'is_twitter': is_twitter(desc),
+        'raw_desc': desc,
+        'truth_value': truth_value,
+        'tags': None
+    }
+    return scraped_info
+
+
+def parse_listing_page(html, earliest_date, base_url=PF_URL, known_urls=None, parser='html.parser'):
+    """
+    Parses a `factchecks/list/` page
+
+    Args:
+        html: Page html
+        earliest_date: datetime, items dated before it are not returned
+        base_url: Prefix for relative article urls
+        known_urls: Optional set of urls we already have. They are skipped, and finding one ends the crawl.
+        parser: One of `PARSERS`
+    Returns:
+        (rows, done) where rows are the `scraped_info` dicts up to the first item before `earliest_date`, and done is
+        True if the page had such an item, a known url or no items at all
+    """
+    containers = listing_items(html, parser)
+    if not containers:
+        logging.info("No more data to scrape.")
+        return [], True
+
+    rows = []
+    reached_known = False
+    for item in containers:
+        scraped_info = parse_listing_item(item, base_url)
+        if scraped_info['date'] and scraped_info['date'] < str(earliest_date):
+            logging.info(f"Reached the earliest date ({earliest_date}). Stopping scraping.")
+            return rows, True
+        # Keep going to the end of the page, since a new fact-check can be listed below a known one
+        if known_urls and scraped_info['url'] in known_urls:
+            reached_known = True
+            continue
+        rows.append(scraped_info)
+    if reached_known:
+        logging.info("Reached fact-checks we already have. Stopping scraping.")
+    return rows, reached_known
+
+
+def scrape_politifact(earliest_date, extract_tags=False, pause=2, base_url=PF_URL, cache=None, known_urls=None,
+                      parser='html.parser', page_attempts=5, tag_workers=4, tag_min_interval=0.5):
+    """
+    Scrapes listing pages one at a time, newest first, until `earliest_date`. A page that still fails after
+    `page_attempts` attempts ends the crawl, keeping the rows of the pages before it, and `df.attrs['failed_page']` is
+    its number. With `extract_tags`, articles go to a `TagStage` of `tag_workers` threads, so the crawl doesn't wait
+    on them.
+    """
     page_start = 1
+    attempt = 1
+    failed_page = None
     scraped_data = []
 
     earliest_date = convert_date(earliest_date)
     if not earliest_date:
         raise ValueError("Invalid earliest date format. Use 'YYYY-MM-DD' format.")
 
+    tag_stage = TagStage(tag_workers, tag_min_interval, cache) if extract_tags else None
+
     logging.info("Starting scraping process...")
-    while True:
-        try:
-            page_url = f'https://www.politifact.com/factchecks/list/?page={page_start}'
-            logging.info(f"Scraping page {page_start}...")
-            response = requests.get(page_url)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            containers = soup.find_all("li", class_="o-listicle__item")
-
-            if not containers:
-                logging.info("No more data to scrape.")
-                break
+    try:
+        while True:
+            try:
+                page_url = f'{base_url}/factchecks/list/?page={page_start}'
+                logging.info(f"Scraping page {page_start}...")
+                response = requests.get(page_url, timeout=60)
+                response.raise_for_status()
+                rows, done = parse_listing_page(response.text, earliest_date, base_url, known_urls, parser)
+            except Exception as e:
+                logging.info(f'Failed to scrape page {page_start} (attempt {attempt}): {e}')
+                if attempt == page_attempts:
+                    logging.error(f"Giving up on page {page_start}, keeping the rows before it")
+                    failed_page = page_start
+                    break
+                time.sleep(2 ** attempt)
+                attempt += 1
+                continue
 
-            for item in containers:
-                meter_div = item.find("div", class_="m-statement__meter")
-                truth_value_img = meter_div.find("img") if meter_div else None
-                truth_value = truth_value_img['alt'] if truth_value_img else 'Truth value not found'
-                footer = item.find("footer", class_="m-statement__footer")
-                author, date_str = (footer.text.strip().split(" • ") if footer else ('Unknown', 'Unknown'))
-                date_object = datetime.strptime(date_str, '%B %d, %Y')
-                date = date_object.strftime('%Y-%m-%d')
-                if date and date < str(earliest_date):
-                    logging.info(f"Reached the earliest date ({earliest_date}). Stopping scraping.")
-                    return pd.DataFrame(scraped_data)
-                else:
-                    pass
-
-                quote_div = item.find("div", class_="m-statement__quote")
-                url_anchor = quote_div.find("a", href=True) if quote_div else None
-                url = url_anchor['href'] if url_anchor else 'URL not found'
-                if url and not url.startswith('http'):
-                    url = f"https://www.politifact.com{url}"
-
-                if extract_tags:
-                    tags = extract_tags_from_url(url)
-                else:
-                    tags = None
-
-                type_anchor = item.find("a", class_="m-statement__name")
-                title = quote_div.text.strip() if quote_div else 'Unknown'
-
-                desc = item.find("div", class_="m-statement__desc").text.strip()
-
-                scraped_info = {
-                    'type': type_anchor.text.strip() if type_anchor else 'Unknown',
-                    'date': date,
-                    'title': title,
-                    'author': author.replace("By ", ""),
-                    'url': url,
-                    'is_twitter': categorize_where(desc),
-                    'raw_desc': desc,
-                    'truth_value': truth_value,
-                    'tags': tags
-                }
+            # Outside the try, so a failure here can't retry the page and add its rows twice
+            for scraped_info in rows:
+                if tag_stage:
+                    tag_stage.submit(scraped_info)
                 scraped_data.append(scraped_info)
+            if done:
+                break
             sleep_time = random.random()*pause
             time.sleep(sleep_time)
             page_start += 1
+            attempt = 1
+    except BaseException:
+        # Don't leave the tag stage downloading articles for a crawl that failed
+        if tag_stage:
+            tag_stage.cancel()
+        raise
+
+    if tag_stage:
+        tag_stage.collect()
+    df = pd.DataFrame(scraped_data)
+    df.attrs['failed_page'] = failed_page
+    return df
+
+
+class RateLimiter:
+    """
+    Spaces out request starts across threads by at least `min_interval` seconds
+    """
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.min_interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class RandomPause:
+    """
+    Sleeps a random 0 to `max_secs` seconds per `wait()`, the original politeness pause between article requests
+    """
+
+    def __init__(self, max_secs):
+        self.max_secs = max_secs
+
+    def wait(self):
+        time.sleep(random.random()*self.max_secs)
+
+
+def make_session(pool_size):
+    """
+    A requests Session whose connection pool fits `pool_size` concurrent requests
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class TagStage:
+    """
+    Extracts the tags of `scraped_info` rows in a pool of `workers` threads on their own pooled session, with at most
+    one article request started every `min_interval` seconds, so the listing crawl doesn't wait on articles. Cached
+    articles cost no request.
+    """
+
+    def __init__(self, workers=4, min_interval=0.5, cache=None):
+        self.cache = cache
+        self.session = make_session(workers)
+        self.limiter = RateLimiter(min_interval)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+
+    def submit(self, scraped_info):
+        future = self.executor.submit(extract_tags_from_url, scraped_info['url'], self.cache, self.session,
+                                      self.limiter)
+        self.futures.append((scraped_info, future))
+
+    def collect(self):
+        """
+        Waits for all submitted articles and sets the 'tags' of their rows
+        """
+        for scraped_info, future in self.futures:
+            try:
+                scraped_info['tags'] = future.result()
+            except Exception as e:
+                logging.info(f"Failed to extract tags from {scraped_info['url']}: {e}")
+        self.executor.shutdown()
+        if self.cache is not None:
+            logging.info(f"Articles: {self.cache.hits} from cache, {self.cache.revalidated} revalidated, "
+                         f"{self.cache.misses} downloaded")
+
+    def cancel(self):
+        self.executor.shutdown(cancel_futures=True)
 
-        except Exception as e:
-            logging.info(f'Failed to scrape page {page_start}: {e}')
 
+def fetch_listing_page(session, limiter, page, base_url=PF_URL, max_attempts=5):
+    """
+    Gets the html of listing page `page`, backing off between failed attempts
+    """
+    page_url = f'{base_url}/factchecks/list/?page={page}'
+    for attempt in range(1, max_attempts + 1):
+        limiter.wait()
+        try:
+            response = session.get(page_url, timeout=60)
+            response.raise_for_status()
+            logging.info(f"Fetched page {page}")
+            return response.text
+        except requests.RequestException as e:
+            logging.info(f'Failed to fetch page {page} (attempt {attempt}): {e}')
+            if attempt == max_attempts:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def scrape_politifact_concurrent(earliest_date, extract_tags=False, base_url=PF_URL, workers=4, min_interval=0.5,
+                                 session=None, cache=None, tag_workers=4, tag_min_interval=0.5, known_urls=None,
+                                 parser='html.parser', page_attempts=5):
+    """
+    Like `scrape_politifact` but with up to `workers` listing pages in flight on one pooled session.
+
+    Pages are requested in order and parsed in order as they complete, so rows come out exactly as the sequential
+    scrape would have them. Once a page has no items or reaches `earliest_date`, requests for later pages are
+    cancelled, and the few already in flight are discarded. A page that still fails after `page_attempts` attempts, or
+    that can't be parsed, ends the crawl the same way, keeping the rows of the pages before it.
+
+    Tags are a separate stage, as in `scrape_politifact`: each row's article is handed to a `TagStage` of `tag_workers`
+    threads as soon as its listing page is parsed, and the tags are collected once the crawl is done.
+
+    Args:
+        earliest_date: 'YYYY-MM-DD'
+        extract_tags: Whether to also visit each article for its tags
+        base_url: Site to scrape
+        workers: Max listing pages in flight
+        min_interval: Min seconds between the starts of any two requests
+        session: Optional requests Session, otherwise one is made with a pool of `workers` connections
+        cache: Optional HTTPCache for articles
+        tag_workers: Max articles in flight
+        tag_min_interval: Min seconds between the starts of any two article requests
+        known_urls: Optional set of urls we already have, see `parse_listing_page`
+        parser: One of `PARSERS`
+        page_attempts: Attempts per listing page
+    Returns:
+        Dataframe of `scraped_info` rows. If a page failed, `df.attrs['failed_page']` is its number.
+    """
+    earliest_date = convert_date(earliest_date)
+    if not earliest_date:
+        raise ValueError("Invalid earliest date format. Use 'YYYY-MM-DD' format.")
+    session = session if session else make_session(workers)
+    limiter = RateLimiter(min_interval)
+    scraped_data = []
+    tag_stage = TagStage(tag_workers, tag_min_interval, cache) if extract_tags else None
+    failed_page = None
+
+    logging.info(f"Starting scraping process with {workers} workers...")
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = {}
+            next_page, page = 1, 1
+            while True:
+                while len(in_flight) < workers:
+                    in_flight[next_page] = executor.submit(fetch_listing_page, session, limiter, next_page, base_url,
+                                                           page_attempts)
+                    next_page += 1
+                try:
+                    html = in_flight.pop(page).result()
+                    rows, done = parse_listing_page(html, earliest_date, base_url, known_urls, parser)
+                except Exception as e:
+                    logging.error(f"Giving up on page {page}, keeping the rows before it: {e}")
+                    failed_page = page
+                    for future in in_flight.values():
+                        future.cancel()
+                    break
+                for scraped_info in rows:
+                    if tag_stage:
+                        tag_stage.submit(scraped_info)
+                    scraped_data.append(scraped_info)
+                if done:
+                    for future in in_flight.values():
+                        future.cancel()
+                    break
+                page += 1
+    except BaseException:
+        # Don't leave the tag stage downloading articles for a crawl that failed
+        if tag_stage:
+            tag_stage.cancel()
+        raise
+    logging.info(f"Scraped {len(scraped_data)} rows from {page} pages")
+
+    if tag_stage:
+        tag_stage.collect()
     df = pd.DataFrame(scraped_data)
+    df.attrs['failed_page'] = failed_page
     return df
 
+def append_new_rows(fn, df):
+    """
+    Appends rows of `df` whose url is not in `fn` yet, in `fn`'s column order
+
+    Returns:
+        Number of rows appended
+    """
+    if df.empty:
+        return 0
+    existing = pd.read_csv(fn, usecols=['url'])
+    new = df.drop_duplicates(subset=['url'])
+    new = new[~new['url'].isin(set(existing['url']))]
+    new.reindex(columns=pd.read_csv(fn, nrows=0).columns).to_csv(fn, mode='a', header=False, index=False)
+    return len(new)
+
+
 def main():
     date_str = datetime.now().strftime("%Y-%m-%d__%H_%M_%S")
 
@@ -130,13 +475,31 @@ def main():
     logging.basicConfig(filename=f'{os.path.basename(__file__)}_{date_str}.log', level=logging.INFO, format=LOG_FORMAT,
                         datefmt='%Y-%m-%d %H:%M:%S', filemode='w')
     parser = argparse.ArgumentParser(description="Scrape Politifact data.")
-    parser.add_argument("--earliest_date", help="Earliest date for data in 'YYYY-MM-DD' format", nargs='?', default=(datetime.now() - timedelta(days=2)).strftime('%Y-%m-%d'))
-    parser.add_argument("--fn", help="Filename to save the scraped data", default=None)
+    parser.add_argument("--earliest_date", help="Earliest date for data in 'YYYY-MM-DD' format. Defaults to two days ago, or the earliest date in --update.", nargs='?', default=None)
+    parser.add_argument("--fn", help="Filename to save the scraped data. Not used with --update, which writes to its own file.", default=None)
+    parser.add_argument("--update", help="Existing csv of an earlier scrape. Crawls until known urls and appends only the new rows to it.", default=None)
     parser.add_argument("--t", help="Whether to also visit each page and extract tags", action="store_true")
     parser.add_argument("--d", "--debug", help="Debug mode: scrape only until day before yesterday", action="store_true")
+    parser.add_argument("--base_url", help="Site to scrape (defaults to https://www.politifact.com)", default=PF_URL)
+    parser.add_argument("--parser", help="How to parse listing pages (defaults to html.parser)", choices=PARSERS, default='html.parser')
+    parser.add_argument("--workers", help="Listing pages to fetch at once. 0 (the default) is the original one page at a time scrape", type=int, default=0)
+    parser.add_argument("--min_interval", help="With --workers, min seconds between request starts (defaults to 0.5)", type=float, default=0.5)
+    parser.add_argument("--page_attempts", help="Attempts per listing page before the crawl stops there (defaults to 5)", type=int, default=5)
+    parser.add_argument("--cache_fn", help="On-disk cache of articles for --t (defaults to pf_http_cache.sqlite). Pass an empty string to disable.", default="pf_http_cache.sqlite")
+    parser.add_argument("--cache_days", help="Revalidate cached articles older than this many days (defaults to 30)", type=float, default=30)
+    parser.add_argument("--tag_workers", help="With --t, articles to fetch at once (defaults to 4)", type=int, default=4)
+    parser.add_argument("--tag_min_interval", help="With --t, min seconds between article request starts (defaults to 0.5)", type=float, default=0.5)
     args = parser.parse_args()
+    if args.update and args.fn:
+        parser.error("--fn can't be used with --update, which appends to the --update file")
 
-    if args.d:
+    known_urls = None
+    if args.update:
+        existing = pd.read_csv(args.update, usecols=['url', 'date'])
+        known_urls = set(existing['url'])
+        if args.earliest_date is None:
+            args.earliest_date = existing['date'].min()
+    if args.d or args.earliest_date is None:
         args.earliest_date = (datetime.now() - timedelta(days=2)).strftime('%Y-%m-%d')
 
     try:
@@ -145,13 +508,37 @@ def main():
         logging.error("Invalid earliest date format. Use 'YYYY-MM-DD' format.")
         return
 
-    if not args.fn:
+    if args.update:
+        args.fn = args.update
+    elif not args.fn:
         args.fn = f'raw_pf_links_{date_str}.csv'
 
     logging.info("Starting scraping process with args: " + str(args))
-    df = scrape_politifact(args.earliest_date, extract_tags=args.t)
+    cache = HTTPCache(args.cache_fn, max_age_days=args.cache_days) if args.t and args.cache_fn else None
+    if args.workers:
+        df = scrape_politifact_concurrent(args.earliest_date, extract_tags=args.t, base_url=args.base_url,
+                                          workers=args.workers, min_interval=args.min_interval, cache=cache,
+                                          tag_workers=args.tag_workers, tag_min_interval=args.tag_min_interval,
+                                          known_urls=known_urls, parser=args.parser, page_attempts=args.page_attempts)
+    else:
+        df = scrape_politifact(args.earliest_date, extract_tags=args.t, base_url=args.base_url, cache=cache,
+                               known_urls=known_urls, parser=args.parser, page_attempts=args.page_attempts,
+                               tag_workers=args.tag_workers, tag_min_interval=args.tag_min_interval)
+    if cache is not None:
+        cache.close()
     logging.info("Scraping complete.")
-    df.to_csv(args.fn, index=False)
+    failed_page = df.attrs.get('failed_page')
+    if args.update and failed_page is not None:
+        # Appending would leave a gap from the failed page down to the known urls that the next update never fills
+        args.fn = f'raw_pf_links_{date_str}.csv'
+        logging.error(f"Page {failed_page} failed, so the update is incomplete. Wrote its rows to {args.fn} instead.")
+        df.to_csv(args.fn, index=False)
+    elif args.update:
+        logging.info(f"Appended {append_new_rows(args.fn, df)} new rows to {args.fn}")
+    else:
+        if failed_page is not None:
+            logging.error(f"Page {failed_page} failed, so {args.fn} only has the pages before it")
+        df.to_csv(args.fn, index=False)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -13,10 +13,16 @@ Date: 2024-04-02 13:32:47
 import pandas as pd
 import tweepy
 import json
+import math
 import random
 import numpy as np
 import logging
 import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from api_metrics import METRICS
+from profile_cache import ProfileCache
 
 logging.basicConfig(filename=f"{os.path.splitext(os.path.basename(__file__))[0]}.log",
                     level=logging.INFO,
@@ -44,18 +50,158 @@ def flatten_dict(d, parent_key='', sep='_'):
     return dict(items)
 
 
-def return_tweepy_client(TWITTER_API):
+def return_tweepy_client(TWITTER_API, account_name='personal_news'):
     """
-    Inits tweepy client
+    Inits tweepy client, with its calls recorded in `api_metrics.METRICS` under `account_name`
     """
     client = tweepy.Client(bearer_token=TWITTER_API['bearer_token'], wait_on_rate_limit=True)
+    METRICS.instrument(client.session, account_name)
     return client
 
 
-def hydrate_users(client, master_df, panel_n, panel_n_pad):
+USER_FIELDS = ['created_at', 'description',
+               'protected',
+               'username',
+               'public_metrics',
+               'location',
+               'verified',
+               'verified_type'
+               ]
+
+
+def get_users_cached(client, batch, cache=None):
+    """
+    Hydrates a batch of up to 100 ids with `client.get_users`, reading whatever it can from `cache` first.
+
+    Returns a list of flattened user dicts, in no particular order. Users the API did not return are left out.
+    """
+    cached = cache.get_many(batch) if cache else {}
+    to_fetch = [x for x in batch if str(x) not in cached]
+    flatten = [f for f in cached.values() if f is not None]
+    if to_fetch:
+        users = client.get_users(ids=to_fetch, user_fields=USER_FIELDS)
+        fetched = [flatten_dict(user.data) for user in (users.data or [])]
+        if cache:
+            # Cache misses as None so they are not looked up again
+            profiles = dict.fromkeys([str(x) for x in to_fetch])
+            profiles.update({str(f['id']): f for f in fetched})
+            cache.put_many(profiles)
+        flatten.extend(fetched)
+    return flatten
+
+
+def is_valid_user(f):
+    """
+    We only keep users if
+    - their tweets are not protected
+    - have non zero followers, friends, tweets
+    - NEW: Have more than 20 tweets
+    """
+    return f['protected'] is False and f['public_metrics_followers_count'] > 0 and f['public_metrics_following_count'] > 0 and f['public_metrics_tweet_count'] > 20
+
+
+def required_valid_users(n_success, downstream_rate, z):
+    """
+    Smallest number of valid users `k` so that, if each one has tweets downstream with prob `downstream_rate`,
+    we still expect `n_success` successes `z` standard deviations below the mean: k*q - z*sqrt(k*q*(1-q)) >= n_success
+
+    Raises:
+        ValueError: If `downstream_rate` is not in (0, 1], since then no `k` works
+    """
+    if not 0 < downstream_rate <= 1:
+        raise ValueError(f"downstream_rate must be in (0, 1], got {downstream_rate}")
+    q = downstream_rate
+    k = n_success
+    while k * q - z * math.sqrt(k * q * (1 - q)) < n_success:
+        k += 1
+    return k
+
+
+def hydrate_block_adaptive(client, spreader_username, condition, user_ids, n_valid, cache=None, z=2.33):
+    """
+    Hydrates one (spreader, condition) block until it has `n_valid` valid users or runs out of ids. `user_ids` should
+    not overlap with other blocks, see `hydrate_users_adaptive`.
+
+    We keep a running estimate of the block's validity rate and size each lookup so it should just finish the block,
+    using a lower confidence bound on the rate so we rarely need an extra call. Lookups still max out at 100 ids.
+
+    Returns a list of valid flattened users.
+    """
+    valid_users = []
+    n_seen = 0
+    index = 0
+    while len(valid_users) < n_valid and index < len(user_ids):
+        # Wilson lower bound on the validity rate so far, using a flat prior before the first batch
+        p_hat = (len(valid_users) + 1) / (n_seen + 2)
+        n_eff = n_seen + 2
+        center = (p_hat + z ** 2 / (2 * n_eff)) / (1 + z ** 2 / n_eff)
+        half = z * math.sqrt(p_hat * (1 - p_hat) / n_eff + z ** 2 / (4 * n_eff ** 2)) / (1 + z ** 2 / n_eff)
+        p_low = max(center - half, 0.01)
+        batch_n = min(100, math.ceil((n_valid - len(valid_users)) / p_low))
+
+        batch = user_ids[index:index + batch_n]
+        index += batch_n
+        try:
+            flatten = get_users_cached(client, batch, cache)
+        except Exception as e:
+            logging.error(f"Error while hydrating {spreader_username}, {condition}: {e}")
+            continue
+        n_seen += len(batch)
+        for f in flatten:
+            f['spreader_username'] = spreader_username
+            f['condition'] = condition
+            f['id'] = str(f['id'])
+            if is_valid_user(f) and len(valid_users) < n_valid:
+                valid_users.append(f)
+
+    logging.info(f"Hydrated {len(valid_users)} users for {spreader_username}, {condition} from {n_seen} ids, "
+                 f"validity rate {len(valid_users) / max(n_seen, 1):.2f}")
+    return valid_users
+
+
+def hydrate_users_adaptive(client, master_df, panel_n, downstream_rate=0.5, z=2.33, n_workers=4, cache=None):
+    """
+    Adaptive version of `hydrate_users`. Rather than a fixed pad, each block stops once it has enough valid users
+    that `panel_n` of them should still have tweets downstream (see `required_valid_users`), and blocks are
+    hydrated concurrently. `downstream_rate` is an assumption passed in, not a rate measured on this run.
+
+    A follower in several blocks only goes to the first of them in (spreader, condition) order, decided before any
+    block is hydrated, so the panel doesn't depend on which thread gets to a follower first.
+
+    Returns a DataFrame of hydrated users.
+    """
+    n_valid = required_valid_users(panel_n, downstream_rate, z)
+    logging.info(f"Adaptive mode: {n_valid} valid users per block for {panel_n} successes at rate {downstream_rate}")
+
+    # Shuffle and dedupe in the main thread so the blocks are the same regardless of threads
+    blocks = []
+    assigned_ids = set()
+    for (spreader_username, condition), group in master_df.groupby(['spreader_username', 'condition']):
+        user_ids = []
+        for user_id in group.sample(frac=1, replace=False)['follower_id']:
+            if str(user_id) not in assigned_ids:
+                assigned_ids.add(str(user_id))
+                user_ids.append(user_id)
+        blocks.append((spreader_username, condition, user_ids))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(hydrate_block_adaptive, client, spreader_username, condition, user_ids, n_valid,
+                                   cache, z)
+                   for spreader_username, condition, user_ids in blocks]
+        hydrated_users = [f for future in futures for f in future.result()]
+
+    logging.info("Hydration process completed.")
+    hydrated_df = pd.DataFrame(hydrated_users)
+    hydrated_df = hydrated_df.drop_duplicates(subset=['id'])
+    return hydrated_df
+
+
+def hydrate_users(client, master_df, panel_n, panel_n_pad, cache=None):
     """
     Hydrates users, returning `panel_n' hydrated users per each of the (spreader, condition) blocks.
 
+    If a ProfileCache is passed, ids it already has are not sent to the API.
+
     Returns a DataFrame of hydrated users.
 
 
@@ -78,27 +224,15 @@ def hydrate_users(client, master_df, panel_n, panel_n_pad):
         while hydrated_count < pull_n and index < len(user_ids):
             try:
                 batch = user_ids[index:index + 100]
-                users = client.get_users(ids=batch, user_fields=['created_at', 'description',
-                                                                 'protected',
-                                                                 'username',
-                                                                 'public_metrics',
-                                                                 'location',
-                                                                 'verified',
-                                                                 'verified_type'
-                                                                 ])
-                flatten = [flatten_dict(user.data) for user in users.data]
-
-                # Now we only add users if
-                # - their tweets are not protected
-                # - have non zero followers, friends, tweets
-                # - NEW: Have more than 20 tweets
-                # - were not added yet
+                flatten = get_users_cached(client, batch, cache)
+
+                # Now we only add users if they are valid and were not added yet
                 valid_users = []
                 for f in flatten:
                     f['spreader_username'] = spreader_username
                     f['condition'] = condition
                     f['id'] = str(f['id'])
-                    if f['id'] not in hydrated_ids and f['protected'] is False and f['public_metrics_followers_count'] > 0 and f['public_metrics_following_count'] > 0 and f['public_metrics_tweet_count'] > 20:
+                    if f['id'] not in hydrated_ids and is_valid_user(f):
                         valid_users.append(f)
                         hydrated_ids.add(f['id'])
                 hydrated_users.extend(valid_users)
@@ -115,7 +249,8 @@ def hydrate_users(client, master_df, panel_n, panel_n_pad):
     return pd.DataFrame(hydrated_df)
 
 
-def main():
+def main(adaptive=False, downstream_rate=0.5, z=2.33, n_workers=4, cache_fn="hydrated_profiles.sqlite",
+         cache_ttl_days=30):
     pad = 20
     logging.info("Starting up")
     logging.info("Pad {}".format(pad))
@@ -133,10 +268,23 @@ def main():
 
     master_df = pd.concat(dfs)
     client = return_tweepy_client(TWITTER_API)
+    metrics_fn = f"{os.path.splitext(os.path.basename(__file__))[0]}_api_metrics.json"
+    METRICS.start_snapshots(metrics_fn)
+
+    # Reruns with a new pad only look up ids this script has not hydrated yet. hydrate_uids.py can use the same
+    # file, but its v1 rows are kept apart from these v2 rows, so neither script reuses the other's profiles.
+    cache = ProfileCache(cache_fn, source='v2', ttl_days=cache_ttl_days) if cache_fn else None
 
     panel_n = 40
     panel_n_pad = int(panel_n*pad)
-    hydrated_panel = hydrate_users(client, master_df, panel_n, panel_n_pad)
+    if adaptive:
+        hydrated_panel = hydrate_users_adaptive(client, master_df, panel_n, downstream_rate, z, n_workers, cache)
+    else:
+        hydrated_panel = hydrate_users(client, master_df, panel_n, panel_n_pad, cache)
+    METRICS.write(metrics_fn)
+    if cache:
+        logging.info(f"Profile cache: {cache.hits} hits, {cache.misses} misses")
+        cache.close()
     hydrated_panel = hydrated_panel.drop_duplicates(subset=['id'])
     print(hydrated_panel.groupby(['spreader_username', 'condition']).size())
     print(hydrated_panel.head())
@@ -149,4 +297,20 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Select and hydrate the panel of followers")
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Stop each block at a target number of valid users instead of a fixed pad')
+    parser.add_argument('--downstream_rate', type=float, default=0.5,
+                        help='Adaptive mode: assumed share of valid users with tweets downstream (default: 0.5)')
+    parser.add_argument('--z', type=float, default=2.33,
+                        help='Adaptive mode: z score of the safety margin (default: 2.33)')
+    parser.add_argument('--n_workers', type=int, default=4,
+                        help='Adaptive mode: blocks to hydrate at once (default: 4)')
+    parser.add_argument('--cache_fn', default="hydrated_profiles.sqlite",
+                        help='Profile cache, empty string to disable (default: hydrated_profiles.sqlite)')
+    parser.add_argument('--cache_ttl_days', type=float, default=30,
+                        help='Re-hydrate cached profiles older than this many days (default: 30)')
+    args = parser.parse_args()
+    if not 0 < args.downstream_rate <= 1:
+        parser.error(f"--downstream_rate must be in (0, 1], got {args.downstream_rate}")
+    main(args.adaptive, args.downstream_rate, args.z, args.n_workers, args.cache_fn, args.cache_ttl_days)
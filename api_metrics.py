@@ -0,0 +1,263 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Per-account, per-endpoint metrics of every Twitter API call, written to a JSON snapshot.
+
+Clients built by `helpers.return_api_dict`, and the module-level clients of `get_tweet_data.py` and
+`7_select_panel_followers.py`, get a response hook that records into `METRICS`:
+- requests, and a latency histogram from `response.elapsed`
+- error codes, counted as the same `-{status}` strings that `helpers.exception2value` writes to our output files
+- the last `x-rate-limit-remaining`, `x-rate-limit-limit` and `x-rate-limit-reset` headers
+- seconds slept, by kind: 'rate_limit' when tweepy waits out a window, 'retry' when a tweepy API waits before
+  retrying an error, 'pool' when every key of a `helpers.TokenPool` is out of calls, and 'backoff' when a collector
+  waits before retrying
+
+tweepy's sleeps are the ones it actually takes: `instrument` gives tweepy's `api` and `client` modules a `time` whose
+`sleep` is recorded under the account and endpoint of the thread's last response, as 'rate_limit' if tweepy just logged
+a rate limit wait and 'retry' otherwise. So a `retry-after` header or a last attempt without a retry are counted as
+tweepy handles them. The async client sleeps in asyncio, so only its logged rate limit waits are counted.
+
+'pool' sleeps wait on all keys at once, so they are recorded under the pseudo-account 'pool' rather than any one
+credential.
+
+The hook is a few dict updates under a lock, microseconds next to a request. Collectors call `start_snapshots`,
+which rewrites the snapshot every `interval` seconds, and `write` once they are done.
+
+Usage:
+    python api_metrics.py FOLLOWERS_..._api_metrics.json
+"""
+
+import argparse
+import bisect
+import importlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is everything slower
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def endpoint_key(url):
+    """
+    Turns a request url into an endpoint key, e.g. `/1.1/followers/ids.json` or `/2/users/:id/tweets`
+    """
+    path = urlsplit(url).path
+    # Skip the first segment since that is the API version
+    return re.sub(r'(?<=.)/\d+(?=/|$)', '/:id', path)
+
+
+class _TweepySleepHandler(logging.Handler):
+    # tweepy logs "Rate limit exceeded. Sleeping for N seconds." (Client) or "Rate limit reached. Sleeping for: N"
+    # (API) right before it sleeps, in the thread whose last response hit the limit
+    pattern = re.compile(r"Sleeping for:? (\d+)")
+
+    def __init__(self, metrics):
+        super().__init__(level=logging.WARNING)
+        self.metrics = metrics
+
+    def emit(self, record):
+        match = self.pattern.search(record.getMessage())
+        if not match:
+            return
+        if record.name.startswith("tweepy.asynchronous"):
+            # asyncio.sleep is not hooked, so go by the log
+            last = getattr(self.metrics.local, 'last', None)
+            if last:
+                self.metrics.add_sleep(last[0], last[1], int(match.group(1)), 'rate_limit')
+        else:
+            # The next sleep of this thread, see `_TweepyTime`
+            self.metrics.local.sleep_kind = 'rate_limit'
+
+
+class _TweepyTime:
+    """
+    Stands in for the `time` module inside tweepy's `api` and `client` modules, recording each `sleep`
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        kind = getattr(self.metrics.local, 'sleep_kind', None) or 'retry'
+        self.metrics.local.sleep_kind = None
+        last = getattr(self.metrics.local, 'last', None)
+        if last and seconds > 0:
+            self.metrics.add_sleep(last[0], last[1], seconds, kind)
+        time.sleep(seconds)
+
+
+class APIMetrics:
+    """
+    Thread-safe counters of API calls keyed by (account, endpoint)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started_at = time.time()
+        self.calls = {}
+        self.sleeps = {}
+        self._snapshot_thread = None
+        logging.getLogger("tweepy").addHandler(_TweepySleepHandler(self))
+
+    def _calls(self, account, endpoint):
+        stats = self.calls.get((account, endpoint))
+        if stats is None:
+            stats = self.calls[(account, endpoint)] = {
+                'requests': 0, 'errors': {}, 'latency_sum': 0.0, 'latency_max': 0.0,
+                'histogram': [0] * (len(LATENCY_BUCKETS) + 1), 'remaining': None, 'limit': None, 'reset': None}
+        return stats
+
+    def record(self, account, endpoint, status, latency, headers=None):
+        """
+        Records one response
+
+        Args:
+            account: Account alias of the credential that made the call
+            endpoint: Endpoint key, see `endpoint_key`
+            status: HTTP status code
+            latency: Seconds from sending the request to its response
+            headers: Optional response headers, for the rate limit headers
+        """
+        self.local.last = (account, endpoint)
+        remaining = headers.get('x-rate-limit-remaining') if headers is not None else None
+        with self.lock:
+            stats = self._calls(account, endpoint)
+            stats['requests'] += 1
+            stats['latency_sum'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+            stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            if status >= 400:
+                code = str(-1 * status)
+                stats['errors'][code] = stats['errors'].get(code, 0) + 1
+            if remaining is not None:
+                stats['remaining'] = int(remaining)
+                stats['limit'] = int(headers.get('x-rate-limit-limit', 0)) or None
+                stats['reset'] = int(headers.get('x-rate-limit-reset', 0)) or None
+
+    def add_sleep(self, account, endpoint, seconds, kind):
+        """
+        Records `seconds` slept by `account` on `endpoint`, where kind is 'rate_limit', 'retry', 'pool' or 'backoff'.
+        'pool' sleeps are recorded under the account 'pool', since they wait on every key.
+        """
+        with self.lock:
+            stats = self.sleeps.setdefault((account, endpoint, kind), {'seconds': 0.0, 'count': 0})
+            stats['seconds'] += seconds
+            stats['count'] += 1
+
+    def instrument(self, session, account):
+        """
+        Adds a response hook to a requests Session (e.g. `client.session` of a tweepy Client or API), and records
+        tweepy's sleeps, see `_TweepyTime`
+
+        Args:
+            session: requests Session
+            account: Account alias to record calls under
+        """
+        # `tweepy.api` is also the name of an API instance in tweepy's __init__, so look the modules up by name
+        for module in (importlib.import_module("tweepy.api"), importlib.import_module("tweepy.client")):
+            if not isinstance(module.time, _TweepyTime):
+                module.time = _TweepyTime(self)
+
+        def hook(response, *args, **kwargs):
+            self.record(account, endpoint_key(response.url), response.status_code, response.elapsed.total_seconds(),
+                        response.headers)
+        session.hooks['response'].append(hook)
+        return session
+
+    def trace_config(self, account):
+        """
+        aiohttp TraceConfig that records into these metrics, for the session of a tweepy AsyncClient
+        """
+        import aiohttp
+
+        async def on_request_start(session, ctx, params):
+            ctx.start = time.perf_counter()
+
+        async def on_request_end(session, ctx, params):
+            self.record(account, endpoint_key(str(params.url)), params.response.status,
+                        time.perf_counter() - ctx.start, params.response.headers)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    def snapshot(self):
+        """
+        The metrics so far as a JSON-able dict
+        """
+        with self.lock:
+            calls = [{'account': account, 'endpoint': endpoint, 'requests': s['requests'],
+                      'errors': dict(s['errors']),
+                      'latency_mean': s['latency_sum'] / s['requests'] if s['requests'] else None,
+                      'latency_max': s['latency_max'], 'latency_histogram': list(s['histogram']),
+                      'remaining': s['remaining'], 'limit': s['limit'], 'reset': s['reset']}
+                     for (account, endpoint), s in self.calls.items()]
+            sleeps = [{'account': account, 'endpoint': endpoint, 'kind': kind, **s}
+                      for (account, endpoint, kind), s in self.sleeps.items()]
+        now = time.time()
+        return {'started_at': datetime.fromtimestamp(self.started_at).isoformat(),
+                'updated_at': datetime.fromtimestamp(now).isoformat(),
+                'elapsed_s': now - self.started_at,
+                'latency_buckets': LATENCY_BUCKETS + ['inf'],
+                'calls': calls,
+                'sleeps': sleeps}
+
+    def write(self, fn):
+        """
+        Writes a snapshot to `fn`, replacing it in one step so readers never see half a file
+        """
+        tmp_fn = f"""{fn}.tmp"""
+        with open(tmp_fn, "w") as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp_fn, fn)
+
+    def start_snapshots(self, fn, interval=60):
+        """
+        Rewrites the snapshot at `fn` every `interval` seconds from a daemon thread
+        """
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.write(fn)
+
+        if self._snapshot_thread is None:
+            self._snapshot_thread = threading.Thread(target=loop, daemon=True)
+            self._snapshot_thread.start()
+
+
+# Shared by every client in the process
+METRICS = APIMetrics()
+
+
+def summarize(snapshot):
+    """
+    Dataframe of requests, errors, latency and sleep per (account, endpoint) from a snapshot
+    """
+    import pandas as pd
+
+    calls = pd.DataFrame(snapshot['calls'], columns=['account', 'endpoint', 'requests', 'errors', 'latency_mean',
+                                                     'latency_max', 'remaining'])
+    calls['n_errors'] = calls['errors'].map(lambda x: sum(x.values()))
+    sleeps = pd.DataFrame(snapshot['sleeps'], columns=['account', 'endpoint', 'kind', 'seconds'])
+    sleeps = sleeps.pivot_table(index=['account', 'endpoint'], columns='kind', values='seconds', aggfunc='sum')
+    sleeps.columns = [f"""sleep_{x}_s""" for x in sleeps.columns]
+    return calls.drop(columns=['errors']).merge(sleeps.reset_index(), on=['account', 'endpoint'], how='outer')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("snapshot_fn", help="JSON snapshot written by a collector")
+    args = parser.parse_args()
+    with open(args.snapshot_fn) as f:
+        print(summarize(json.load(f)).to_string(index=False))
@@ -0,0 +1,197 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Block randomization of followers into treatment and control, with each spreader as a block.
+
+This does what `4_assign_treat_control.ipynb` and `6_downsized_assign_treat_control.ipynb` do in one vectorized
+pass. Every follower gets one uniform draw from a single seeded `np.random.default_rng`, and within each block the
+followers with the smallest draws fill the treatment quota, then the control quota. So each block gets exactly its
+quota (rather than a Bernoulli draw per follower like step 4), and the same seed gives the same assignment on any
+machine.
+
+The `final_{treat,ctrl}_twit_{spreader}.txt` files and the status csv are then written in one pass over the blocks.
+
+Usage:
+    # All followers, 80% treatment
+    python assignment.py -g follower_graph --prefix ""
+    # Downsized to the N from the power analysis, like step 6
+    python assignment.py -g follower_graph --total_n 367301
+"""
+
+import argparse
+import contextlib
+import logging
+import math
+import os
+from fractions import Fraction
+
+import numpy as np
+import pandas as pd
+
+from follower_graph import FollowerGraph
+
+ASSIGN_TREAT = 0.8
+
+
+def block_quotas(block_sizes, treat_ratio=ASSIGN_TREAT):
+    """
+    Exact quotas when every follower of a block is assigned
+
+    Args:
+        block_sizes: Array of followers per block
+        treat_ratio: Share of each block to treat, rounded half up
+    Returns:
+        (n_treat, n_ctrl) arrays aligned with `block_sizes`
+    """
+    block_sizes = np.asarray(block_sizes, dtype=np.int64)
+    n_treat = np.floor(block_sizes * treat_ratio + 0.5).astype(np.int64)
+    return n_treat, block_sizes - n_treat
+
+
+def downsized_quotas(total_n, n_blocks, treat_ratio=ASSIGN_TREAT):
+    """
+    Equal per-block quotas for a target N, like `assign_participants` in step 6.
+
+    N is rounded up so that it splits evenly over the blocks and then exactly by the treat ratio. For 5 blocks and 80%
+    treatment that is the next multiple of 25.
+
+    Args:
+        total_n: Target number of participants from the power analysis
+        n_blocks: Number of blocks (spreaders)
+        treat_ratio: Share of each block to treat
+    Returns:
+        Dict with `new_n` and the per-block `treat` and `ctrl` quotas
+    """
+    ratio = Fraction(treat_ratio).limit_denominator(1000)
+    unit = n_blocks * ratio.denominator
+    new_n = math.ceil(total_n / unit) * unit
+    per_block = new_n // n_blocks
+    treat = per_block * ratio.numerator // ratio.denominator
+    ctrl = per_block - treat
+
+    assert new_n == (treat + ctrl) * n_blocks, f"Failed test: Total N is {n_blocks} times treat and ctrl"
+    assert new_n >= total_n, "Failed test: New N >= original N"
+    assert Fraction(treat, treat + ctrl) == ratio, f"Failed test: treat not {treat_ratio}"
+    return {'new_n': new_n, 'treat': treat, 'ctrl': ctrl}
+
+
+def assign_blocks(blocks, n_blocks, n_treat, n_ctrl, seed=42):
+    """
+    Assigns every unit to treatment, control or neither in one pass.
+
+    Args:
+        blocks: int array of each unit's block, e.g. `FollowerGraph.edge_rows()`
+        n_blocks: Number of blocks
+        n_treat: Treatment quota per block (array or int)
+        n_ctrl: Control quota per block (array or int). Units past both quotas are dropped.
+        seed: Seed for `np.random.default_rng`
+    Returns:
+        int8 array aligned with `blocks`: 1 for treatment, 0 for control and -1 for dropped
+    """
+    blocks = np.asarray(blocks, dtype=np.int64)
+    sizes = np.bincount(blocks, minlength=n_blocks)
+    n_treat = np.broadcast_to(np.asarray(n_treat, dtype=np.int64), (n_blocks,))
+    n_ctrl = np.broadcast_to(np.asarray(n_ctrl, dtype=np.int64), (n_blocks,))
+    short = np.flatnonzero(sizes < n_treat + n_ctrl)
+    if len(short):
+        raise ValueError(f"""Blocks {short.tolist()} have {sizes[short].tolist()} units, fewer than their quotas""")
+
+    rng = np.random.default_rng(seed)
+    draws = rng.random(len(blocks))
+    order = np.argsort(blocks, kind='stable')
+    ends = np.cumsum(sizes)
+
+    group = np.full(len(blocks), -1, dtype=np.int8)
+    for b in range(n_blocks):
+        k_treat, k_all = n_treat[b], n_treat[b] + n_ctrl[b]
+        if k_all == 0:
+            continue
+        units = order[ends[b] - sizes[b]:ends[b]]
+        # A partial sort is enough to find the k_treat and then k_all smallest draws
+        kth = sorted({k - 1 for k in (k_treat, k_all) if k > 0})
+        ranked = units[np.argpartition(draws[units], kth)]
+        group[ranked[:k_treat]] = 1
+        group[ranked[k_treat:k_all]] = 0
+    return group
+
+
+def assign_graph(graph, treat_ratio=ASSIGN_TREAT, total_n=None, seed=42):
+    """
+    Assigns the followers of a deduped FollowerGraph, with spreaders as blocks
+
+    Args:
+        graph: FollowerGraph, each follower should be under one spreader (see `FollowerGraph.dedupe`)
+        treat_ratio: Share of each block to treat
+        total_n: If given, downsize to this N with equal quotas per spreader with followers, like step 6. Otherwise
+            every follower is assigned.
+        seed: Seed for `np.random.default_rng`
+    Returns:
+        int8 group array aligned with `graph.indices`, see `assign_blocks`
+    """
+    sizes = np.diff(graph.indptr)
+    if total_n is None:
+        n_treat, n_ctrl = block_quotas(sizes, treat_ratio)
+    else:
+        # Spreaders we got no followers for are not blocks
+        has_followers = sizes > 0
+        quotas = downsized_quotas(total_n, int(has_followers.sum()), treat_ratio)
+        logging.info(f"""Adjusted total participants to {quotas['new_n']}, {quotas['treat']} treat and """
+                     f"""{quotas['ctrl']} ctrl per spreader""")
+        n_treat = np.where(has_followers, quotas['treat'], 0)
+        n_ctrl = np.where(has_followers, quotas['ctrl'], 0)
+    return assign_blocks(graph.edge_rows(), len(graph), n_treat, n_ctrl, seed)
+
+
+def write_group_files(graph, group, out_dir=".", prefix="final_", status_fn=None):
+    """
+    Writes `{prefix}treat_twit_{spreader}.txt` and `{prefix}ctrl_twit_{spreader}.txt` for every spreader, plus an
+    optional status csv of (main, followers_id, group, treated), in one pass over the graph.
+
+    Args:
+        graph: FollowerGraph that `group` was assigned on
+        group: Array from `assign_graph`
+        out_dir: Directory for the files
+        prefix: Filename prefix, "final_" for step 6 and "" for step 4
+        status_fn: Optional path of the status csv
+    Returns:
+        Dataframe of treat and ctrl counts per spreader
+    """
+    counts = []
+    with open(status_fn, "w") if status_fn else contextlib.nullcontext() as status:
+        if status:
+            status.write("main,followers_id,group,treated\n")
+        for i, spreader in enumerate(graph.spreaders):
+            ids = np.asarray(graph.indices[graph.indptr[i]:graph.indptr[i + 1]])
+            g = group[graph.indptr[i]:graph.indptr[i + 1]]
+            row = {'main': spreader}
+            for arm, value, label in [('treat', 1, 'treatment'), ('ctrl', 0, 'control')]:
+                arm_ids = ids[g == value].astype(str)
+                with open(os.path.join(out_dir, f"""{prefix}{arm}_twit_{spreader.lower()}.txt"""), "w") as f:
+                    if len(arm_ids):
+                        f.write("\n".join(arm_ids) + "\n")
+                if status and len(arm_ids):
+                    status.write("".join(f"""{spreader},{x},{label},{value}\n""" for x in arm_ids))
+                row[arm] = len(arm_ids)
+            counts.append(row)
+    return pd.DataFrame(counts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-graph_dir", "-g", help="Graph directory from follower_graph.py")
+    parser.add_argument("-input_fn", "-i", help="Or a MINIMAL_FOLLOWERS csv to build the graph from")
+    parser.add_argument("--treat_ratio", type=float, default=ASSIGN_TREAT, help="Share to treat (defaults to 0.8)")
+    parser.add_argument("--total_n", type=int, default=None, help="Downsize to this N with equal quotas per spreader")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for both the dedupe and the assignment")
+    parser.add_argument("--prefix", default="final_", help="Prefix of the group files (defaults to final_)")
+    parser.add_argument("--status_fn", default=None, help="Optional status csv of every assigned follower")
+    parser.add_argument("--out_dir", default=".", help="Directory for the group files")
+    args = parser.parse_args()
+    if bool(args.graph_dir) == bool(args.input_fn):
+        parser.error("Pass exactly one of -graph_dir and -input_fn")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    graph = FollowerGraph.load(args.graph_dir) if args.graph_dir else FollowerGraph.from_csv(args.input_fn)
+    graph = graph.dedupe(seed=args.seed)
+    group = assign_graph(graph, args.treat_ratio, args.total_n, args.seed)
+    print(write_group_files(graph, group, args.out_dir, args.prefix, args.status_fn))
@@ -0,0 +1,176 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Checks the `--async_mode` of `get_tweet_data.py` against the serial `tweet_controller` with fake clients,
+and measures its wall-clock speedup.
+
+Both fake clients answer `get_users_tweets` after sleeping `--latency` seconds (`time.sleep` for the serial client,
+`asyncio.sleep` for the async one), with the same synthetic tweets per user. Some users have no tweets and some raise,
+so blocks need more requests than `--n_users_per_spreader`. The script checks that
+- the raw, processed and success files of both modes are identical, so results are committed in input order
+- every block stops at `--n_users_per_spreader` successes, launching at most `--max_in_flight - 1` requests more than
+  the serial mode needed
+- the speedup is close to the one expected from `--max_in_flight` requests in flight: a block that needs `S` requests
+  takes about `S` round trips serially and `ceil(S / max_in_flight)` round trips async
+
+It exits with status 1 if a check fails.
+
+Usage:
+    python bench_async_tweets.py
+    python bench_async_tweets.py --latency 0.1 --max_in_flight 4 --block_size 60
+"""
+
+import argparse
+import asyncio
+import filecmp
+import importlib
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter
+from types import SimpleNamespace
+
+import pandas as pd
+
+from bench_collectors import panel_frame, write_creds
+
+
+def fake_response(user_id, n):
+    """
+    Deterministic tweets for `user_id`: no tweets for about 1 in 5 users, an error for about 1 in 8
+    """
+    r = zlib.crc32(str(user_id).encode())
+    if r % 8 == 0:
+        raise RuntimeError(f"""Fake error for {user_id}""")
+    if r % 5 == 0:
+        return SimpleNamespace(data=None, includes={})
+    ref_id = f"""9{r % 50}"""
+    tweets = [SimpleNamespace(data={'id': f"""{user_id}{i}""", 'author_id': str(user_id), 'text': f"""tweet {i}""",
+                                    'entities': {'urls': [{'expanded_url': f"""https://example.com/{r % 97}/{i}"""}]},
+                                    'referenced_tweets': [{'type': 'retweeted', 'id': ref_id}] if i % 2 else []})
+              for i in range(n)]
+    includes = {'tweets': [SimpleNamespace(data={'id': ref_id, 'author_id': '7', 'text': 'viral'})],
+                'users': [SimpleNamespace(data={'id': '7', 'username': 'spreader'})]}
+    return SimpleNamespace(data=tweets, includes=includes)
+
+
+class FakeClient:
+    """
+    Stand-in for `tweepy.Client` that sleeps `latency` seconds per `get_users_tweets` call
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+
+    def get_users_tweets(self, id, max_results=10, **kwargs):
+        self.calls[id] += 1
+        time.sleep(self.latency)
+        return fake_response(id, max_results)
+
+
+class FakeAsyncClient:
+    """
+    Stand-in for `tweepy.asynchronous.AsyncClient`. It has a session already, so the controller does not make an
+    aiohttp one.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+        self.session = object()
+
+    async def get_users_tweets(self, id, max_results=10, **kwargs):
+        self.calls[id] += 1
+        await asyncio.sleep(self.latency)
+        return fake_response(id, max_results)
+
+
+def compare_modes(gtd, df, args):
+    """
+    Runs both modes on `df` and returns (failed checks, serial seconds, async seconds, expected speedup)
+    """
+    failures = []
+
+    gtd.client = FakeClient(args.latency)
+    start = time.perf_counter()
+    gtd.tweet_controller(df, args.n_per_user, args.n_users_per_spreader, "serial")
+    serial_s = time.perf_counter() - start
+
+    async_client = FakeAsyncClient(args.latency)
+    start = time.perf_counter()
+    asyncio.run(gtd.async_tweet_controller(async_client, df, args.n_per_user, args.n_users_per_spreader, "async",
+                                           args.max_in_flight))
+    async_s = time.perf_counter() - start
+
+    for suffix in ["raw.jsonl", "processed.jsonl", f"""{args.n_users_per_spreader}_success.csv"""]:
+        if not filecmp.cmp(f"""serial_{suffix}""", f"""async_{suffix}""", shallow=False):
+            failures.append(f"""serial_{suffix} and async_{suffix} differ""")
+
+    success = pd.read_csv(f"""async_{args.n_users_per_spreader}_success.csv""", dtype=str)
+    block_successes = success.groupby(['spreader_username', 'condition']).size()
+    serial_round_trips = 0
+    async_round_trips = 0
+    for (spreader_username, condition), group in df.groupby(['spreader_username', 'condition']):
+        user_ids = group['id'].tolist()
+        serial_calls = sum(gtd.client.calls[u] for u in user_ids)
+        async_calls = sum(async_client.calls[u] for u in user_ids)
+        available = sum(_has_tweets(u, args.n_per_user) for u in user_ids)
+        successes = block_successes.get((spreader_username, condition), 0)
+        if successes != min(args.n_users_per_spreader, available):
+            failures.append(f"""{spreader_username}/{condition}: {successes} successes of {available} users with """
+                            f"""tweets""")
+        if async_calls > serial_calls + args.max_in_flight - 1:
+            failures.append(f"""{spreader_username}/{condition}: async mode made {async_calls} requests, serial """
+                            f"""{serial_calls}, window {args.max_in_flight}""")
+        serial_round_trips += serial_calls
+        async_round_trips += math.ceil(serial_calls / args.max_in_flight)
+        logging.info(f"""{spreader_username}/{condition}: {serial_calls} serial requests, {async_calls} async""")
+
+    expected = serial_round_trips / async_round_trips
+    if serial_s / async_s < args.min_efficiency * expected:
+        failures.append(f"""Speedup {serial_s / async_s:.2f}x is below {args.min_efficiency:.0%} of the expected """
+                        f"""{expected:.2f}x""")
+    return failures, serial_s, async_s, expected
+
+
+def _has_tweets(user_id, n):
+    try:
+        return fake_response(user_id, n).data is not None
+    except RuntimeError:
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per fake request")
+    parser.add_argument("--block_size", type=int, default=30, help="Candidate users per (spreader, condition) block")
+    parser.add_argument("--n_users_per_spreader", type=int, default=10, help="Successes to stop a block at")
+    parser.add_argument("--n_per_user", type=int, default=5, help="Tweets per user")
+    parser.add_argument("--max_in_flight", type=int, default=8, help="Async requests in flight per block")
+    parser.add_argument("--min_efficiency", type=float, default=0.8,
+                        help="Fail if the speedup is below this share of the expected speedup")
+    parser.add_argument("--seed", type=int, default=416, help="Seed of the synthetic panel")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_async_tweets_")
+    os.chdir(work_dir)
+    # The fake errors are logged with tracebacks, so keep the log out of the terminal
+    logging.basicConfig(filename=os.path.join(work_dir, "bench.log"), level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    write_creds(work_dir, 1)
+    gtd = importlib.import_module("get_tweet_data")
+    df = panel_frame(args.block_size, args.seed).rename(columns={'follower_id': 'id'})
+
+    failures, serial_s, async_s, expected = compare_modes(gtd, df, args)
+    print(f"""serial {serial_s:.2f}s, async {async_s:.2f}s with {args.max_in_flight} in flight: """
+          f"""{serial_s / async_s:.2f}x speedup, {expected:.2f}x expected (outputs in {work_dir})""")
+    for failure in failures:
+        print(f"""FAILED: {failure}""")
+    if failures:
+        sys.exit(1)
+    print("Outputs, per-block early stopping and speedup match")
@@ -0,0 +1,312 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: End-to-end throughput benchmark of the collectors against `fake_twitter_api.py`, with no credentials.
+
+The fake API runs in its own process. Every requests Session created during the benchmark gets an adapter that sends
+`https://api.twitter.com` to it, so tweepy and the collectors run unchanged. Each collector runs in a temp directory
+that holds a fake `twitter_creds3.json` of `--n_accounts` accounts:
+- `relations`: `get_people_relation.main` pulls the followers of the five spreaders with `--minimal`
+- `hydrate`: `hydrate_uids.main` hydrates `--n_hydrate` ids through v1 `users/lookup`
+- `select_panel` and `select_panel_adaptive`: `hydrate_users` and `hydrate_users_adaptive` of
+  `7_select_panel_followers.py` on (spreader, condition) blocks of `--block_size` ids
+- `tweets`: `tweet_controller` of `get_tweet_data.py` until `--n_users_per_spreader` users per block have tweets.
+  The async mode uses aiohttp rather than requests, so it is not covered.
+
+For each collector we report requests and requests/sec, ids returned (follower ids, hydrated users or tweets) and
+ids/sec, as counted by the server, plus 429s, 5xxs and the seconds spent in `time.sleep`. Sleeps after a tweepy rate
+limit warning or in `helpers.TokenPool` count as rate limit sleeps, the rest (retry delays, backoff) as other sleeps.
+Sleeps are summed over threads, so they can add up to more than the wall time.
+
+Usage:
+    python bench_collectors.py
+    python bench_collectors.py --collectors relations hydrate --latency 0.1 --error_rate 0.01
+    # Tight limits to see rate limit sleeps
+    python bench_collectors.py --collectors relations --window 5 --limit /1.1/followers/ids.json=2
+"""
+
+import argparse
+import contextlib
+import importlib
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from fake_twitter_api import add_server_args
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TWITTER_URL = "https://api.twitter.com"
+SPREADERS = ['charliekirk11', 'gatewaypundit', 'jackposobiec', 'realcandaceo', 'stkirsch']
+CONDITIONS = ['treat', 'ctrl']
+
+
+class RedirectAdapter(HTTPAdapter):
+    """
+    Sends requests for `https://api.twitter.com` to `base_url` instead
+    """
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip("/")
+
+    def send(self, request, **kwargs):
+        request.url = self.base_url + request.url[len(TWITTER_URL):]
+        return super().send(request, **kwargs)
+
+
+@contextlib.contextmanager
+def redirect_twitter(base_url, pool_size=32):
+    """
+    Mounts a RedirectAdapter on every requests Session created inside the block, such as those of tweepy clients
+    """
+    init = requests.Session.__init__
+
+    def patched_init(session, *args, **kwargs):
+        init(session, *args, **kwargs)
+        session.mount(TWITTER_URL, RedirectAdapter(base_url, pool_maxsize=pool_size))
+
+    requests.Session.__init__ = patched_init
+    try:
+        yield
+    finally:
+        requests.Session.__init__ = init
+
+
+class _RateLimitLogHandler(logging.Handler):
+    # tweepy logs "... Sleeping for N" right before it sleeps on a rate limit
+    def __init__(self, meter):
+        super().__init__(level=logging.WARNING)
+        self.meter = meter
+
+    def emit(self, record):
+        if "Sleeping for" in record.getMessage():
+            self.meter.local.rate_limited = True
+
+
+class SleepMeter:
+    """
+    Patches `time.sleep` inside the block to add up time slept, split into rate limit and other sleeps
+    """
+
+    def __init__(self):
+        self.rate_limit = 0.0
+        self.other = 0.0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.handler = _RateLimitLogHandler(self)
+        self._sleep = time.sleep
+
+    def __enter__(self):
+        self._sleep = time.sleep
+        time.sleep = self.sleep
+        logging.getLogger("tweepy").addHandler(self.handler)
+        return self
+
+    def __exit__(self, *exc):
+        time.sleep = self._sleep
+        logging.getLogger("tweepy").removeHandler(self.handler)
+
+    def sleep(self, seconds):
+        rate_limited = getattr(self.local, 'rate_limited', False) or sys._getframe(1).f_globals.get('__name__') == 'helpers'
+        self.local.rate_limited = False
+        start = time.perf_counter()
+        self._sleep(seconds)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            if rate_limited:
+                self.rate_limit += elapsed
+            else:
+                self.other += elapsed
+
+    def snapshot(self):
+        with self.lock:
+            return self.rate_limit, self.other
+
+
+def write_creds(work_dir, n_accounts):
+    """
+    Writes a fake `twitter_creds3.json` with `personal_news` and `n_accounts - 1` more accounts
+    """
+    names = ['personal_news'] + [f"""bench_{i}""" for i in range(1, n_accounts)]
+    creds = {name: {'bearer_token': f"""bearer-{name}""", 'api_key': f"""key-{name}""",
+                    'api_key_secret': 'secret', 'access_token': f"""access-{name}""",
+                    'access_token_secret': 'secret'} for name in names}
+    fn = os.path.join(work_dir, "twitter_creds3.json")
+    with open(fn, "w") as f:
+        json.dump(creds, f)
+    return fn
+
+
+def synthetic_ids(n, seed):
+    rng = random.Random(seed)
+    return [str(x) for x in rng.sample(range(10 ** 9, 10 ** 12), n)]
+
+
+def panel_frame(block_size, seed):
+    """
+    (follower_id, condition, spreader_username) rows, `block_size` per block, like the `final_*_twit_*.txt` files
+    """
+    ids = synthetic_ids(block_size * len(SPREADERS) * len(CONDITIONS), seed)
+    rows = [(ids.pop(), condition, spreader) for spreader in SPREADERS for condition in CONDITIONS
+            for _ in range(block_size)]
+    return pd.DataFrame(rows, columns=['follower_id', 'condition', 'spreader_username'])
+
+
+def run_relations(args, work_dir, creds_fn):
+    get_people_relation = importlib.import_module("get_people_relation")
+    handles_fn = os.path.join(work_dir, "handles.txt")
+    with open(handles_fn, "w") as f:
+        f.write("\n".join(SPREADERS) + "\n")
+    get_people_relation.main(output_fn=os.path.join(work_dir, "FOLLOWERS__relations_bench"), input_fn=handles_fn,
+                             creds_fn=creds_fn, relation_type='followers', is_minimal=True, start_idx=0, end_idx=-1,
+                             max_pull=-1)
+
+
+def run_hydrate(args, work_dir, creds_fn):
+    hydrate_uids = importlib.import_module("hydrate_uids")
+    ids_fn = os.path.join(work_dir, "hydrate_ids.txt")
+    with open(ids_fn, "w") as f:
+        f.write("\n".join(synthetic_ids(args.n_hydrate, args.seed)) + "\n")
+    hydrate_uids.main(output_fn=os.path.join(work_dir, "Hydrated__hydrate_bench"), input_fn=ids_fn,
+                      creds_fn=creds_fn, start_idx=0, end_idx=-1, pandas_column="", cache_fn="")
+
+
+def run_select_panel(args, work_dir, creds_fn, adaptive=False):
+    select = importlib.import_module("7_select_panel_followers")
+    client = select.return_tweepy_client(select.TWITTER_API)
+    master_df = panel_frame(args.block_size, args.seed)
+    if adaptive:
+        select.hydrate_users_adaptive(client, master_df, panel_n=40, n_workers=4)
+    else:
+        select.hydrate_users(client, master_df, panel_n=40, panel_n_pad=40 * 20)
+
+
+def run_tweets(args, work_dir, creds_fn):
+    get_tweet_data = importlib.import_module("get_tweet_data")
+    df = panel_frame(args.block_size, args.seed).rename(columns={'follower_id': 'id'})
+    get_tweet_data.tweet_controller(df, n_per_user=10, n_users_per_spreader=args.n_users_per_spreader,
+                                    fn=os.path.join(work_dir, "tweets_bench"))
+
+
+COLLECTORS = {
+    'relations': run_relations,
+    'hydrate': run_hydrate,
+    'select_panel': run_select_panel,
+    'select_panel_adaptive': lambda args, work_dir, creds_fn: run_select_panel(args, work_dir, creds_fn, True),
+    'tweets': run_tweets,
+}
+
+
+def server_stats(base_url):
+    return requests.get(f"""{base_url}/stats""", timeout=10).json()
+
+
+def start_server(args):
+    """
+    Starts `fake_twitter_api.py` in its own process on a free port
+
+    Returns:
+        (process, base_url)
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    cmd = [sys.executable, os.path.join(REPO_DIR, "fake_twitter_api.py"), "--port", str(port),
+           "--latency", str(args.latency), "--jitter", str(args.jitter), "--window", str(args.window),
+           "--error_rate", str(args.error_rate), "--n_followers", str(args.n_followers),
+           "--missing_rate", str(args.missing_rate), "--no_tweets_rate", str(args.no_tweets_rate),
+           "--seed", str(args.seed)]
+    for limit in args.limit:
+        cmd += ["--limit", limit]
+    process = subprocess.Popen(cmd, cwd=REPO_DIR, stdout=subprocess.DEVNULL)
+    base_url = f"""http://127.0.0.1:{port}"""
+    for _ in range(100):
+        try:
+            server_stats(base_url)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"""Fake Twitter API did not start on {base_url}""")
+
+
+def run_collector(name, args, work_dir, creds_fn, base_url, meter):
+    """
+    Runs one collector and measures it
+
+    Returns:
+        Dict of the collector's throughput, errors and sleeps
+    """
+    before = server_stats(base_url)
+    slept_before = meter.snapshot()
+    start = time.perf_counter()
+    COLLECTORS[name](args, work_dir, creds_fn)
+    wall = time.perf_counter() - start
+    after = server_stats(base_url)
+    slept_after = meter.snapshot()
+
+    def total(key, stats):
+        return sum(s[key] for s in stats.values())
+
+    def n_status(prefix, stats):
+        return sum(n for s in stats.values() for code, n in s['status'].items() if code.startswith(prefix))
+
+    n_requests = total('requests', after) - total('requests', before)
+    n_ids = total('ids', after) - total('ids', before)
+    return {'collector': name, 'wall_s': wall, 'requests': n_requests, 'requests_per_s': n_requests / wall,
+            'ids': n_ids, 'ids_per_s': n_ids / wall,
+            'n_429': n_status('429', after) - n_status('429', before),
+            'n_5xx': n_status('5', after) - n_status('5', before),
+            'rate_limit_sleep_s': slept_after[0] - slept_before[0], 'other_sleep_s': slept_after[1] - slept_before[1]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--collectors", nargs="+", choices=list(COLLECTORS), default=list(COLLECTORS),
+                        help="Collectors to run (defaults to all)")
+    parser.add_argument("--n_accounts", type=int, default=3, help="Accounts in the fake creds file (defaults to 3)")
+    parser.add_argument("--n_hydrate", type=int, default=10000, help="Ids for hydrate (defaults to 10000)")
+    parser.add_argument("--block_size", type=int, default=1000, help="Ids per (spreader, condition) block")
+    parser.add_argument("--n_users_per_spreader", type=int, default=20, help="Users with tweets per block for tweets")
+    parser.add_argument("--base_url", default=None, help="Use a fake API that is already running instead")
+    parser.add_argument("--output_fn", default=None, help="Optional csv of the results")
+    add_server_args(parser)
+    parser.set_defaults(window=10)
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIR)
+    work_dir = tempfile.mkdtemp(prefix="bench_collectors_")
+    os.chdir(work_dir)
+    logging.basicConfig(filename=os.path.join(work_dir, "bench.log"), level=logging.INFO,
+                        format='%(asctime)s %(levelname)s (%(module)s): %(message)s')
+    creds_fn = write_creds(work_dir, args.n_accounts)
+
+    process, base_url = (None, args.base_url) if args.base_url else start_server(args)
+    results = []
+    try:
+        with redirect_twitter(base_url), SleepMeter() as meter:
+            for name in args.collectors:
+                print(f"""Running {name}""", flush=True)
+                results.append(run_collector(name, args, work_dir, creds_fn, base_url, meter))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    results = pd.DataFrame(results)
+    print(f"""Work dir: {work_dir}""")
+    print(results.round(2).to_string(index=False))
+    if args.output_fn:
+        results.to_csv(os.path.join(REPO_DIR, args.output_fn) if not os.path.isabs(args.output_fn) else args.output_fn,
+                       index=False)
@@ -0,0 +1,82 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Micro-benchmark of the listing page parsers in `1_scrape_pf_links.py`.
+
+Each parser in `PARSERS` parses every saved listing page, and we report pages per second. The rows each parser
+returns are checked against 'html.parser' (the original), so a parser that is fast but wrong fails loudly.
+
+Usage:
+    # Save the first 5 listing pages, then benchmark on them
+    python bench_pf_parsing.py --pages_dir pf_pages --fetch 5
+    # Benchmark on pages saved earlier
+    python bench_pf_parsing.py --pages_dir pf_pages --repeat 5
+"""
+
+import argparse
+import glob
+import importlib
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+import requests
+
+scraper = importlib.import_module("1_scrape_pf_links")
+
+
+def fetch_pages(pages_dir, n_pages, base_url=scraper.PF_URL):
+    """
+    Saves listing pages 1..n_pages to `{pages_dir}/page_{i}.html`
+    """
+    os.makedirs(pages_dir, exist_ok=True)
+    for page in range(1, n_pages + 1):
+        response = requests.get(f"""{base_url}/factchecks/list/?page={page}""", timeout=60)
+        response.raise_for_status()
+        with open(os.path.join(pages_dir, f"""page_{page}.html"""), "w", encoding="utf-8") as f:
+            f.write(response.text)
+
+
+def bench_parsers(pages, parsers=scraper.PARSERS, repeat=3):
+    """
+    Times each parser on the listing pages
+
+    Args:
+        pages: List of listing page html strings
+        parsers: Parsers to compare, the first is the reference for the rows
+        repeat: Passes over the pages per parser, the fastest pass is kept
+    Returns:
+        Dataframe of pages per second by parser
+    """
+    earliest_date = datetime(1900, 1, 1)
+    results, reference = [], None
+    for parser in parsers:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = [row for html in pages for row in scraper.parse_listing_page(html, earliest_date, parser=parser)[0]]
+            best = min(best, time.perf_counter() - start)
+        if reference is None:
+            reference = rows
+        assert rows == reference, f"Failed test: {parser} rows differ from {parsers[0]}"
+        results.append({'parser': parser, 'rows': len(rows), 'seconds': best, 'pages_per_s': len(pages) / best})
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages_dir", help="Directory of saved listing pages", required=True)
+    parser.add_argument("--fetch", type=int, default=0, help="Save this many listing pages first")
+    parser.add_argument("--base_url", default=scraper.PF_URL, help="Site to fetch pages from")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes per parser (defaults to 3)")
+    args = parser.parse_args()
+
+    if args.fetch:
+        fetch_pages(args.pages_dir, args.fetch, args.base_url)
+    pages = []
+    for fn in sorted(glob.glob(os.path.join(args.pages_dir, "*.html"))):
+        with open(fn, encoding="utf-8") as f:
+            pages.append(f.read())
+    print(f"""{len(pages)} pages from {args.pages_dir}""")
+    print(bench_parsers(pages, repeat=args.repeat).to_string(index=False))
@@ -0,0 +1,172 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Checks that `pf_filters.py` writes the same `raw_` and `to_annotate_` csv files as the code
+`2_filter_pf_links.ipynb` ran before it, on a synthetic scrape.
+
+`notebook_filter` is the notebook's old row-by-row code. For a scrape with and without missing descriptions, and for
+the csv and the parquet input of `pf_filters`, the script checks that
+- both files are byte for byte the notebook's
+- the tags of `to_annotate_` read back with `ast.literal_eval` (as done with `annotated_filtered_tweets.csv`) are the
+  scraped lists
+
+It exits with status 1 if a check fails.
+
+Usage:
+    python check_pf_filters.py
+    python check_pf_filters.py --n_links 20000
+"""
+
+import argparse
+import ast
+import contextlib
+import filecmp
+import io
+import os
+import random
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+import pf_filters
+
+TAGS = ['Coronavirus', 'Facebook Fact-checks', 'Public Health', 'Drugs', 'Abortion', 'Health Care', 'Elections',
+        'Science', "Women's Health", 'Immigration', 'Autism', 'Instagram posts']
+DESCS = ["stated on {d} in a post on X:", "stated on {d} in a tweet:", "stated on {d} in a blog post:",
+         "stated on {d} in a Facebook post:", "said on {d} in an interview:", "stated on {d} en X:"]
+TYPES = ['Viral image', 'Bloggers', 'Facebook posts', 'Steve Kirsch']
+TRUTH_VALUES = ['false', 'pants-fire', 'mostly-false', 'half-true', 'true']
+
+
+def synthetic_scrape(n, seed, missing_desc=False):
+    """
+    A scraper csv's rows, with tags as the scraper writes them (a list's repr), from 2020 to 2024
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        d = date(2020, 1, 1) + timedelta(days=rng.randrange(4 * 365))
+        desc = rng.choice(DESCS).format(d=f"""{d.strftime('%B')} {d.day}, {d.year}""")
+        rows.append({'type': rng.choice(TYPES), 'date': d.isoformat(), 'title': f"""Claim {i}""",
+                     'author': f"""Author {i % 7}""", 'url': f"""https://www.politifact.com/factchecks/{i}/""",
+                     'is_twitter': 1, 'raw_desc': None if missing_desc and i % 50 == 0 else desc,
+                     'truth_value': rng.choice(TRUTH_VALUES), 'tags': str(rng.sample(TAGS, rng.randint(1, 4)))})
+    return pd.DataFrame(rows)
+
+
+def notebook_filter(input_fn, output_fn):
+    """
+    The filter cell of `2_filter_pf_links.ipynb` before `pf_filters.py`
+    """
+    START_DATE = '2021-06-01'
+    END_DATE = '2023-12-21'
+
+    CATEGORIES = ['abortion', 'autism', 'coronavirus', 'drugs', 'disability', 'health-care', 'health-check',
+                  'public-health']
+    TRUTH_VALUES = ['pants-fire', 'false', 'mostly-false']
+
+    def is_twitter(desc):
+        try:
+            desc = desc.lower()
+            if "twitter" in desc or "tweet" in desc or "post on x" in desc or "x-post" in desc or "x post" in desc or "en x" in desc:
+                return 1
+            else:
+                return 0
+        except Exception as e:
+            print(e)
+            return np.nan
+
+    def is_blog(desc):
+        try:
+            desc = desc.lower()
+            if "in a blog" in desc or "bloggers" in desc:
+                return 1
+            else:
+                return 0
+        except Exception as e:
+            print(e)
+            return np.nan
+
+    def is_valid_category(x, categories):
+        x = [i.lower() for i in x]
+        if len(set(x).intersection(set(categories))) > 0:
+            return True
+        else:
+            return False
+
+    def safe_literal_eval(s):
+        try:
+            return ast.literal_eval(s)
+        except:
+            return s
+
+    df = pd.read_csv(input_fn)
+
+    df['tags'] = df['tags'].apply(lambda x: safe_literal_eval(x))
+    df['is_twitter'] = df['raw_desc'].apply(lambda x: is_twitter(x))
+    df['is_blog_desc'] = df['raw_desc'].apply(lambda x: is_blog(x))
+    df['is_blog_cat'] = df['type'].apply(lambda x: 1 if x == "Bloggers" else 0)
+    df['is_blog'] = np.maximum(df['is_blog_desc'], df['is_blog_cat'])
+    df['date'] = pd.to_datetime(df['date'], errors='coerce')
+    filtered_df = df[(df['date'] >= START_DATE) & (df['date'] <= END_DATE)]
+    filtered_df = filtered_df[filtered_df['tags'].apply(lambda x: is_valid_category(x, CATEGORIES))]
+    filtered_df = filtered_df.query("truth_value in @TRUTH_VALUES")
+    filtered_df = filtered_df.query("is_twitter==1|is_blog==1")
+    filtered_df.to_csv(f"raw_{output_fn}")
+
+    filtered_df['annotated_column'] = ''
+    filtered_df['raw_url'] = ''
+    filtered_df['twitter_handle'] = ''
+    filtered_df['n_followers'] = ''
+    filtered_df.to_csv(f"to_annotate_{output_fn}")
+
+
+def check_outputs(scrape, name):
+    """
+    Writes `scrape` as a csv and a parquet in the current directory, filters it with the notebook's code and with
+    `pf_filters`, and returns the failed checks
+    """
+    failures = []
+    scrape.to_csv(f"""{name}.csv""", index=False)
+    pf_filters.save_links(pf_filters.load_links(f"""{name}.csv"""), f"""{name}.parquet""")
+    # The notebook prints an error per missing description
+    with contextlib.redirect_stdout(io.StringIO()):
+        notebook_filter(f"""{name}.csv""", f"""{name}_notebook.csv""")
+    scraped_tags = dict(zip(scrape.index, scrape['tags'].map(ast.literal_eval)))
+
+    for input_fn in [f"""{name}.csv""", f"""{name}.parquet"""]:
+        output_fn = f"""{os.path.basename(input_fn).replace('.', '_')}_module.csv"""
+        pf_filters.write_filtered(pf_filters.filter_links(pf_filters.load_links(input_fn)), output_fn)
+        for prefix in ['raw_', 'to_annotate_']:
+            if not filecmp.cmp(f"""{prefix}{name}_notebook.csv""", f"""{prefix}{output_fn}""", shallow=False):
+                failures.append(f"""{prefix}{output_fn} differs from the notebook's {prefix}{name}_notebook.csv""")
+        written = pd.read_csv(f"""to_annotate_{output_fn}""", index_col=0)
+        if written.empty:
+            failures.append(f"""to_annotate_{output_fn} has no rows""")
+        for i, tags in written['tags'].items():
+            if ast.literal_eval(tags) != scraped_tags[i]:
+                failures.append(f"""to_annotate_{output_fn} row {i}: tags {tags} read back as """
+                                f"""{ast.literal_eval(tags)}, scraped {scraped_tags[i]}""")
+                break
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n_links", type=int, default=5000, help="Links in the synthetic scrape")
+    parser.add_argument("--seed", type=int, default=416, help="Seed of the synthetic scrape")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="check_pf_filters_")
+    os.chdir(work_dir)
+    failures = []
+    for name, missing_desc in [('scrape', False), ('scrape_missing_desc', True)]:
+        failures += check_outputs(synthetic_scrape(args.n_links, args.seed, missing_desc), name)
+    for failure in failures:
+        print(f"""FAILED: {failure}""")
+    if failures:
+        sys.exit(1)
+    print(f"""pf_filters writes the notebook's files, with and without missing descriptions (outputs in {work_dir})""")
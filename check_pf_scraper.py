@@ -0,0 +1,183 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Checks `1_scrape_pf_links.py` against `pf_test_server.py`, offline.
+
+Checks:
+- `concurrent`: the concurrent crawl returns exactly the rows of the sequential one and stops within `--workers`
+  pages of the last page it needs
+- `failed_page`: a listing page that keeps failing or can't be parsed ends the crawl at that page, with and without
+  `--workers`, and the CSV is still written with the rows of the pages before it
+- `tags`: a sequential `--t` crawl with the article cache finishes when some articles 404, with no tags for those,
+  and a `--workers` crawl after it gets the same tags without downloading any article again
+- `update`: `--update` on a scrape missing its newest rows appends exactly those rows, stopping at the page of the
+  first known url, and `--fn` is rejected with `--update`
+
+Each check runs in its own temp directory against its own server. The script exits with status 1 if a check fails.
+
+Usage:
+    python check_pf_scraper.py
+    python check_pf_scraper.py --checks failed_page
+"""
+
+import argparse
+import importlib
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+import requests
+
+from pf_test_server import PFTestServer
+
+scraper = importlib.import_module("1_scrape_pf_links")
+SCRAPER_FN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "1_scrape_pf_links.py")
+
+# 20 synthetic pages of 30 items, 7 items a day from 2024-04-01, so the crawl stops at this date on page 12
+EARLIEST_DATE = '2024-02-11'
+N_PAGES = 20
+PER_PAGE = 30
+
+
+def server_stats(base_url):
+    return requests.get(f"""{base_url}/stats""", timeout=10).json()
+
+
+def run_scraper(base_url, work_dir, *args):
+    """
+    Runs the scraper's CLI in `work_dir` against `base_url`
+
+    Returns:
+        Seconds it took
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, SCRAPER_FN, "--base_url", base_url, *args], cwd=work_dir, check=True,
+                   timeout=600)
+    return time.perf_counter() - start
+
+
+def check_concurrent(work_dir):
+    site = PFTestServer(n_pages=N_PAGES, per_page=PER_PAGE, latency=0.02)
+    base_url = site.start()
+    try:
+        sequential = scraper.scrape_politifact(EARLIEST_DATE, pause=0, base_url=base_url)
+        n_sequential = server_stats(base_url)['list']
+        workers = 4
+        concurrent = scraper.scrape_politifact_concurrent(EARLIEST_DATE, base_url=base_url, workers=workers,
+                                                          min_interval=0)
+        n_concurrent = server_stats(base_url)['list'] - n_sequential
+    finally:
+        site.stop()
+    failures = []
+    if sequential.empty or not sequential.equals(concurrent):
+        failures.append(f"""Concurrent rows ({len(concurrent)}) differ from sequential rows ({len(sequential)})""")
+    if n_concurrent > n_sequential + workers:
+        failures.append(f"""Concurrent crawl fetched {n_concurrent} pages, sequential {n_sequential}""")
+    return failures
+
+
+def check_failed_page(work_dir):
+    failures = []
+    for failure, server_args in [('fetch', {'fail_pages': [3]}), ('parse', {'bad_pages': [3]})]:
+        site = PFTestServer(n_pages=N_PAGES, per_page=PER_PAGE, **server_args)
+        base_url = site.start()
+        try:
+            for mode, mode_args in [('sequential', []), ('concurrent', ["--workers", "4", "--min_interval", "0"])]:
+                fn = f"""{failure}_{mode}.csv"""
+                try:
+                    seconds = run_scraper(base_url, work_dir, "--earliest_date", EARLIEST_DATE, "--page_attempts",
+                                          "2", "--fn", fn, *mode_args)
+                except subprocess.CalledProcessError:
+                    failures.append(f"""{fn}: the scraper exited with an error after page 3 failed""")
+                    continue
+                if not os.path.exists(os.path.join(work_dir, fn)):
+                    failures.append(f"""{fn}: no CSV written after page 3 failed""")
+                    continue
+                n_rows = len(pd.read_csv(os.path.join(work_dir, fn)))
+                logging.info(f"""failed_page ({failure}, {mode}): {n_rows} rows in {seconds:.1f}s""")
+                if n_rows != 2 * PER_PAGE:
+                    failures.append(f"""{fn}: expected the {2 * PER_PAGE} rows of pages 1-2 after page 3 failed, """
+                                    f"""got {n_rows}""")
+        finally:
+            site.stop()
+    return failures
+
+
+def check_tags(work_dir):
+    site = PFTestServer(n_pages=N_PAGES, per_page=PER_PAGE, missing_rate=0.2)
+    base_url = site.start()
+    failures = []
+    try:
+        scrape_args = ["--earliest_date", EARLIEST_DATE, "--t", "--cache_fn", "cache.sqlite", "--tag_min_interval", "0"]
+        run_scraper(base_url, work_dir, *scrape_args, "--fn", "first.csv")
+        n_downloaded = server_stats(base_url)['article']
+        run_scraper(base_url, work_dir, *scrape_args, "--workers", "4", "--min_interval", "0", "--fn", "second.csv")
+        n_downloaded_again = server_stats(base_url)['article'] - n_downloaded
+    finally:
+        site.stop()
+    first = pd.read_csv(os.path.join(work_dir, "first.csv"))
+    if not first.equals(pd.read_csv(os.path.join(work_dir, "second.csv"))):
+        failures.append("The sequential and --workers crawls wrote different rows or tags")
+    for fn in ["first.csv", "second.csv"]:
+        df = pd.read_csv(os.path.join(work_dir, fn))
+        missing = df['url'].map(lambda url: site.is_missing(url[len(base_url):]))
+        if not missing.any() or missing.all():
+            failures.append(f"""{fn}: expected some but not all of the {len(df)} articles to 404""")
+        if df.loc[missing, 'tags'].notna().any() or df.loc[~missing, 'tags'].isna().any():
+            failures.append(f"""{fn}: tags should be empty exactly for the articles that 404""")
+    if n_downloaded_again:
+        failures.append(f"""The second crawl downloaded {n_downloaded_again} cached articles again""")
+    return failures
+
+
+def check_update(work_dir):
+    n_new = 40
+    site = PFTestServer(n_pages=N_PAGES, per_page=PER_PAGE)
+    base_url = site.start()
+    failures = []
+    try:
+        run_scraper(base_url, work_dir, "--earliest_date", EARLIEST_DATE, "--fn", "full.csv")
+        full = pd.read_csv(os.path.join(work_dir, "full.csv"))
+        full.iloc[n_new:].to_csv(os.path.join(work_dir, "old.csv"), index=False)
+        n_listed = server_stats(base_url)['list']
+        run_scraper(base_url, work_dir, "--update", "old.csv")
+        n_listed_update = server_stats(base_url)['list'] - n_listed
+        rejected = subprocess.run([sys.executable, SCRAPER_FN, "--update", "old.csv", "--fn", "other.csv"],
+                                  cwd=work_dir, capture_output=True).returncode != 0
+    finally:
+        site.stop()
+    updated = pd.read_csv(os.path.join(work_dir, "old.csv"))
+    expected = pd.concat([full.iloc[n_new:], full.iloc[:n_new]], ignore_index=True)
+    if not updated.equals(expected):
+        failures.append(f"""Updated file has {len(updated)} rows, expected the {len(full) - n_new} old rows and the """
+                        f"""{n_new} new ones""")
+    if n_listed_update != n_new // PER_PAGE + 1:
+        failures.append(f"""The update fetched {n_listed_update} listing pages, expected {n_new // PER_PAGE + 1}""")
+    if not rejected:
+        failures.append("--fn was accepted with --update")
+    return failures
+
+
+CHECKS = {'concurrent': check_concurrent, 'failed_page': check_failed_page, 'tags': check_tags,
+          'update': check_update}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checks", nargs="+", choices=list(CHECKS), default=list(CHECKS), help="Checks to run")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    results = {}
+    for name in args.checks:
+        work_dir = tempfile.mkdtemp(prefix=f"""check_pf_{name}_""")
+        results[name] = CHECKS[name](work_dir)
+        print(f"""{name}: {"ok" if not results[name] else "FAILED"} ({work_dir})""")
+        for failure in results[name]:
+            print(f"""  {failure}""")
+    if any(results.values()):
+        sys.exit(1)
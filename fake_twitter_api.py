@@ -0,0 +1,411 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Local stand-in for the Twitter API endpoints our collectors use, so they can be run and timed without
+credentials. `bench_collectors.py` points tweepy at it.
+
+Endpoints:
+- v1.1 `followers/ids` and `friends/ids` (cursor pages of up to 5000 ids), used by `get_people_relation.py`
+- v1.1 `users/lookup` (up to 100 ids), used by `hydrate_uids.py`
+- v2 `users` (up to 100 ids), used by `7_select_panel_followers.py`
+- v2 `users/:id/tweets` with `includes` for referenced tweets and their authors, used by `get_tweet_data.py`
+- `/stats`: requests, status codes and ids returned per endpoint, as JSON
+
+All data is synthetic and a function of the seed and the id, so two runs see the same followers, profiles and tweets.
+Each request waits `latency` (plus up to `jitter`) seconds. Every (account, endpoint) gets its own rate limit window
+of `window` seconds, with the real `x-rate-limit-limit`, `x-rate-limit-remaining` and `x-rate-limit-reset` headers
+and a 429 once it runs out. The account is the bearer token, or the access token of OAuth 1 requests. A share
+`error_rate` of requests that are within their limit get a 503 instead.
+
+Usage:
+    python fake_twitter_api.py --port 8766 --latency 0.05 --window 15 --error_rate 0.01
+    python fake_twitter_api.py --limit /1.1/followers/ids.json=5 --n_followers 20000
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from helpers import endpoint_key
+
+# Calls per window by endpoint, the real limits per 15 minutes
+RATE_LIMITS = {
+    '/1.1/followers/ids.json': 15,
+    '/1.1/friends/ids.json': 15,
+    '/1.1/users/lookup.json': 900,
+    '/2/users': 300,
+    '/2/users/:id/tweets': 1500,
+}
+
+DOMAINS = ['nytimes.com', 'foxnews.com', 'thegatewaypundit.com', 'youtube.com', 'rumble.com', 'cdc.gov',
+           'substack.com', 'breitbart.com', 'cnn.com', 'childrenshealthdefense.org']
+
+
+class FakeTwitterData:
+    """
+    Synthetic followers, profiles and tweets, each drawn from a generator seeded by the id they belong to.
+
+    Args:
+        seed: Seed for all of the data
+        n_followers: Followers (and friends) of every account
+        missing_rate: Share of user ids that lookups do not return, like suspended or deleted accounts
+        protected_rate: Share of users that are protected
+        no_tweets_rate: Share of users with no tweets
+        n_viral: Size of the pool of viral tweets that timelines reference, so expansions repeat across users
+    """
+
+    def __init__(self, seed=42, n_followers=20000, missing_rate=0.02, protected_rate=0.1, no_tweets_rate=0.3,
+                 n_viral=200):
+        self.seed = seed
+        self.n_followers = n_followers
+        self.missing_rate = missing_rate
+        self.protected_rate = protected_rate
+        self.no_tweets_rate = no_tweets_rate
+        self.n_viral = n_viral
+
+    def _rng(self, kind, key):
+        return random.Random(f"""{self.seed}:{kind}:{key}""")
+
+    def follower_ids(self, screen_name, start, count):
+        """
+        Ids `start` to `start + count` of an account's followers, unique and stable for a screen name
+        """
+        base = 10 ** 12 + zlib.crc32(f"""{self.seed}:{screen_name.lower()}""".encode()) * 10 ** 3
+        return [base + i * 7919 for i in range(start, min(start + count, self.n_followers))]
+
+    def exists(self, user_id):
+        return self._rng('exists', user_id).random() >= self.missing_rate
+
+    def _profile(self, user_id):
+        rng = self._rng('user', user_id)
+        created = datetime(2008, 1, 1, tzinfo=timezone.utc) + timedelta(days=rng.randrange(5500))
+        return {'id': int(user_id),
+                'username': f"""user{user_id}""",
+                'name': f"""User {user_id}""",
+                'created_at': created,
+                'protected': rng.random() < self.protected_rate,
+                'followers_count': int(rng.lognormvariate(4, 2)),
+                'following_count': int(rng.lognormvariate(5, 1.5)),
+                'tweet_count': int(rng.lognormvariate(6, 2)),
+                'listed_count': rng.randrange(10),
+                'location': rng.choice(['', 'USA', 'Texas', 'London']),
+                'description': f"""Bio of user {user_id}"""}
+
+    def user_v1(self, user_id):
+        p = self._profile(user_id)
+        return {'id': p['id'], 'id_str': str(p['id']), 'name': p['name'], 'screen_name': p['username'],
+                'created_at': p['created_at'].strftime('%a %b %d %H:%M:%S +0000 %Y'),
+                'followers_count': p['followers_count'], 'friends_count': p['following_count'],
+                'statuses_count': p['tweet_count'], 'listed_count': p['listed_count'], 'lang': None,
+                'protected': p['protected'], 'location': p['location'], 'description': p['description'],
+                'status': {'id': p['id'] * 10, 'id_str': str(p['id'] * 10), 'text': 'Last tweet',
+                           'created_at': 'Mon Apr 01 12:00:00 +0000 2024'}}
+
+    def user_v2(self, user_id):
+        p = self._profile(user_id)
+        return {'id': str(p['id']), 'name': p['name'], 'username': p['username'],
+                'created_at': p['created_at'].strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'description': p['description'], 'protected': p['protected'], 'location': p['location'],
+                'verified': False, 'verified_type': 'none',
+                'public_metrics': {'followers_count': p['followers_count'],
+                                   'following_count': p['following_count'],
+                                   'tweet_count': p['tweet_count'], 'listed_count': p['listed_count']}}
+
+    def _tweet(self, tweet_id, author_id, rng, n_urls):
+        return {'id': str(tweet_id), 'text': f"""Tweet {tweet_id}""", 'author_id': str(author_id),
+                'conversation_id': str(tweet_id), 'lang': 'en', 'reply_settings': 'everyone', 'source': '',
+                'edit_history_tweet_ids': [str(tweet_id)],
+                'created_at': (datetime(2024, 4, 1, tzinfo=timezone.utc) - timedelta(minutes=rng.randrange(10 ** 5))
+                               ).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'public_metrics': {'retweet_count': rng.randrange(100), 'reply_count': rng.randrange(20),
+                                   'like_count': rng.randrange(500), 'quote_count': rng.randrange(10),
+                                   'bookmark_count': 0, 'impression_count': rng.randrange(10 ** 4)},
+                'entities': {'urls': [{'start': 0, 'end': 23, 'url': f"""https://t.co/{tweet_id}{i}""",
+                                       'expanded_url': f"""https://{rng.choice(DOMAINS)}/story/{rng.randrange(10 ** 4)}""",
+                                       'display_url': 'story'} for i in range(n_urls)]}}
+
+    def viral_tweet(self, k):
+        rng = self._rng('viral', k)
+        return self._tweet(9 * 10 ** 17 + k, 10 ** 9 + k % 50, rng, n_urls=1)
+
+    def timeline(self, user_id, max_results):
+        """
+        The v2 `users/:id/tweets` response of a user, with `includes` for referenced tweets and their authors
+        """
+        rng = self._rng('timeline', user_id)
+        if rng.random() < self.no_tweets_rate:
+            return {'meta': {'result_count': 0}}
+        data, refs = [], {}
+        for i in range(max_results):
+            tweet = self._tweet(int(user_id) * 1000 + i, user_id, rng, n_urls=rng.randrange(3))
+            if rng.random() < 0.5:
+                k = rng.randrange(self.n_viral)
+                tweet['referenced_tweets'] = [{'type': rng.choice(['retweeted', 'quoted', 'replied_to']),
+                                               'id': str(9 * 10 ** 17 + k)}]
+                refs[k] = self.viral_tweet(k)
+            data.append(tweet)
+        authors = [user_id] + sorted({int(t['author_id']) for t in refs.values()})
+        return {'data': data,
+                'includes': {'users': [self.user_v2(x) for x in authors], 'tweets': list(refs.values())},
+                'meta': {'result_count': len(data), 'newest_id': data[0]['id'], 'oldest_id': data[-1]['id']}}
+
+
+class RateWindows:
+    """
+    Fixed rate limit windows per (account, endpoint), starting at the first request of each window
+    """
+
+    def __init__(self, limits, window):
+        self.limits = limits
+        self.window = window
+        self.state = {}
+        self.lock = threading.Lock()
+
+    def take(self, account, endpoint):
+        """
+        Spends one call
+
+        Returns:
+            (allowed, headers) where headers are the `x-rate-limit-*` headers of the response
+        """
+        limit = self.limits[endpoint]
+        now = time.time()
+        with self.lock:
+            reset, used = self.state.get((account, endpoint), (0, 0))
+            if now >= reset:
+                reset, used = int(now + self.window) + 1, 0
+            allowed = used < limit
+            used += allowed
+            self.state[(account, endpoint)] = (reset, used)
+        return allowed, {'x-rate-limit-limit': str(limit), 'x-rate-limit-remaining': str(limit - used),
+                         'x-rate-limit-reset': str(reset)}
+
+
+class FakeTwitterAPI:
+    """
+    The fake API behind a ThreadingHTTPServer
+
+    Args:
+        data: FakeTwitterData
+        latency: Seconds every request waits before it is answered
+        jitter: Up to this many extra seconds, uniformly
+        window: Seconds per rate limit window
+        limits: Calls per window by endpoint, defaults to `RATE_LIMITS`
+        error_rate: Share of requests within their limit that get a 503
+        seed: Seed for the jitter and the errors
+    """
+
+    def __init__(self, data=None, latency=0.05, jitter=0.0, window=900, limits=None, error_rate=0.0, seed=42):
+        self.data = data if data is not None else FakeTwitterData(seed=seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.windows = RateWindows(dict(RATE_LIMITS, **(limits or {})), window)
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.server = None
+
+    def _count(self, endpoint, status, n_ids=0):
+        with self.lock:
+            stats = self.stats.setdefault(endpoint, {'requests': 0, 'ids': 0, 'status': {}})
+            stats['requests'] += 1
+            stats['ids'] += n_ids
+            stats['status'][str(status)] = stats['status'].get(str(status), 0) + 1
+
+    @staticmethod
+    def account_of(headers):
+        """
+        The bearer token, or the access token of an OAuth 1 header
+        """
+        auth = headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            return auth[len('Bearer '):]
+        match = re.search(r'oauth_token="([^"]*)"', auth)
+        return match.group(1) if match else auth
+
+    def handle(self, method, path, params, headers):
+        """
+        Answers one request
+
+        Returns:
+            (status, body as a JSON-able object, response headers)
+        """
+        if path == '/stats':
+            with self.lock:
+                return 200, json.loads(json.dumps(self.stats)), {}
+        endpoint = endpoint_key(path)
+        if endpoint not in self.windows.limits:
+            self._count(endpoint, 404)
+            return 404, {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist.'}]}, {}
+
+        with self.lock:
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            fail = self.rng.random() < self.error_rate
+        time.sleep(delay)
+        allowed, rate_headers = self.windows.take(self.account_of(headers), endpoint)
+        if not allowed:
+            self._count(endpoint, 429)
+            return 429, {'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]}, rate_headers
+        if fail:
+            self._count(endpoint, 503)
+            return 503, {'errors': [{'code': 130, 'message': 'Over capacity'}]}, rate_headers
+
+        status, body, n_ids = self.route(endpoint, path, params)
+        self._count(endpoint, status, n_ids)
+        return status, body, rate_headers
+
+    def route(self, endpoint, path, params):
+        """
+        Returns (status, body, number of ids or tweets returned) for a request within its rate limit
+        """
+        data = self.data
+        if endpoint in ('/1.1/followers/ids.json', '/1.1/friends/ids.json'):
+            name = params.get('screen_name') or params.get('user_id', '')
+            cursor = int(params.get('cursor', -1))
+            start = 0 if cursor == -1 else cursor
+            count = min(int(params.get('count', 5000)), 5000)
+            ids = data.follower_ids(name, start, count)
+            next_cursor = start + len(ids) if start + len(ids) < data.n_followers else 0
+            if params.get('stringify_ids', '').lower() == 'true':
+                ids = [str(x) for x in ids]
+            return 200, {'ids': ids, 'next_cursor': next_cursor, 'next_cursor_str': str(next_cursor),
+                         'previous_cursor': -start, 'previous_cursor_str': str(-start)}, len(ids)
+
+        if endpoint == '/1.1/users/lookup.json':
+            ids = [x for x in params.get('user_id', '').split(',') if x][:100]
+            users = [data.user_v1(x) for x in ids if data.exists(x)]
+            if not users:
+                return 404, {'errors': [{'code': 17, 'message': 'No user matches for specified terms.'}]}, 0
+            return 200, users, len(users)
+
+        if endpoint == '/2/users':
+            ids = [x for x in params.get('ids', '').split(',') if x][:100]
+            body = {}
+            found = [data.user_v2(x) for x in ids if data.exists(x)]
+            if found:
+                body['data'] = found
+            missing = [x for x in ids if not data.exists(x)]
+            if missing:
+                body['errors'] = [{'value': x, 'detail': f"""Could not find user with ids: [{x}].""",
+                                   'title': 'Not Found Error', 'resource_type': 'user', 'parameter': 'ids',
+                                   'resource_id': x,
+                                   'type': 'https://api.twitter.com/2/problems/resource-not-found'} for x in missing]
+            return 200, body, len(found)
+
+        # /2/users/:id/tweets
+        user_id = path.rstrip('/').split('/')[-2]
+        if not data.exists(user_id):
+            return 200, {'errors': [{'title': 'Not Found Error', 'resource_id': user_id}]}, 0
+        body = data.timeline(user_id, min(max(int(params.get('max_results', 10)), 5), 100))
+        return 200, body, body['meta']['result_count']
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, method):
+                url = urlsplit(self.path)
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    params.update({k: v[-1] for k, v in parse_qs(self.rfile.read(length).decode()).items()})
+                status, body, headers = api.handle(method, url.path, params, self.headers)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, host='127.0.0.1', port=8766):
+        """
+        Serves forever on `host:port`
+        """
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.server.serve_forever()
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Serves from a background thread
+
+        Returns:
+            Base url of the server, e.g. http://127.0.0.1:8766
+        """
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"""http://{host}:{self.server.server_address[1]}"""
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def parse_limits(pairs):
+    """
+    Parses ENDPOINT=CALLS pairs into a dict of rate limits
+    """
+    limits = {}
+    for pair in pairs or []:
+        endpoint, calls = pair.rsplit("=", 1)
+        if endpoint not in RATE_LIMITS:
+            raise ValueError(f"""Unknown endpoint {endpoint}, use one of {list(RATE_LIMITS)}""")
+        limits[endpoint] = int(calls)
+    return limits
+
+
+def add_server_args(parser):
+    """
+    Adds the server's options to an argparse parser, shared with `bench_collectors.py`
+    """
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per request (defaults to 0.05)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many extra seconds per request")
+    parser.add_argument("--window", type=float, default=900, help="Seconds per rate limit window")
+    parser.add_argument("--limit", action="append", default=[],
+                        help="Calls per window for an endpoint, e.g. /1.1/followers/ids.json=15. Repeatable.")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Share of requests that get a 503")
+    parser.add_argument("--n_followers", type=int, default=20000, help="Followers of every account")
+    parser.add_argument("--missing_rate", type=float, default=0.02, help="Share of user ids lookups do not return")
+    parser.add_argument("--no_tweets_rate", type=float, default=0.3, help="Share of users with no tweets")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for the data, jitter and errors")
+
+
+def api_from_args(args):
+    data = FakeTwitterData(seed=args.seed, n_followers=args.n_followers, missing_rate=args.missing_rate,
+                           no_tweets_rate=args.no_tweets_rate)
+    return FakeTwitterAPI(data, latency=args.latency, jitter=args.jitter, window=args.window,
+                          limits=parse_limits(args.limit), error_rate=args.error_rate, seed=args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="Host to bind")
+    parser.add_argument("--port", type=int, default=8766, help="Port to serve on (defaults to 8766)")
+    add_server_args(parser)
+    args = parser.parse_args()
+    print(f"""Fake Twitter API on http://{args.host}:{args.port}""", flush=True)
+    api_from_args(args).serve(args.host, args.port)
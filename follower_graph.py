@@ -0,0 +1,201 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Compact store for the follower graph pulled by `3_pull_init_followers.sh`.
+
+`get_people_relation.py --minimal` writes a (main, followers_id) edge list. Reading that back with pandas holds every
+id as a Python string, so steps 4 and 6 spend most of their time and memory on strings. This module converts it once
+into CSR arrays in a directory:
+
+- `spreaders.json`: spreader names in the order they first appear in the CSV (row i of the graph)
+- `indptr.npy`: int64 array of length n_spreaders + 1. Row i's followers are `indices[indptr[i]:indptr[i + 1]]`
+- `indices.npy`: uint64 follower ids, sorted and unique within each row
+
+`FollowerGraph.load` memory-maps the arrays, so loading is instant and per-spreader extraction is a slice. Overlap
+and dedupe are vectorized over all edges at once.
+
+Usage:
+    python follower_graph.py -i MINIMAL_FOLLOWERS_{...}.csv -g follower_graph
+"""
+
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class FollowerGraph:
+    """
+    Spreaders as rows and their sorted follower ids in CSR arrays.
+
+    Args:
+        spreaders: List of spreader names, one per row
+        indptr: int64 row pointers of length len(spreaders) + 1
+        indices: uint64 follower ids, sorted within each row
+    """
+
+    def __init__(self, spreaders, indptr, indices):
+        self.spreaders = list(spreaders)
+        self.indptr = indptr
+        self.indices = indices
+        self.row_of = {s: i for i, s in enumerate(self.spreaders)}
+
+    def __len__(self):
+        return len(self.spreaders)
+
+    @classmethod
+    def from_csv(cls, edges_fn, followers_col='followers_id', chunksize=5 * 10 ** 6):
+        """
+        Builds the graph from a `get_people_relation.py --minimal` CSV.
+
+        Rows whose follower is not a plain integer (the '00' and '-99_<code>' rows) are dropped, but their spreader
+        still gets a row. Duplicate edges within a spreader are collapsed.
+
+        Args:
+            edges_fn: CSV with `main` and `followers_col` columns
+            followers_col: Name of the follower id column
+            chunksize: Rows of the CSV to parse at once
+        Returns:
+            FollowerGraph held in memory, see `save`
+        """
+        spreaders, row_of = [], {}
+        rows, ids = [], []
+        for chunk in pd.read_csv(edges_fn, usecols=['main', followers_col], dtype='str', chunksize=chunksize):
+            for s in chunk['main'].unique():
+                if s not in row_of:
+                    row_of[s] = len(spreaders)
+                    spreaders.append(s)
+            valid = chunk[followers_col].str.fullmatch(r"[1-9]\d{0,18}").fillna(False).to_numpy(dtype=bool)
+            rows.append(chunk['main'].map(row_of).to_numpy(dtype=np.int64)[valid])
+            ids.append(chunk[followers_col].to_numpy()[valid].astype(np.uint64))
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.uint64)
+        graph = cls._from_edges(spreaders, rows, ids)
+        logging.info(f"""Read {len(rows)} edges from {edges_fn} into {len(graph.indices)} unique edges""")
+        return graph
+
+    @classmethod
+    def _from_edges(cls, spreaders, rows, ids, is_sorted=False):
+        """
+        Sorts (row, id) edge arrays into CSR form, dropping duplicate edges
+        """
+        if not is_sorted:
+            order = np.lexsort((ids, rows))
+            rows, ids = rows[order], ids[order]
+        keep = np.ones(len(ids), dtype=bool)
+        keep[1:] = (rows[1:] != rows[:-1]) | (ids[1:] != ids[:-1])
+        rows, ids = rows[keep], ids[keep]
+        indptr = np.zeros(len(spreaders) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(spreaders)), out=indptr[1:])
+        return cls(spreaders, indptr, ids)
+
+    def save(self, graph_dir):
+        os.makedirs(graph_dir, exist_ok=True)
+        with open(os.path.join(graph_dir, "spreaders.json"), "w") as f:
+            json.dump(self.spreaders, f)
+        np.save(os.path.join(graph_dir, "indptr.npy"), np.asarray(self.indptr))
+        np.save(os.path.join(graph_dir, "indices.npy"), np.asarray(self.indices))
+        logging.info(f"""Saved graph of {len(self)} spreaders and {len(self.indices)} edges to {graph_dir}""")
+
+    @classmethod
+    def load(cls, graph_dir):
+        """
+        Memory-maps a graph written by `save`
+        """
+        with open(os.path.join(graph_dir, "spreaders.json")) as f:
+            spreaders = json.load(f)
+        indptr = np.load(os.path.join(graph_dir, "indptr.npy"))
+        indices = np.load(os.path.join(graph_dir, "indices.npy"), mmap_mode='r')
+        return cls(spreaders, indptr, indices)
+
+    def followers(self, spreader):
+        """
+        Sorted uint64 follower ids of `spreader`, as a view into the graph
+        """
+        i = self.row_of[spreader]
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def degrees(self):
+        """
+        Series of follower counts indexed by spreader
+        """
+        return pd.Series(np.diff(self.indptr), index=self.spreaders, name='n_followers')
+
+    def edge_rows(self):
+        """
+        Row index of every edge, aligned with `indices`
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+
+    def n_unique_followers(self):
+        return len(np.unique(self.indices))
+
+    def overlap(self):
+        """
+        Counts followers shared by each pair of spreaders.
+
+        Returns:
+            Dataframe where cell (a, b) is the number of followers of both a and b. The diagonal is each spreader's
+            follower count.
+        """
+        rows = self.edge_rows()
+        counts = np.zeros((len(self), len(self)), dtype=np.int64)
+        for i, spreader in enumerate(self.spreaders):
+            ids = self.followers(spreader)
+            if len(ids) == 0:
+                continue
+            pos = np.minimum(np.searchsorted(ids, self.indices), len(ids) - 1)
+            hit = ids[pos] == self.indices
+            counts[i] = np.bincount(rows[hit], minlength=len(self))
+        return pd.DataFrame(counts, index=self.spreaders, columns=self.spreaders)
+
+    def dedupe(self, seed=42):
+        """
+        Keeps each follower under exactly one spreader.
+
+        A follower of several spreaders is kept under one of them chosen uniformly at random, like shuffling the edge
+        list and running `drop_duplicates(subset=['followers_id'])`. The draw comes from one seeded generator over the
+        graph's edges, so the result is the same across runs and machines.
+
+        Args:
+            seed: Seed for `np.random.default_rng`
+        Returns:
+            New FollowerGraph held in memory
+        """
+        rng = np.random.default_rng(seed)
+        ids = np.asarray(self.indices)
+        # A stable sort of shuffled edges puts each id's edges in random order, and we keep the first
+        shuffled = rng.permutation(len(ids))
+        order = shuffled[np.argsort(ids[shuffled], kind='stable')]
+        sorted_ids = ids[order]
+        first = np.ones(len(ids), dtype=bool)
+        first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+        # Kept edges in their original order are still sorted by (row, id)
+        keep = np.sort(order[first])
+        return FollowerGraph._from_edges(self.spreaders, self.edge_rows()[keep], ids[keep], is_sorted=True)
+
+    def to_frame(self):
+        """
+        (main, followers_id) edge list with string ids, like the CSV the graph was built from
+        """
+        return pd.DataFrame({'main': np.asarray(self.spreaders, dtype=object)[self.edge_rows()],
+                             'followers_id': np.asarray(self.indices).astype(str).astype(object)})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-input_fn", "-i", help="MINIMAL_FOLLOWERS csv from get_people_relation.py", required=True)
+    parser.add_argument("-graph_dir", "-g", help="Directory to write the graph to", required=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    graph = FollowerGraph.from_csv(args.input_fn)
+    graph.save(args.graph_dir)
+    print("Followers by spreader:")
+    print(graph.degrees())
+    print("Unique followers:", graph.n_unique_followers())
+    print("Shared followers:")
+    print(graph.overlap())
@@ -15,32 +15,87 @@ Updated 2023-12-23:
 - Changed get_people_relation_minimal so it works with usernames and not user ids 
 - Depracated get_people_relation
 
+Updated:
+- Minimal pulls stream each page of 5000 ids straight to the CSV and only log progress
+- Each page's next cursor is checkpointed per (account, main user), and `--resume {output_fn}` continues an
+  interrupted run into the same files
+- API keys are shared through a `helpers.TokenPool`. Threads still split the users, but each cursor page goes to
+  whichever key has calls left, so one key hitting its window does not stall its thread.
+- Requests, latency, errors, remaining calls and sleeps of every key go to `{output_fn}_api_metrics.json`, see
+  `api_metrics.py`
+
 
 
 """
 
 import argparse
 import csv
+import json
 import logging
 import threading
 import pandas as pd
 import tweepy
 
-from helpers import dt_str, exception2value, return_api_dict
+from api_metrics import METRICS
+from helpers import dt_str, exception2value, return_api_dict, TokenPool
 import os
 
 import math
 
-def get_people_relations(api, user_list, relation_type, output_fn, account_name, is_minimal, max_pull):
+RELATION_ENDPOINTS = {'followers': '/1.1/followers/ids.json', 'friends': '/1.1/friends/ids.json'}
+
+
+class CursorCheckpoint:
+    """
+    Per-page checkpoints for one output CSV, stored next to it as `{output_fn}.ckpt.jsonl`.
+
+    Each line is committed after a page of ids is flushed to the CSV and holds the main user, the next cursor, the
+    number of ids written so far, the CSV's byte offset and whether that user is done. On resume the CSV is cut back
+    to the last committed offset, so at most the page in flight when we crashed is lost and pulled again.
+
+    Error rows of users whose pull failed are only written once every user of the file is done (see
+    `get_people_relations`), so no committed offset ever covers them and a resume always cuts them off.
+    """
+
+    def __init__(self, output_fn):
+        self.fn = f"""{output_fn}.ckpt.jsonl"""
+        self.states = {}
+        self.offset = None
+        if os.path.exists(self.fn):
+            with open(self.fn) as f:
+                for line in f:
+                    try:
+                        state = json.loads(line)
+                    except ValueError:
+                        # Half-written last line
+                        break
+                    self.states[state['main']] = state
+                    self.offset = state['offset']
+        self.f = open(self.fn, "a")
+
+    def commit(self, main, cursor, n_written, offset, done):
+        state = {'main': main, 'cursor': cursor, 'n': n_written, 'offset': offset, 'done': done}
+        self.f.write(json.dumps(state) + "\n")
+        self.f.flush()
+        self.states[main] = state
+        self.offset = offset
+
+    def close(self):
+        self.f.close()
+
+
+def get_people_relations(pool, user_list, relation_type, output_fn, account_name, is_minimal, max_pull, resume=False):
     """
     Manages the people relations function calls. Gets either friends or followers for a list of users,
     rotating different API keys.
 
     Args:
-        api: Tweepy api
+        pool: A TokenPool of API keys
         user_list: A list of user_ids
         relation_type: {'friends', 'followers'}
         output_fn: Str of csv name, matches name of log
+        resume: If True, continue an earlier run's `output_fn` from its checkpoints (minimal only). In minimal mode,
+            the `-99` error rows of failed users are written at the end of the file.
 
     Returns:
         None, writes to a CSV file named `output_fn`. Each row of CSV has these fields:
@@ -56,27 +111,50 @@ def get_people_relations(api, user_list, relation_type, output_fn, account_name,
     user_list = user_list
     len_users = len(user_list)
 
-    with open(f"""{output_fn}.csv""", "w") as f:
+    checkpoint = CursorCheckpoint(output_fn) if is_minimal else None
+    csv_fn = f"""{output_fn}.csv"""
+    if resume and checkpoint is not None and checkpoint.offset is not None:
+        # Drop rows written after the last committed page
+        os.truncate(csv_fn, checkpoint.offset)
+        logging.info(f"""Resuming {csv_fn} from byte {checkpoint.offset}""")
+    else:
+        resume = False
+
+    with open(csv_fn, "a" if resume else "w") as f:
         if not is_minimal:
             fieldnames = ['main', f"""{relation_type}_username""", f"""{relation_type}_id""",
                           f"""{relation_type}_followers""", f"""{relation_type}_following""",
                           f"""{relation_type}_tweet_count""", f"""{relation_type}_created_date"""]
-            api_connection = 'client'
-            target_func = get_follow_relation
         else:
             fieldnames = ['main', f"""{relation_type}_id"""]
-            api_connection = 'api'
-            target_func = get_follow_relation_minimal
 
         writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
+        if not resume:
+            writer.writeheader()
+            f.flush()
+
+        # Error rows wait until every user is done, see CursorCheckpoint
+        error_rows = []
 
         for user in user_list:
             logging.info(f"""Parsing {counter} of {len_users} with {account_name}""")
-            people = target_func(account_name, api[api_connection], user, relation_type, max_pull)
-            for f in people:
-                writer.writerow(f)
+            if not is_minimal:
+                people = get_follow_relation(account_name, pool.tweepy_dict[account_name]['client'], user,
+                                             relation_type, max_pull)
+                for person in people:
+                    writer.writerow(person)
+            else:
+                state = checkpoint.states.get(user, {'cursor': -1, 'n': 0, 'done': False})
+                if state['done']:
+                    logging.info(f"""Skipping {user}, already done""")
+                else:
+                    get_follow_relation_minimal(account_name, pool, user, relation_type, max_pull, writer, f,
+                                                cursor=state['cursor'], n_written=state['n'], checkpoint=checkpoint,
+                                                error_rows=error_rows)
             counter += 1
+        writer.writerows(error_rows)
+    if checkpoint:
+        checkpoint.close()
 
 
 def get_follow_relation(account_name, client, user_id, relation_type, max_pull):
@@ -157,70 +235,96 @@ def get_follow_relation(account_name, client, user_id, relation_type, max_pull):
     return people
 
 
-def get_follow_relation_minimal(account_name, api, user_id, relation_type, max_pull):
-    """Get either friends or followers of a given user.
+def iter_relation_pages(pool, relation_type, user_id, cursor=-1):
+    """Yield cursor pages of friend or follower ids, asking the pool for a key before every page.
+
+    Args:
+        pool: A TokenPool of API keys
+        relation_type: The type of relation to get, either 'friends' or 'followers'.
+        user_id: The screen name of the user.
+        cursor: Cursor to start from, -1 is the first page
+
+    Yields:
+        (ids, next_cursor) for each page, where next_cursor is 0 on the last page
+    """
+    endpoint = RELATION_ENDPOINTS[relation_type]
+    while cursor != 0:
+        key_name, connections = pool.acquire(endpoint)
+        api = connections['api']
+        func_call = api.get_follower_ids if relation_type == 'followers' else api.get_friend_ids
+        ids, cursors = func_call(stringify_ids=True, screen_name=user_id, count=5000, cursor=cursor)
+        cursor = cursors[1] if isinstance(cursors, tuple) else cursors
+        yield ids, cursor
+
+
+def get_follow_relation_minimal(account_name, pool, user_id, relation_type, max_pull, writer, f=None, cursor=-1,
+                                n_written=0, checkpoint=None, error_rows=None):
+    """Get either friends or followers of a given user, writing each cursor page of ids as it arrives.
+
+    Only progress is logged, and memory stays at one page no matter how many ids we pull.
 
     Args:
-        account_name: Name of account
-        api: An instance of the `tweepy.API` class.
+        account_name: Name of the thread's account, used for logging
+        pool: A TokenPool of API keys
         user_id: The ID of the user.
         relation_type: The type of relation to get, either 'friends' or 'followers'.
         max_pull: stop after this n
+        writer: csv.DictWriter with fields ['main', '{relation_type}_id']
+        f: Optional file object under `writer`, flushed after each page
+        cursor: Cursor to start from, -1 is the first page
+        n_written: Ids already written for this user by an earlier run
+        checkpoint: Optional CursorCheckpoint, committed after each page (needs `f`)
+        error_rows: Optional list to append the error row to instead of writing it, for the caller to write once no
+            more pages will be committed
 
     Returns:
-        A list of dictionaries containing the `main` user ID and the IDs of the
-        `friends` or `followers` of the `main` user. If no friends or followers
-        are found, returns a list with a single dictionary containing the `main`
-        user ID and the value '00'. If an exception is raised when trying to
-        retrieve the data for a particular user, the dictionary will contain the
-        `main` user ID and the value '-1_<api_code>'. If an exception is raised
-        when trying to retrieve data for any user, the function returns a list
-        with a single dictionary containing the `main` user ID and the value
-        '-99_<api_code>'.
+        Number of ids written. Rows are the `main` user ID and the ID of one of
+        their `friends` or `followers`. If no friends or followers are found, we
+        write a single row with the value '00'. If an exception is raised when
+        trying to retrieve data, we write a row with the value '-99_<api_code>'.
+        Pages written before the error are kept, so a partial pull is followed by
+        that error row, or by nothing until the caller writes `error_rows`. The error row is never checkpointed, so a resume drops
+        it and continues from the last page.
     """
-    # List to hold many people data
-    people = []
-    keys = ['main', f'{relation_type}_id']
+    key = f'{relation_type}_id'
 
-    if relation_type == 'followers':
-        func_call = api.get_follower_ids
-    elif relation_type == 'friends':
-        func_call = api.get_friend_ids
-    else:
-        raise "Entered a bad value: Needs to be one of ['followers', 'friends']"
+    if relation_type not in RELATION_ENDPOINTS:
+        raise ValueError("Entered a bad value: Needs to be one of ['followers', 'friends']")
 
     # Try to fetch the followers for a given user
     # If the initial function call does not throw an error, we enter the `try` block
     try:
-        for f in tweepy.Cursor(func_call, stringify_ids=True, screen_name=user_id, count=5000).items():
-            if len(people) >= max_pull:
-                break 
-
-            data = dict.fromkeys(keys, str(-999))
-            data.update({'main': user_id})
-
-            # Catch exceptions at the follower level, return API "-1_{api_code}"
-            try:
-                data.update({f'{relation_type}_id': str(f)})
-                people.append(data)
-            except Exception as e:
-                logging.info(f'ERROR parsing data for particular {user_id}: {e}')
-                data.update({f'{relation_type}_id': exception2value(e, '-1')})
-                people.append(data)
-
-        # Return "00" if no followers/friends
-        if len(people) == 0:
-            people = [{'main': user_id, f'{relation_type}_id': '00'}]
-
-    # If the function call DOES throw an error, then we can't get any data for a main account.
-    # If can't pull ANY data for user (i.e: exception at the main account level) return "-99_{api code}"
+        for page, next_cursor in iter_relation_pages(pool, relation_type, user_id, cursor):
+            page = page[:max_pull - n_written]
+            writer.writerows({'main': user_id, key: str(x)} for x in page)
+            if f:
+                f.flush()
+            n_written += len(page)
+            logging.info(f"""Wrote {n_written} {relation_type} of {user_id} with {account_name}""")
+            done = next_cursor == 0 or n_written >= max_pull
+            if checkpoint and not (done and n_written == 0):
+                checkpoint.commit(user_id, next_cursor, n_written, f.tell(), done)
+            if n_written >= max_pull:
+                break
+
+        # Write "00" if no followers/friends
+        if n_written == 0:
+            writer.writerow({'main': user_id, key: '00'})
+            if checkpoint:
+                f.flush()
+                checkpoint.commit(user_id, 0, 0, f.tell(), True)
+
+    # If the function call DOES throw an error, then we can't get (the rest of) the data for a main account.
+    # Write "-99_{api code}"
     except Exception as e:
-
-        logging.info(f"ERROR: Couldn't pull any data for {user_id}: {e}")
-        people = [{'main': user_id, f"""{relation_type}_id""": f"""{exception2value(e, "-99")}"""}]
-    logging.info("Logged {} people with {}".format(len(people), account_name))
-    logging.info(people)
-    return people
+        logging.info(f"ERROR: Couldn't pull data for {user_id} after {n_written}: {e}")
+        error_row = {'main': user_id, key: exception2value(e, "-99")}
+        if error_rows is not None:
+            error_rows.append(error_row)
+        else:
+            writer.writerow(error_row)
+    logging.info("Logged {} people with {}".format(n_written, account_name))
+    return n_written
 
 
 def chunk_list(lst, k):
@@ -231,7 +335,7 @@ def chunk_list(lst, k):
     return chunks
 
 
-def main(output_fn, input_fn, creds_fn, relation_type, is_minimal, start_idx, end_idx, max_pull):
+def main(output_fn, input_fn, creds_fn, relation_type, is_minimal, start_idx, end_idx, max_pull, resume=False):
     # Get ids
     f = open(input_fn)
 
@@ -257,6 +361,9 @@ def main(output_fn, input_fn, creds_fn, relation_type, is_minimal, start_idx, en
         apis_dict = {first_element_key: apis_dict[first_element_key]}
         chunks = [input_ids]
 
+    # Every thread draws from the same pool of keys
+    pool = TokenPool(apis_dict)
+
     # Log data
     logging.basicConfig(
         filename=f"""{output_fn}.log""",
@@ -266,18 +373,21 @@ def main(output_fn, input_fn, creds_fn, relation_type, is_minimal, start_idx, en
     )
 
     logging.info(f"""INPUT:{input_fn}, CREDS:{creds_fn}, "RELATION":{relation_type}, START:END={start_idx}:{end_idx}, "MAXPULL:{max_pull}""")
+    metrics_fn = f"""{output_fn}_api_metrics.json"""
+    METRICS.start_snapshots(metrics_fn)
 
     # Create threads
     threads = []
     for i in range(len(chunks)):
         account_name = list(apis_dict.keys())[i]
-        t = threading.Thread(target=get_people_relations, args=(apis_dict[account_name], chunks[i], relation_type, output_fn + "_" + account_name, account_name, is_minimal, max_pull))
+        t = threading.Thread(target=get_people_relations, args=(pool, chunks[i], relation_type, output_fn + "_" + account_name, account_name, is_minimal, max_pull, resume))
         threads.append(t)
         t.start()
 
     # Wait for all threads to finish
     for t in threads:
         t.join()
+    METRICS.write(metrics_fn)
 
     # # Get all files in directory
 
@@ -319,8 +429,12 @@ if __name__ == "__main__":
     parser.add_argument('--minimal', '-m', dest="minimal",
                         help="If minimal, use v1 endpoint that only returns ids and not any user data. This endpoint returns 5000 ids per request rather than 1500.",
                         action='store_true')
+    parser.add_argument('--resume', dest="resume", default="",
+                        help="Output filename (without account suffix or extension) of an interrupted --minimal run to continue from its checkpoints. Use the same input, creds and indexes.")
 
     args = parser.parse_args()
+    if args.resume and not args.minimal:
+        parser.error("--resume only works with --minimal, the only mode with checkpoints")
     # If debug mode only get 1 user
     end_idx = 1 if args.debug else args.end_idx
     debug_tag = "DEBUG_" if args.debug else ""
@@ -328,6 +442,8 @@ if __name__ == "__main__":
 
     prefix_tag = args.prefix + "__" if args.prefix else args.prefix
     output_fn = f"""{prefix_tag}{debug_tag}{minimal_tag}{args.relation_type.upper()}_{dt_str()}__START{args.start_idx}_END{end_idx}"""
+    output_fn = args.resume if args.resume else output_fn
 
     main(output_fn=output_fn, input_fn=args.input_fn, creds_fn=args.creds_fn, relation_type=args.relation_type,
-         start_idx=args.start_idx, end_idx=end_idx, is_minimal=args.minimal, max_pull=args.max_pull)
+         start_idx=args.start_idx, end_idx=end_idx, is_minimal=args.minimal, max_pull=args.max_pull,
+         resume=bool(args.resume))
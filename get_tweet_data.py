@@ -16,6 +16,24 @@ There are two jsonl files that are created.
     First, I collect all the URLs in a nice expanded format (for primary and refd). Second, I also add the author info
     to the data for each ref tweet.
 
+OUTPUT FORMAT
+- With `--output_format parquet` the processed tweets go to `{fn}_processed.parquet` (one row per tweet, one row group
+    per (spreader, condition) block) and the raw data to `{fn}_raw.jsonl.zst`. See `tweet_writers.py`, which also
+    converts the jsonl files of earlier runs.
+- With `--output_format entities` the raw data goes to deduplicated `{fn}_tweets`, `{fn}_ref_tweets` and `{fn}_users`
+    parquet tables keyed by id, and `{fn}_records.parquet` holds only the ids per user. Load them with
+    `tweet_writers.EntityStore`; the processed data can be rebuilt with `parse_tweet` from `EntityStore.raw_record`.
+
+ASYNC MODE
+- With `--async_mode` each (spreader, condition) block keeps `--max_in_flight` requests open at once. Results are
+    still committed in input order and spare requests are cancelled once a block hits `n_users_per_spreader`, so the
+    three output files have the same shape as the serial mode. `bench_async_tweets.py` checks this against the serial
+    mode with fake clients and measures the speedup.
+
+API METRICS
+- Requests, latency, errors, remaining calls and rate limit sleeps go to `{file_prefix}_api_metrics.json`, see
+    `api_metrics.py`
+
 MISSING DATA
 - If there are errors then we still write the data to the file, but we write -1 for keys other than `original_user_id`
 - If the user actually has no tweets then we write -9 instead of -1
@@ -29,10 +47,14 @@ import random
 import json
 import tweepy
 import argparse
+import asyncio
 import logging
 import datetime
 import csv
 
+from api_metrics import METRICS
+from tweet_writers import WRITERS, open_writer
+
 random.seed(416)
 np.random.seed(416)
 
@@ -40,39 +62,65 @@ with open('twitter_creds3.json', 'r') as file:
     secrets = json.load(file)
 TWITTER_API = secrets['personal_news']
 client = tweepy.Client(bearer_token=TWITTER_API['bearer_token'], wait_on_rate_limit=True)
+METRICS.instrument(client.session, 'personal_news')
+
+TWEET_FIELDS = [
+    "attachments", "author_id", "conversation_id",
+    "created_at", "entities", "geo", "id", "in_reply_to_user_id", "lang", "public_metrics", "referenced_tweets",
+    "reply_settings",
+    "source", "text", "withheld", "note_tweet"
+]
+MEDIA_FIELDS = ['url', 'preview_image_url']
+EXPANSIONS = [
+    "attachments.poll_ids", "attachments.media_keys", "author_id", "geo.place_id",
+    "in_reply_to_user_id", "referenced_tweets.id", "entities.mentions.username",
+    "referenced_tweets.id.author_id",
+]
+
+
+def missing_records(user_id, code):
+    """
+    The (raw, processed) records of a user without tweets: `code` is -9 if the user has none and -1 for an error
+    """
+    raw = {'original_user_id': user_id, 'data': code, 'includes_users': code, 'includes_tweets': code}
+    processed = {'original_user_id': user_id, 'processed': code}
+    return raw, processed
+
+
+def tweet_records(tweets, user_id):
+    """
+    The (raw, processed) records of a `get_users_tweets` response, shared by the serial and async modes
+    """
+    if tweets.data:
+        return process_tweets(tweets, user_id)
+    return missing_records(user_id, -9)
 
 
 def fetch_and_process_tweets(user_id, n_per_user):
     try:
-        tweets = get_tweets(user_id, n_per_user)
-        if tweets.data:
-            raw, processed = process_tweets(tweets, user_id)
-        else:
-            raw = {'original_user_id': user_id, 'data': -9, 'includes_users': -9, 'includes_tweets': -9}
-            processed = {'original_user_id': user_id, 'processed': -9}
+        return tweet_records(get_tweets(user_id, n_per_user), user_id)
     except Exception as e:
         logging.exception(f"Error for user {user_id}: {e}")
-        raw = {'original_user_id': user_id, 'data': -1, 'includes_users': -1, 'includes_tweets': -1}
-        processed = {'original_user_id': user_id, 'processed': -1}
-
-    return raw, processed
+        return missing_records(user_id, -1)
 
 
-def write_to_files(raw_file, processed_file, raw, processed):
-    raw_file.write(json.dumps(raw) + "\n")
-    processed_file.write(json.dumps(processed) + "\n")
+def has_tweets(raw):
+    """
+    True if the user had tweets and we pulled them without an error
+    """
+    return raw['data'] != -1 and raw['data'] != -9
 
 
-def tweet_controller_ids(df, n_per_user, fn):
-    with open(f'{fn}_raw.jsonl', 'w') as raw_file, open(f'{fn}_processed.jsonl', 'w') as processed_file:
+def tweet_controller_ids(df, n_per_user, fn, output_format='jsonl'):
+    with open_writer(output_format, fn) as writer:
         for user_id in df['id']:
             raw, processed = fetch_and_process_tweets(user_id, n_per_user)
-            write_to_files(raw_file, processed_file, raw, processed)
+            writer.write(raw, processed)
     logging.info("Done")
 
 
-def tweet_controller(df, n_per_user, n_users_per_spreader, fn):
-    with open(f'{fn}_raw.jsonl', 'w') as raw_file, open(f'{fn}_processed.jsonl', 'w') as processed_file, open(
+def tweet_controller(df, n_per_user, n_users_per_spreader, fn, output_format='jsonl'):
+    with open_writer(output_format, fn) as writer, open(
             f'{fn}_{n_users_per_spreader}_success.csv', 'w', newline='') as success_file:
         csv_writer = csv.writer(success_file)
         csv_writer.writerow(['follower_id', 'spreader_username', 'condition'])
@@ -85,8 +133,8 @@ def tweet_controller(df, n_per_user, n_users_per_spreader, fn):
                 if user_id_success >= n_users_per_spreader:
                     break
                 raw, processed = fetch_and_process_tweets(user_id, n_per_user)
-                if raw['data'] != -1 and raw['data'] != -9:
-                    write_to_files(raw_file, processed_file, raw, processed)
+                if has_tweets(raw):
+                    writer.write(raw, processed, (spreader_username, condition))
                     csv_writer.writerow([user_id, spreader_username, condition])
                     user_id_success += 1
             logging.info("Finished a spreader block")
@@ -99,22 +147,108 @@ def get_tweets(user_id, n=10):
     tweets_response = client.get_users_tweets(
         id=user_id,
         max_results=n,
-        tweet_fields=[
-            "attachments", "author_id", "conversation_id",
-            "created_at", "entities", "geo", "id", "in_reply_to_user_id", "lang", "public_metrics", "referenced_tweets",
-            "reply_settings",
-            "source", "text", "withheld", "note_tweet"
-        ],
-        media_fields=['url', 'preview_image_url'],
-        expansions=[
-            "attachments.poll_ids", "attachments.media_keys", "author_id", "geo.place_id",
-            "in_reply_to_user_id", "referenced_tweets.id", "entities.mentions.username",
-            "referenced_tweets.id.author_id",
-        ]
+        tweet_fields=TWEET_FIELDS,
+        media_fields=MEDIA_FIELDS,
+        expansions=EXPANSIONS
+    )
+    return tweets_response
+
+
+def return_async_client(TWITTER_API):
+    """
+    Inits asynchronous tweepy client. Only needed for the async mode, which also needs aiohttp installed.
+    """
+    from tweepy.asynchronous import AsyncClient
+    return AsyncClient(bearer_token=TWITTER_API['bearer_token'], wait_on_rate_limit=True)
+
+
+async def async_get_tweets(async_client, user_id, n=10):
+    tweets_response = await async_client.get_users_tweets(
+        id=user_id,
+        max_results=n,
+        tweet_fields=TWEET_FIELDS,
+        media_fields=MEDIA_FIELDS,
+        expansions=EXPANSIONS
     )
     return tweets_response
 
 
+async def async_fetch_and_process_tweets(async_client, user_id, n_per_user):
+    try:
+        return tweet_records(await async_get_tweets(async_client, user_id, n_per_user), user_id)
+    except Exception as e:
+        logging.exception(f"Error for user {user_id}: {e}")
+        return missing_records(user_id, -1)
+
+
+async def async_tweet_block(async_client, user_ids, n_per_user, n_users_per_spreader, max_in_flight):
+    """
+    Fetches tweets for one (spreader, condition) block with at most `max_in_flight` requests open at once.
+
+    Results are committed in the order of `user_ids`, so a block ends up with the same successes the serial
+    `tweet_controller` would pick. Once we have `n_users_per_spreader` successes we stop launching requests and
+    cancel the ones still in flight.
+
+    Returns:
+        List of (user_id, raw, processed) tuples for users with tweets
+    """
+    successes = []
+    in_flight = {}
+    next_launch = 0
+    next_commit = 0
+    try:
+        while next_commit < len(user_ids) and len(successes) < n_users_per_spreader:
+            while next_launch < len(user_ids) and next_launch - next_commit < max_in_flight:
+                in_flight[next_launch] = asyncio.ensure_future(
+                    async_fetch_and_process_tweets(async_client, user_ids[next_launch], n_per_user))
+                next_launch += 1
+            raw, processed = await in_flight.pop(next_commit)
+            if has_tweets(raw):
+                successes.append((user_ids[next_commit], raw, processed))
+            next_commit += 1
+    finally:
+        for task in in_flight.values():
+            task.cancel()
+        await asyncio.gather(*in_flight.values(), return_exceptions=True)
+    logging.info("Launched {} requests, cancelled {}".format(next_launch, len(in_flight)))
+    return successes
+
+
+async def async_tweet_controller(async_client, df, n_per_user, n_users_per_spreader, fn, max_in_flight=10,
+                                 output_format='jsonl'):
+    """
+    Async version of `tweet_controller`. Blocks are processed one after another but each block keeps
+    `max_in_flight` requests open. Writes the same three files as `tweet_controller`.
+    """
+    import aiohttp
+
+    own_session = async_client.session is None
+    if own_session:
+        async_client.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_in_flight),
+                                                     trace_configs=[METRICS.trace_config('personal_news')])
+    try:
+        with open_writer(output_format, fn) as writer, open(
+                f'{fn}_{n_users_per_spreader}_success.csv', 'w', newline='') as success_file:
+            csv_writer = csv.writer(success_file)
+            csv_writer.writerow(['follower_id', 'spreader_username', 'condition'])
+
+            for (spreader_username, condition), group in df.groupby(['spreader_username', 'condition']):
+                user_ids = group['id'].tolist()
+                successes = await async_tweet_block(async_client, user_ids, n_per_user, n_users_per_spreader,
+                                                    max_in_flight)
+                for user_id, raw, processed in successes:
+                    writer.write(raw, processed, (spreader_username, condition))
+                    csv_writer.writerow([user_id, spreader_username, condition])
+                logging.info("Finished a spreader block")
+                logging.info("Success {}".format(len(successes)))
+    finally:
+        if own_session:
+            await async_client.session.close()
+            async_client.session = None
+
+    logging.info("Done with all users")
+
+
 def process_tweets(tweets_response, user_id):
     # Try to get included tweets unless there are no included tweets bundled
     try:
@@ -205,18 +339,26 @@ def parse_tweet(tweet, includes_tweet_data, includes_user_data):
     return tweet
 
 
-def main(fn, n_per_user, n_users_per_spreader, file_prefix, debug):
+def main(fn, n_per_user, n_users_per_spreader, file_prefix, debug, async_mode=False, max_in_flight=10,
+         output_format='jsonl'):
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d__%H--%M--%S')
     file_prefix = f"{file_prefix}_{timestamp}"
 
     logging.basicConfig(filename=f"{file_prefix}_data.log", filemode='w', level=logging.INFO,
                         format='%(asctime)s: %(message)s', datefmt='%Y-%m-%d__%H--%M--%S')
+    metrics_fn = f"{file_prefix}_api_metrics.json"
+    METRICS.start_snapshots(metrics_fn)
     df = pd.read_csv(fn, dtype={'id': str})
     df = df.sample(frac=1, random_state=42)
-    if n_users_per_spreader:
-        tweet_controller(df, n_per_user, n_users_per_spreader, file_prefix)
+    if n_users_per_spreader and async_mode:
+        async_client = return_async_client(TWITTER_API)
+        asyncio.run(async_tweet_controller(async_client, df, n_per_user, n_users_per_spreader, file_prefix,
+                                           max_in_flight, output_format))
+    elif n_users_per_spreader:
+        tweet_controller(df, n_per_user, n_users_per_spreader, file_prefix, output_format)
     else:
-        tweet_controller_ids(df, n_per_user, file_prefix)
+        tweet_controller_ids(df, n_per_user, file_prefix, output_format)
+    METRICS.write(metrics_fn)
 
 
 if __name__ == "__main__":
@@ -228,6 +370,17 @@ if __name__ == "__main__":
     parser.add_argument('-file_prefix', '--file_prefix', type=str, required=True, help='Prefix for the output file')
     parser.add_argument('-d', '--d', dest='debug', action='store_true', default=False,
                         help='Enable debug mode (default: False)')
+    parser.add_argument('-async_mode', '--async_mode', dest='async_mode', action='store_true', default=False,
+                        help='Use the asyncio client to keep several requests per block in flight. Needs '
+                             'n_users_per_spreader (default: False)')
+    parser.add_argument('-max_in_flight', '--max_in_flight', type=int, default=10,
+                        help='Max concurrent requests per block in async mode (default: 10)')
+    parser.add_argument('-output_format', '--output_format', choices=list(WRITERS), default='jsonl',
+                        help='jsonl files, or parquet tweets plus zstd raw records, see tweet_writers.py '
+                             '(default: jsonl)')
 
     args = parser.parse_args()
-    main(args.fn, args.n_per_user, args.n_users_per_spreader, args.file_prefix, args.debug)
+    if args.async_mode and not args.n_users_per_spreader:
+        parser.error("--async_mode needs --n_users_per_spreader, the all-ids mode only runs serially")
+    main(args.fn, args.n_per_user, args.n_users_per_spreader, args.file_prefix, args.debug, args.async_mode,
+         args.max_in_flight, args.output_format)
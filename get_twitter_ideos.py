@@ -14,9 +14,14 @@ from joblib import Parallel, delayed
 import os
 import logging
 import argparse
+import numpy as np
 import pandas as pd
 from datetime import datetime
 
+# Ideology chunks that pablo emailed me
+# These represent all people who followed at least 3 political accounts as of 2020
+IDEO_URLS = [f"https://storage.googleapis.com/tweetscores/user-ideal-points-202008_00000000000{i}" for i in range(7)]
+
 
 def merge_id_chunk(input_df, input_id_col, id_url, join_type):
     """
@@ -48,7 +53,141 @@ def clean_data(id_df, id_col):
     return fixed_data
 
 
-def main(input_fn, id_col, join_type, debug_mode, output_fn=None, client_df=None):
+def build_ideo_index(id_urls, index_dir, chunksize=5 * 10 ** 6):
+    """
+    One-time build of a local ideology index from the id shards.
+
+    Writes two aligned arrays to `index_dir`: `ids.npy` (sorted uint64 ids) and `theta.npy` (float32). Duplicate ids
+    are resolved the same way as `clean_data`, keeping the row with the highest theta (NaN last). Load it back with
+    `load_ideo_index`.
+
+    Args:
+        id_urls (list): Shard urls or local paths
+        index_dir (str): Directory to write the index to
+        chunksize (int): Rows of a shard to parse at once
+    Returns:
+        Number of unique ids in the index
+    """
+    ids, thetas = [], []
+    for id_url in id_urls:
+        for chunk in pd.read_csv(id_url, usecols=["id_str", "theta"], dtype={"id_str": 'str'}, chunksize=chunksize):
+            valid = chunk["id_str"].str.fullmatch(r"\d{1,19}").fillna(False).to_numpy(dtype=bool)
+            ids.append(chunk["id_str"].to_numpy()[valid].astype(np.uint64))
+            thetas.append(chunk["theta"].to_numpy(dtype=np.float32)[valid])
+        logging.info(f"""Read shard {id_url}""")
+    ids = np.concatenate(ids)
+    thetas = np.concatenate(thetas)
+
+    # Sort by id then descending theta, NaN sorts last, and keep the first row of each id
+    order = np.lexsort((-thetas, ids))
+    ids, thetas = ids[order], thetas[order]
+    first = np.ones(len(ids), dtype=bool)
+    first[1:] = ids[1:] != ids[:-1]
+    ids, thetas = ids[first], thetas[first]
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, "ids.npy"), ids)
+    np.save(os.path.join(index_dir, "theta.npy"), thetas)
+    logging.info(f"""Built index of {len(ids)} ids in {index_dir}""")
+    return len(ids)
+
+
+def load_ideo_index(index_dir):
+    """
+    Memory-maps an index written by `build_ideo_index`
+
+    Returns:
+        (ids, theta) arrays
+    """
+    ids = np.load(os.path.join(index_dir, "ids.npy"), mmap_mode='r')
+    theta = np.load(os.path.join(index_dir, "theta.npy"), mmap_mode='r')
+    return ids, theta
+
+
+def lookup_ideo(index, query_ids):
+    """
+    Vectorized binary search of ids in the index.
+
+    Args:
+        index (tuple): (ids, theta) from `load_ideo_index`
+        query_ids (pd.Series): String ids. Anything that is not a plain integer (e.g. error codes) is not found.
+    Returns:
+        (found, theta) arrays aligned with `query_ids`, where theta is NaN if not found
+    """
+    ids, theta = index
+    query_ids = pd.Series(query_ids).astype('str')
+    valid = query_ids.str.fullmatch(r"\d{1,19}").fillna(False).to_numpy(dtype=bool)
+    q = np.zeros(len(query_ids), dtype=np.uint64)
+    q[valid] = query_ids[valid].to_numpy().astype(np.uint64)
+
+    out_theta = np.full(len(q), np.nan, dtype=np.float32)
+    if len(ids) == 0:
+        return np.zeros(len(q), dtype=bool), out_theta
+    pos = np.minimum(np.searchsorted(ids, q), len(ids) - 1)
+    found = valid & (ids[pos] == q)
+    out_theta[found] = theta[pos[found]]
+    return found, out_theta
+
+
+def merge_ideo_index(input_df, input_id_col, index, join_type):
+    """
+    Joins the input file with the ideology index. Like `merge_id_chunk` followed by `clean_data`, but only theta is
+    kept from the ideology data and input rows are not collapsed to one per id.
+
+    Args:
+        input_df (df): Pandas dataframe
+        input_id_col (str): String pointing to user id
+        index (tuple): (ids, theta) from `load_ideo_index`
+        join_type (str): One of "inner", "left"
+    Returns:
+        Dataframe with `id_str`, `theta` and `found_ideo` columns added
+    """
+    found, theta = lookup_ideo(index, input_df[input_id_col])
+    out = input_df.copy()
+    out["id_str"] = out[input_id_col].where(found)
+    out["theta"] = theta
+    out["found_ideo"] = np.where(found, "non_missing", "missing")
+    if join_type == "inner":
+        out = out[found]
+    return out
+
+
+def stream_ideo_index(input_fn, input_id_col, index, join_type, output_fn, max_mem_mb=512):
+    """
+    Out-of-core version of the index join. Reads the input in chunks, joins each chunk against the memory-mapped
+    index and appends it to `output_fn`, so peak memory is set by `max_mem_mb` and not by the size of the input.
+
+    Unlike `main`, rows are not collapsed to one per id since that would need every seen id in memory.
+
+    Args:
+        input_fn (str): Input csv
+        input_id_col (str): String pointing to user id
+        index (tuple): (ids, theta) from `load_ideo_index`
+        join_type (str): One of "inner", "left"
+        output_fn (str): Output csv
+        max_mem_mb (int): Rough memory ceiling for a chunk and its joined copy
+    Returns:
+        (rows read, rows written)
+    """
+    # Size the chunks from what a sample of rows costs once parsed. The joined copy and the
+    # string ids we parse roughly triple that.
+    sample = pd.read_csv(input_fn, dtype={input_id_col: 'object'}, nrows=1000)
+    row_bytes = max(sample.memory_usage(deep=True, index=True).sum() / max(len(sample), 1), 1)
+    chunksize = max(int(max_mem_mb * 1024 ** 2 / (3 * row_bytes)), 1000)
+    logging.info(f"""Streaming {input_fn} in chunks of {chunksize} rows (~{row_bytes:.0f} bytes/row)""")
+
+    n_read, n_written = 0, 0
+    for i, chunk in enumerate(pd.read_csv(input_fn, dtype={input_id_col: 'object'}, chunksize=chunksize)):
+        merged = merge_ideo_index(chunk, input_id_col, index, join_type)
+        merged.to_csv(output_fn, mode='w' if i == 0 else 'a', header=(i == 0))
+        n_read += len(chunk)
+        n_written += len(merged)
+        logging.info(f"""Chunk {i}: read {n_read} rows, wrote {n_written} rows""")
+    return n_read, n_written
+
+
+def main(input_fn, id_col, join_type, debug_mode, output_fn=None, client_df=None, index_dir=None, stream=False,
+         max_mem_mb=512):
     debug_str = "DEBUG_" if debug_mode else ""
     fn = f"""IDEO_{debug_str}{join_type.upper()}_{datetime.today().strftime('%Y-%m-%d-%H:%M:%S')}"""
     logging.basicConfig(
@@ -61,25 +200,31 @@ def main(input_fn, id_col, join_type, debug_mode, output_fn=None, client_df=None
 
     logging.info(f"""Using {input_fn}, join type: {join_type},  n_jobs:{n_jobs}""")
 
-    # Ideology chunks that pablo emailed me
-    # These represent all people who followed at least 3 political accounts as of 2020
-    i0 = "https://storage.googleapis.com/tweetscores/user-ideal-points-202008_000000000000"
-    i1 = "https://storage.googleapis.com/tweetscores/user-ideal-points-202008_000000000001"
-    i2 = "https://storage.googleapis.com/tweetscores/user-ideal-points-202008_000000000002"
-    i3 = "https://storage.googleapis.com/tweetscores/user-ideal-points-202008_000000000003"
-    i4 = "https://storage.googleapis.com/tweetscores/user-ideal-points-202008_000000000004"
-    i5 = "https://storage.googleapis.com/tweetscores/user-ideal-points-202008_000000000005"
-    i6 = "https://storage.googleapis.com/tweetscores/user-ideal-points-202008_000000000006"
-    ids = [i0, i1, i2, i3, i4, i5, i6] if not debug_mode else [i0]
+    ids = IDEO_URLS if not debug_mode else IDEO_URLS[:1]
+
+    # Streaming mode never holds the whole input, so it returns counts rather than a dataframe
+    if stream:
+        output_fn = output_fn if output_fn else f"""{fn}.csv"""
+        n_read, n_written = stream_ideo_index(input_fn, id_col, load_ideo_index(index_dir), join_type, output_fn,
+                                              max_mem_mb)
+        logging.info(f"""Wrote to file {output_fn}""")
+        logging.info(f"""Original file was length {n_read} and new file is of length {n_written}""")
+        return n_read, n_written
 
     # Input file
-    if not client_df:
+    if client_df is None:
         df = pd.read_csv(input_fn, dtype={id_col: 'object'})
     else:
         df = client_df
-    dfs = pd.concat(
-        Parallel(n_jobs=n_jobs)(delayed(merge_id_chunk)(df, id_col, ids[x], join_type) for x in range(len(ids))))
-    dfs = clean_data(dfs, id_col)
+
+    # With a prebuilt index we skip the shards entirely; we still keep one row per id like `clean_data`
+    if index_dir:
+        dfs = merge_ideo_index(df, id_col, load_ideo_index(index_dir), join_type)
+        dfs = dfs.dropna(subset=[id_col]).sort_values(by=id_col).drop_duplicates(subset=[id_col])
+    else:
+        dfs = pd.concat(
+            Parallel(n_jobs=n_jobs)(delayed(merge_id_chunk)(df, id_col, ids[x], join_type) for x in range(len(ids))))
+        dfs = clean_data(dfs, id_col)
 
     # If output filename is provided, use it. Otherwise, use the generated filename.
     output_fn = output_fn if output_fn else f"""{fn}.csv"""
@@ -91,13 +236,30 @@ def main(input_fn, id_col, join_type, debug_mode, output_fn=None, client_df=None
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("-input_fn", "-i", required=True, help="Input filename")
-    parser.add_argument("-id_col", "-c", required=True, help="Column pointing to user id")
+    parser.add_argument("-input_fn", "-i", help="Input filename")
+    parser.add_argument("-id_col", "-c", help="Column pointing to user id")
     parser.add_argument("--join_type", "--j", help="Join type (defaults to inner)", choices=['inner', 'left'],
                         default='inner')
     parser.add_argument("--debug", "--d", help="Only runs with first ID chunk for testing",
                         action='store_true')
     parser.add_argument("--output_fn", "--o", help="Optional output filename",
                         default=None)
+    parser.add_argument("--build_index", help="Build a local ideology index from the shards into this directory, then exit",
+                        default=None)
+    parser.add_argument("--index", help="Join against a local index built with --build_index instead of the shards",
+                        default=None)
+    parser.add_argument("--stream", help="Join the input in chunks against --index, writing as it goes",
+                        action='store_true')
+    parser.add_argument("--max_mem_mb", help="Memory ceiling for --stream chunks in MB (defaults to 512)",
+                        default=512, type=int)
     args = parser.parse_args()
-    main(input_fn=args.input_fn, id_col=args.id_col, join_type=args.join_type, debug_mode=args.debug, output_fn=args.output_fn)
+    if args.stream and not args.index:
+        parser.error("--stream needs --index")
+    if args.build_index:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+        build_ideo_index(IDEO_URLS if not args.debug else IDEO_URLS[:1], args.build_index)
+    elif not args.input_fn or not args.id_col:
+        parser.error("-input_fn and -id_col are required unless using --build_index")
+    else:
+        main(input_fn=args.input_fn, id_col=args.id_col, join_type=args.join_type, debug_mode=args.debug,
+             output_fn=args.output_fn, index_dir=args.index, stream=args.stream, max_mem_mb=args.max_mem_mb)
@@ -1,9 +1,17 @@
 import collections
 import json
+import logging
+import threading
+import time
 from datetime import datetime
 
 import tweepy
 
+from api_metrics import METRICS, endpoint_key
+
+# Budget assumed for a key we have no rate limit headers for yet
+UNKNOWN_BUDGET = 10 ** 6
+
 
 def return_api_dict(creds_fn, auth_type='app'):
     """
@@ -14,7 +22,7 @@ def return_api_dict(creds_fn, auth_type='app'):
         auth_type: App or user authentication
 
     Returns:
-        Dictionary of Tweepy clients keyed by account alias
+        Dictionary of Tweepy clients keyed by account alias. Their calls are recorded in `api_metrics.METRICS`.
     """
     f = open(creds_fn)
     api_dict = json.load(f)
@@ -31,9 +39,92 @@ def return_api_dict(creds_fn, auth_type='app'):
         tweepy_dict[key]['client'] = tweepy.Client(bearer_token=bearer_token, wait_on_rate_limit=True)
         tweepy_dict[key]['api'] = tweepy.API(auth, wait_on_rate_limit=True, timeout=1200, retry_count=10, retry_delay=5,
                                              retry_errors=set([500, 502, 503, 504]))
+        METRICS.instrument(tweepy_dict[key]['client'].session, key)
+        METRICS.instrument(tweepy_dict[key]['api'].session, key)
     return tweepy_dict
 
 
+class TokenPool:
+    """
+    Shares the calls of every credential in a `return_api_dict` dict.
+
+    Each response's `x-rate-limit-remaining` and `x-rate-limit-reset` headers are recorded per (account, endpoint)
+    and `acquire` hands out whichever account has the most calls left for an endpoint. So total throughput is the sum
+    of all keys' limits, rather than each thread sleeping on its own key while the others sit idle. If every key is
+    out of calls, `acquire` sleeps until the first one resets.
+
+    The clients keep `wait_on_rate_limit=True` as a backstop in case our counts drift from the server's.
+    """
+
+    def __init__(self, tweepy_dict):
+        self.tweepy_dict = tweepy_dict
+        self.limits = {}
+        self.lock = threading.Lock()
+        for account_name, connections in tweepy_dict.items():
+            for connection in connections.values():
+                connection.session.hooks['response'].append(self._make_hook(account_name))
+
+    def __len__(self):
+        return len(self.tweepy_dict)
+
+    def _make_hook(self, account_name):
+        def hook(response, *args, **kwargs):
+            self.update(account_name, endpoint_key(response.url), response.headers)
+        return hook
+
+    def update(self, account_name, endpoint, headers):
+        """
+        Records the rate limit headers of a response
+        """
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            self.limits[(account_name, endpoint)] = {'remaining': int(remaining), 'reset': int(reset), 'handed': 0}
+
+    def acquire(self, endpoint):
+        """
+        Picks the account with the most calls left on `endpoint`, sleeping if none have any.
+
+        Accounts we have not seen a response from yet (or whose window has reset) count as having full budget. Each
+        hand out is subtracted from the account's budget until the next response updates it, so concurrent threads
+        spread out over the keys.
+
+        Args:
+            endpoint: Endpoint key as returned by `endpoint_key`
+
+        Returns:
+            (account_name, connections) where connections is the {'client', 'api'} dict from `return_api_dict`
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                best_name, best_budget, first_reset = None, None, None
+                for account_name in self.tweepy_dict:
+                    state = self.limits.setdefault((account_name, endpoint),
+                                                   {'remaining': None, 'reset': 0, 'handed': 0})
+                    if state['remaining'] is not None and state['reset'] <= now:
+                        # The window has reset since the last response
+                        state.update({'remaining': None, 'reset': 0, 'handed': 0})
+                    if state['remaining'] is None:
+                        budget = UNKNOWN_BUDGET - state['handed']
+                    else:
+                        budget = state['remaining'] - state['handed']
+                    if budget <= 0:
+                        first_reset = state['reset'] if first_reset is None else min(first_reset, state['reset'])
+                        continue
+                    if best_budget is None or budget > best_budget:
+                        best_name, best_budget = account_name, budget
+                if best_name is not None:
+                    self.limits[(best_name, endpoint)]['handed'] += 1
+                    return best_name, self.tweepy_dict[best_name]
+            sleep_time = max(first_reset - time.time(), 0) + 1
+            logging.info(f"""All {len(self)} keys are out of calls for {endpoint}. Sleeping for {sleep_time:.0f}s""")
+            METRICS.add_sleep('pool', endpoint, sleep_time, 'pool')
+            time.sleep(sleep_time)
+
+
 def dt_str():
     """
     Return datetime string
@@ -0,0 +1,97 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: On-disk cache of GET responses keyed by URL, used by `1_scrape_pf_links.py` for fact-check articles.
+
+Articles almost never change after they are published, so a response younger than `max_age_days` is served from disk
+with no request at all. An older one is revalidated with its ETag / Last-Modified, and a 304 only refreshes its
+timestamp. Bodies are stored zlib-compressed in SQLite.
+"""
+
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class HTTPCache:
+    """
+    SQLite-backed response cache, safe to share across threads.
+
+    Args:
+        fn: Path of the SQLite file, created if missing
+        max_age_days: Responses older than this are revalidated before use. None means they never are.
+    """
+
+    def __init__(self, fn, max_age_days=None):
+        self.fn = fn
+        self.max_age_days = max_age_days
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fn, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                url TEXT PRIMARY KEY,
+                                fetched_at REAL NOT NULL,
+                                etag TEXT,
+                                last_modified TEXT,
+                                body BLOB NOT NULL)""")
+        self.conn.commit()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def __contains__(self, url):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM responses WHERE url = ?", (url,)).fetchone() is not None
+
+    def get(self, session, url, limiter=None, timeout=60):
+        """
+        Text of `url`, from disk if we have a fresh copy
+
+        Args:
+            session: requests Session (or the requests module) for any request we make
+            url: Url to get
+            limiter: Optional object with a `wait()` method, called before a request but not for cache hits
+            timeout: Request timeout in seconds
+        Returns:
+            Response body as text
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT fetched_at, etag, last_modified, body FROM responses WHERE url = ?",
+                                    (url,)).fetchone()
+        if row is not None:
+            fetched_at, etag, last_modified, body = row
+            if self.max_age_days is None or time.time() - fetched_at < self.max_age_days * 86400:
+                with self.lock:
+                    self.hits += 1
+                return zlib.decompress(body).decode("utf-8")
+
+        headers = {}
+        if row is not None and etag:
+            headers['If-None-Match'] = etag
+        if row is not None and last_modified:
+            headers['If-Modified-Since'] = last_modified
+        if limiter:
+            limiter.wait()
+        response = session.get(url, headers=headers, timeout=timeout)
+
+        if response.status_code == 304 and row is not None:
+            with self.lock:
+                self.conn.execute("UPDATE responses SET fetched_at = ? WHERE url = ?", (time.time(), url))
+                self.conn.commit()
+                self.revalidated += 1
+            return zlib.decompress(body).decode("utf-8")
+
+        response.raise_for_status()
+        text = response.text
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                              (url, time.time(), response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                               zlib.compress(text.encode("utf-8"))))
+            self.conn.commit()
+            self.misses += 1
+        return text
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
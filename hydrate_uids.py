@@ -6,7 +6,11 @@ Description: This script takes a list of Twitter user IDs and returns a list of
 about the users. It uses multiple Twitter API accounts to speed up the process.  The script will automatically retry
 failed requests.
 
-usage: hydrate_uids.py [-h] -input_fn INPUT_FN -creds_fn CREDS_FN [-prefix PREFIX] [-start_idx START_IDX] [-end_idx END_IDX] [-pandas_column PANDAS_COLUMN] [--debug]
+Ids are split into batches of 100 on a shared queue that one worker per account pulls from. Finished batches are
+written to `{output_fn}_done.txt`, and `-resume {output_fn}` continues an interrupted run from there. Per-key API
+metrics (see `api_metrics.py`) go to `{output_fn}_api_metrics.json`.
+
+usage: hydrate_uids.py [-h] -input_fn INPUT_FN -creds_fn CREDS_FN [-prefix PREFIX] [-start_idx START_IDX] [-end_idx END_IDX] [-pandas_column PANDAS_COLUMN] [--debug] [-resume RESUME] [-cache_fn CACHE_FN] [-cache_ttl_days CACHE_TTL_DAYS]
 
 optional arguments:
   -h, --help            show this help message and exit
@@ -23,60 +27,202 @@ optional arguments:
   -pandas_column PANDAS_COLUMN, -pc PANDAS_COLUMN
                         Read id column from a Pandas dataframe
   --debug, -d           Change end_idx to 1
+  -resume RESUME, -r RESUME
+                        Output filename (without extension) of an interrupted run to continue, skipping its finished batches
+  -cache_fn CACHE_FN, -cf CACHE_FN
+                        Profile cache, empty string to disable. 7_select_panel_followers.py can use the same file but keeps its own rows
+  -cache_ttl_days CACHE_TTL_DAYS, -ct CACHE_TTL_DAYS
+                        Re-hydrate cached profiles older than this many days
 
 """
 
 import argparse
 import csv
 import logging
-import math
 import os
+import queue
 import threading
+import time
 
 import pandas as pd
+import tweepy
+
+from api_metrics import METRICS
+from helpers import dt_str, exception2value, return_api_dict, TokenPool
+from profile_cache import ProfileCache
+
+LOOKUP_ENDPOINT = '/1.1/users/lookup.json'
+
+
+FIELDNAMES = ['user_id',
+              'username',
+              'follower_count',
+              'following_count',
+              'tweet_count',
+              'account_created',
+              'last_tweet_date',
+              'name',
+              'lang',
+              'last_tweet_id']
+
+
+# Requeue a failed batch this many times before splitting it in half
+MAX_REQUEUES = 4
 
-from helpers import dt_str, return_api_dict
+# Errors that depend on the ids sent, so splitting the batch can isolate them. Anything else (5xx, 429, auth, network)
+# fails the same for any batch, so it is only requeued, up to `MAX_TRANSIENT_REQUEUES` times.
+PAYLOAD_ERRORS = (tweepy.BadRequest, tweepy.NotFound)
+MAX_TRANSIENT_REQUEUES = 10
 
+# Backoff before retrying a failed batch, doubling with each failure
+BACKOFF_SECS = 5
+MAX_BACKOFF_SECS = 300
 
-def hydrate_user_chunks(api, account_name, user_ids, output_fn):
+
+class BatchLog:
+    """
+    Append-only record of finished batches, keyed by the first id of each batch, so a restart can skip them.
+
+    A batch that gets split on failure only counts as finished once all of its parts are, so a crash mid-bisection
+    re-runs the whole batch. Also keeps counts of calls spent and ids recovered on the failure path.
     """
-    Hydrate a list of Twitter user IDs and write the results to a CSV file.
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(fn):
+            with open(fn) as f:
+                self.done = set(x.strip() for x in f if x.strip())
+        self.f = open(fn, "a")
+        self.parts = {}
+        self.stats = dict.fromkeys(['calls', 'failed_calls', 'requeues', 'splits', 'retry_calls', 'ids_recovered',
+                                    'ids_failed'], 0)
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def count(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                self.stats[k] += v
+
+    def split(self, key):
+        """One part of `key` became two"""
+        with self.lock:
+            self.parts[key] = self.parts.get(key, 1) + 1
+
+    def finish(self, key):
+        """One part of `key` is written, record the batch once all of its parts are"""
+        with self.lock:
+            self.parts[key] = self.parts.get(key, 1) - 1
+            if self.parts[key] > 0:
+                return
+            del self.parts[key]
+            self.f.write(f"""{key}\n""")
+            self.f.flush()
+            self.done.add(key)
+
+    def close(self):
+        self.f.close()
+
+
+def hydrate_worker(pool, account_name, batch_queue, batch_log, output_fn, cache=None):
+    """
+    Pulls 100-id batches off a shared queue until it is empty and writes the results to a CSV file.
+
+    Every worker pulls from the same queue, so a slow or throttled worker just takes fewer batches instead of
+    holding up a fixed slice. Each batch is sent with whichever key in the pool has calls left, and recorded in
+    `batch_log` once its rows are written.
+
+    A failed batch goes back on the queue with exponential backoff. If the error depends on the ids sent
+    (`PAYLOAD_ERRORS`), after `MAX_REQUEUES` failures it is split in half, and halves are split again on their next
+    failure, with the same backoff, until single ids that still fail are written out with an error code
+    `-99_{api code}` in every field but `user_id`. Other errors are never split on. The batch is requeued until
+    `MAX_TRANSIENT_REQUEUES` failures and then all of its ids are written out with the error code. So no ids are
+    dropped, and `-resume` only retries those.
+
+    With a cache, ids hydrated recently (by this script or an earlier run) are read from it and only the rest of a
+    batch is sent to the API.
 
     Args:
-        api: A Twitter API object.
-        account_name: The name of the Twitter account associated with the API object.
-        user_ids: A list of Twitter user IDs.
-        output_fn: The name of the output file.
+        pool: A TokenPool of API keys.
+        account_name: The name of the Twitter account this worker is named after.
+        batch_queue: A queue.PriorityQueue of (not_before, seq, key, ids, n_failures) items.
+        batch_log: A BatchLog of finished batches.
+        output_fn: The name of the output file. Appended to if it exists.
+        cache: Optional ProfileCache of v1 rows.
 
     Returns:
         None
     """
     counter = 0
-    chunks = chunk_list_size_n(user_ids, 100)
-    chunks = [x for x in chunks]
-    len_chunks = len(chunks)
-
-    with open(f"""{output_fn}.csv""", "w") as f:
-        fieldnames = ['user_id',
-                      'username',
-                      'follower_count',
-                      'following_count',
-                      'tweet_count',
-                      'account_created',
-                      'last_tweet_date',
-                      'name',
-                      'lang',
-                      'last_tweet_id']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-
-        for chunk in chunks:
-            logging.info(f"""Parsing {counter} of {len_chunks} with {account_name}""")
-            chunk_processed = process_chunk(api['api'], chunk)
-            if chunk_processed:
-                for p in chunk_processed:
-                    writer.writerow(p)
+    fn = f"""{output_fn}.csv"""
+    write_header = not os.path.exists(fn) or os.path.getsize(fn) == 0
+
+    with open(fn, "a") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        if write_header:
+            writer.writeheader()
+
+        while True:
+            try:
+                not_before, seq, key, chunk, n_failures = batch_queue.get_nowait()
+            except queue.Empty:
+                break
+            wait = not_before - time.time()
+            if wait > 0:
+                METRICS.add_sleep(account_name, LOOKUP_ENDPOINT, wait, 'backoff')
+                time.sleep(wait)
+            cached = cache.get_many(chunk) if cache else {}
+            to_fetch = [x for x in chunk if x not in cached]
+            try:
+                chunk_processed = [cached[x] for x in chunk if x in cached]
+                if to_fetch:
+                    key_name, connections = pool.acquire(LOOKUP_ENDPOINT)
+                    logging.info(f"""Parsing batch {counter} for {account_name} with {key_name}, {len(cached)} cached, ~{batch_queue.qsize()} left""")
+                    batch_log.count(calls=1, retry_calls=int(n_failures > 0))
+                    fetched = process_chunk(connections['api'], to_fetch, max_attempts=1)
+                    if cache:
+                        # Parse errors (-1) are not worth keeping
+                        cache.put_many({p['user_id']: p for p in fetched if p['username'] != -1})
+                    chunk_processed.extend(fetched)
+            except Exception as e:
+                batch_log.count(failed_calls=1)
+                n_failures += 1
+                backoff = min(BACKOFF_SECS * 2 ** (n_failures - 1), MAX_BACKOFF_SECS)
+                payload_error = isinstance(e, PAYLOAD_ERRORS)
+                if n_failures < (MAX_REQUEUES if payload_error else MAX_TRANSIENT_REQUEUES):
+                    logging.info(f"""Requeueing {len(chunk)} ids after failure {n_failures} in {backoff}s: {e}""")
+                    batch_log.count(requeues=1)
+                    batch_queue.put((time.time() + backoff, seq, key, chunk, n_failures))
+                elif payload_error and len(chunk) > 1:
+                    logging.info(f"""Splitting {len(chunk)} ids after failure {n_failures} in {backoff}s: {e}""")
+                    batch_log.count(splits=1)
+                    batch_log.split(key)
+                    half = len(chunk) // 2
+                    batch_queue.put((time.time() + backoff, seq, key, chunk[:half], MAX_REQUEUES - 1))
+                    batch_queue.put((time.time() + backoff, seq, key, chunk[half:], MAX_REQUEUES - 1))
+                else:
+                    logging.info(f"""Giving up on {len(chunk)} ids starting with {chunk[0]}: {e}""")
+                    batch_log.count(ids_failed=len(chunk))
+                    for uid in chunk:
+                        t_dict = dict.fromkeys(FIELDNAMES, exception2value(e, "-99"))
+                        t_dict['user_id'] = str(uid)
+                        writer.writerow(t_dict)
+                    f.flush()
+                    batch_log.finish(key)
+                counter += 1
+                continue
+
+            for p in chunk_processed:
+                writer.writerow(p)
+            f.flush()
+            if n_failures:
+                batch_log.count(ids_recovered=len(chunk))
+            batch_log.finish(key)
             counter += 1
+    logging.info(f"""{account_name} finished {counter} batches""")
 
 
 def process_chunk(api: object, chunk: list, max_attempts=4) -> list:
@@ -91,9 +237,12 @@ def process_chunk(api: object, chunk: list, max_attempts=4) -> list:
         A list of dictionaries containing information about the users in the chunk. If a user ID in the chunk is not returned by the 'lookup_users'
         method of the 'api' object, a dictionary with the 'user_id' set to the ID and all other values
         set to -9 is appended to the list.
+
+    Raises:
+        The last error if all `max_attempts` attempts fail.
     """
     attempts = 0
-    while attempts < max_attempts:
+    while True:
         try:
             hydrated = api.lookup_users(user_id=chunk)
             processed = [process_user(x) for x in hydrated]
@@ -102,24 +251,30 @@ def process_chunk(api: object, chunk: list, max_attempts=4) -> list:
             not_pulled_uids = input_uids - pulled_uids
             if not_pulled_uids:
                 for uid in not_pulled_uids:
-                    keys = ['user_id',
-                            'username',
-                            'follower_count',
-                            'following_count',
-                            'tweet_count',
-                            'account_created',
-                            'last_tweet_date',
-                            'name',
-                            'lang',
-                            'last_tweet_id']
-                    t_dict = dict.fromkeys(keys, -9)
+                    t_dict = dict.fromkeys(FIELDNAMES, -9)
                     t_dict['user_id'] = str(uid)
                     processed.append(t_dict)
             return processed
         except Exception as e:
             logging.info("Ran into an error: {} and trying {} out of {} times".format(e, attempts, max_attempts))
             attempts += 1
-            continue
+            if attempts >= max_attempts:
+                raise
+
+
+def failed_uids(output_fn):
+    """
+    Returns the ids in a run's CSV files that were only ever written with a `-99` error code.
+    """
+    path, prefix = os.path.split(output_fn)
+    files = [os.path.join(path, x) for x in os.listdir(path or ".")
+             if x.startswith(prefix + "_") and x.endswith(".csv") and not x.endswith("_merged.csv")]
+    dfs = [pd.read_csv(x, usecols=['user_id', 'username'], dtype='object') for x in files]
+    if not dfs:
+        return set()
+    df = pd.concat(dfs)
+    is_error = df['username'].fillna('').str.startswith('-99')
+    return set(df.loc[is_error, 'user_id']) - set(df.loc[~is_error, 'user_id'])
 
 
 def process_user(t_user: object) -> dict:
@@ -132,17 +287,7 @@ def process_user(t_user: object) -> dict:
         A dictionary containing information about the user. If an exception occurs during the processing of the user object, the
         function returns a dictionary with all values set to -1.
     """
-    keys = ['user_id',
-            'username',
-            'follower_count',
-            'following_count',
-            'tweet_count',
-            'account_created',
-            'last_tweet_date',
-            'name',
-            'lang',
-            'last_tweet_id']
-    t_dict = dict.fromkeys(keys, -1)
+    t_dict = dict.fromkeys(FIELDNAMES, -1)
     try:
         t_user = t_user._json
         t_dict['user_id'] = t_user['id_str']
@@ -166,17 +311,7 @@ def chunk_list_size_n(mylist, n):
     for i in range(0, len(mylist), n):
         yield mylist[i:i + n]
 
-def chunk_list(lst, k):
-    """Split a list into k chunks.
-    If the list cannot be split evenly, the last chunk will be smaller than the others.
-    """
-    n = len(lst)
-    chunk_size = math.ceil(n / k)
-    chunks = [lst[i:i + chunk_size] for i in range(0, n, chunk_size)]
-    return chunks
-
-
-def main(output_fn, input_fn, creds_fn, start_idx, end_idx, pandas_column):
+def main(output_fn, input_fn, creds_fn, start_idx, end_idx, pandas_column, cache_fn="", cache_ttl_days=30):
 
     if not pandas_column:
         f = open(input_fn)
@@ -193,16 +328,8 @@ def main(output_fn, input_fn, creds_fn, start_idx, end_idx, pandas_column):
     # Load twitter creds
     apis_dict = return_api_dict(creds_fn, auth_type='user')
 
-    # In the normal case the number of ids is >= apis_dict so we break these into chunks
-    if len(input_ids) >= len(apis_dict):
-        chunks = chunk_list(input_ids, len(apis_dict))
-
-    # But if debugging, we may have fewer ids than apis_dict, so we just use the number of ids
-    # and only one API
-    else:
-        first_element_key = list(apis_dict.keys())[0]
-        apis_dict = {first_element_key: apis_dict[first_element_key]}
-        chunks = [input_ids]
+    # Every worker draws from the same pool of keys
+    pool = TokenPool(apis_dict)
 
     # Log data
     logging.basicConfig(
@@ -212,18 +339,44 @@ def main(output_fn, input_fn, creds_fn, start_idx, end_idx, pandas_column):
         datefmt='%Y-%m-%d %H:%M:%S',
     )
 
-    # Create threads
+    metrics_fn = f"""{output_fn}_api_metrics.json"""
+    METRICS.start_snapshots(metrics_fn)
+
+    # Queue up the batches that a previous run with this output_fn did not finish,
+    # plus any ids that it gave up on
+    batch_log = BatchLog(f"""{output_fn}_done.txt""")
+    batch_queue = queue.PriorityQueue()
+    n_skipped = 0
+    for seq, chunk in enumerate(chunk_list_size_n(input_ids, 100)):
+        if chunk[0] in batch_log:
+            n_skipped += 1
+        else:
+            batch_queue.put((0, seq, chunk[0], chunk, 0))
+    retry_ids = sorted(failed_uids(output_fn)) if batch_log.done else []
+    for seq, chunk in enumerate(chunk_list_size_n(retry_ids, 100), start=batch_queue.qsize() + n_skipped):
+        batch_queue.put((0, seq, f"""retry_{chunk[0]}""", chunk, 0))
+    logging.info(f"""Queued {batch_queue.qsize()} batches, skipped {n_skipped} finished batches, retrying {len(retry_ids)} failed ids""")
+
+    cache = ProfileCache(cache_fn, source='v1', ttl_days=cache_ttl_days) if cache_fn else None
+
+    # Create one worker per account, no more workers than batches
     threads = []
-    for i in range(len(chunks)):
-        account_name = list(apis_dict.keys())[i]
-        t = threading.Thread(target=hydrate_user_chunks,
-                             args=(apis_dict[account_name], account_name, chunks[i], output_fn + "_" + account_name))
+    for account_name in list(apis_dict.keys())[:max(min(len(apis_dict), batch_queue.qsize()), 1)]:
+        t = threading.Thread(target=hydrate_worker,
+                             args=(pool, account_name, batch_queue, batch_log, output_fn + "_" + account_name, cache))
         threads.append(t)
         t.start()
 
     # Wait for all threads to finish
     for t in threads:
         t.join()
+    batch_log.close()
+    if cache:
+        logging.info(f"""Profile cache: {cache.hits} hits, {cache.misses} misses""")
+        cache.close()
+    stats = batch_log.stats
+    METRICS.write(metrics_fn)
+    logging.info(f"""Made {stats['calls']} lookup calls, {stats['failed_calls']} failed. Failure path: {stats['requeues']} requeues, {stats['splits']} splits, {stats['retry_calls']} retry calls recovered {stats['ids_recovered']} ids, gave up on {stats['ids_failed']} ids""")
 
     # Get all files in directory
 
@@ -235,13 +388,16 @@ def main(output_fn, input_fn, creds_fn, start_idx, end_idx, pandas_column):
     files = os.listdir(path + "/")
 
     # Filter out files that don't have the desired name pattern
-    desired_files = [file for file in files if suffix in file and file.endswith(".csv")]
+    desired_files = [file for file in files if suffix in file and file.endswith(".csv") and not file.endswith("_merged.csv")]
 
     # Read the csv files into dataframes
     dfs = [pd.read_csv(os.path.join(path, file), dtype={'username':'object', 'user_id':'object', 'last_tweet_id':'object'}) for file in desired_files]
 
-    # Concatenate all the dataframes into one
+    # Concatenate all the dataframes into one, keeping a good row over an error row from an earlier attempt
     merged_df = pd.concat(dfs)
+    merged_df['_is_error'] = merged_df['username'].fillna('').str.startswith('-99')
+    merged_df = merged_df.sort_values(by='_is_error', kind='stable').drop_duplicates(subset=['user_id'])
+    merged_df = merged_df.drop(columns=['_is_error'])
     merged_df.to_csv(output_fn + "_merged" + ".csv")
 
     logging.info("ALL DONE")
@@ -258,6 +414,12 @@ if __name__ == "__main__":
     parser.add_argument('-pandas_column', '-pc', dest="pandas_column", help="Read id column from a Pandas dataframe",
                         default="")
     parser.add_argument('--debug', '-d', dest="debug", help="Change end_idx to 1", action='store_true')
+    parser.add_argument('-resume', '-r', dest="resume", default="",
+                        help="Output filename (without extension) of an interrupted run to continue, skipping its finished batches")
+    parser.add_argument('-cache_fn', '-cf', dest="cache_fn", default="hydrated_profiles.sqlite",
+                        help="Profile cache, empty string to disable. 7_select_panel_followers.py can use the same file but keeps its own rows")
+    parser.add_argument('-cache_ttl_days', '-ct', dest="cache_ttl_days", default=30, type=float,
+                        help="Re-hydrate cached profiles older than this many days")
     args = parser.parse_args()
     # If debug mode only get 1 user
     end_idx = 1 if args.debug else args.end_idx
@@ -265,6 +427,8 @@ if __name__ == "__main__":
 
     prefix_tag = args.prefix + "__" if args.prefix else args.prefix
     output_fn = f"""{prefix_tag}{debug_tag}_{dt_str()}__START{args.start_idx}_END{end_idx}"""
+    output_fn = args.resume if args.resume else output_fn
 
     main(output_fn=output_fn, input_fn=args.input_fn, creds_fn=args.creds_fn,
-         start_idx=args.start_idx, end_idx=end_idx, pandas_column=args.pandas_column)
+         start_idx=args.start_idx, end_idx=end_idx, pandas_column=args.pandas_column,
+         cache_fn=args.cache_fn, cache_ttl_days=args.cache_ttl_days)
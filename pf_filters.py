@@ -0,0 +1,211 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Filters for raw PolitiFact links from `1_scrape_pf_links.py`, used by `2_filter_pf_links.ipynb`.
+
+The notebook used to run `is_twitter`, `is_blog` and `is_valid_category` row by row and re-parse the stringified
+`tags` lists with `ast.literal_eval` on every load. Here the flags are one regex pass over `raw_desc`, tags are parsed
+once and saved as a native list column in parquet, and the date, truth value, category and twitter/blog filters are
+one boolean mask. `write_filtered` writes the same csv files as the notebook, with tags as Python list literals.
+`check_pf_filters.py` compares them with the notebook's code.
+
+Usage:
+    # Parse the tags of a scrape once into parquet
+    python pf_filters.py -i raw_pf_links_2023-12-22__10_31_08.csv --save_parquet raw_pf_links.parquet
+    # Filter it, writing raw_filtered_tweets.csv and to_annotate_filtered_tweets.csv like the notebook
+    python pf_filters.py -i raw_pf_links.parquet -o filtered_tweets.csv
+"""
+
+import argparse
+import ast
+import logging
+import re
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+START_DATE = '2021-06-01'
+END_DATE = '2023-12-21'
+
+CATEGORIES = ['abortion', 'autism', 'coronavirus', 'drugs', 'disability', 'health-care', 'health-check', 'public-health']
+TRUTH_VALUES = ['pants-fire', 'false', 'mostly-false']
+
+# Substrings of the lowercased description. "en x" catches Spanish "publicación en X".
+TWITTER_TERMS = ["twitter", "tweet", "post on x", "x-post", "x post", "en x"]
+BLOG_TERMS = ["in a blog", "bloggers"]
+TWITTER_PATTERN = "|".join(re.escape(term) for term in TWITTER_TERMS)
+BLOG_PATTERN = "|".join(re.escape(term) for term in BLOG_TERMS)
+_TWITTER_RE = re.compile(TWITTER_PATTERN)
+
+
+def is_twitter(desc):
+    """
+    1 if a single description mentions Twitter / X, else 0 (NaN if it is not a string). Used by the scraper per row.
+    """
+    try:
+        return int(_TWITTER_RE.search(desc.lower()) is not None)
+    except AttributeError:
+        return np.nan
+
+
+def contains_any(texts, pattern):
+    """
+    Vectorized substring flags
+
+    Args:
+        texts: Series of strings
+        pattern: Regex alternation of lowercase terms, e.g. `TWITTER_PATTERN`
+    Returns:
+        Series, 1 where the lowercased text contains a term. Missing text is NaN, like `is_twitter` and the notebook's
+        flags, so the Series is float if any text is missing and int8 otherwise.
+    """
+    flags = texts.str.lower().str.contains(pattern, regex=True, na=False).astype('int8')
+    missing = texts.isna()
+    if missing.any():
+        return flags.astype('float64').mask(missing)
+    return flags
+
+
+def parse_tags(tags):
+    """
+    Parses stringified tag lists from a csv, once. Values that are not lists become None.
+    """
+    def parse(x):
+        if isinstance(x, str):
+            try:
+                x = ast.literal_eval(x)
+            except (ValueError, SyntaxError):
+                return None
+        return list(x) if isinstance(x, (list, tuple, np.ndarray)) else None
+    return tags.map(parse)
+
+
+def save_links(df, fn):
+    """
+    Saves scraped links to parquet with tags as a list<string> column, dates as timestamps and the truth value and
+    type as categoricals, so loading never re-parses anything
+    """
+    df = df.copy()
+    if 'tags' in df and not isinstance(df['tags'].dtype, pd.ArrowDtype):
+        df['tags'] = parse_tags(df['tags'])
+    df['date'] = pd.to_datetime(df['date'], errors='coerce')
+    for col in ['truth_value', 'type']:
+        if col in df:
+            df[col] = df[col].astype('category')
+    df.to_parquet(fn, index=False)
+    logging.info(f"""Saved {len(df)} links to {fn}""")
+
+
+def load_links(fn):
+    """
+    Loads scraped links from parquet (see `save_links`) or from a scraper csv
+
+    Returns:
+        Dataframe with `date` as datetime and `tags` as an Arrow list column
+    """
+    if fn.endswith(".parquet"):
+        df = pq.read_table(fn).to_pandas(types_mapper=lambda t: pd.ArrowDtype(t) if pa.types.is_list(t) else None)
+    else:
+        df = pd.read_csv(fn)
+        df['date'] = pd.to_datetime(df['date'], errors='coerce')
+        if 'tags' in df:
+            df['tags'] = pd.Series(pa.array(parse_tags(df['tags']), type=pa.list_(pa.string())),
+                                   index=df.index, dtype=pd.ArrowDtype(pa.list_(pa.string())))
+    return df
+
+
+def category_mask(tags, categories=CATEGORIES):
+    """
+    Whether any tag of each row, lowercased, is in `categories`
+
+    Args:
+        tags: Series of tag lists, Arrow-backed (fast) or of Python lists
+        categories: Lowercase categories to keep
+    Returns:
+        Boolean numpy array aligned with `tags`
+    """
+    arr = pa.array(tags, type=pa.list_(pa.string()), from_pandas=True)
+    flat = pc.list_flatten(arr)
+    hit = pc.is_in(pc.utf8_lower(flat), value_set=pa.array(categories, type=pa.string()))
+    parents = pc.list_parent_indices(arr).to_numpy()
+    return np.bincount(parents[hit.to_numpy(zero_copy_only=False)], minlength=len(arr)) > 0
+
+
+def add_flags(df):
+    """
+    Adds the notebook's is_twitter, is_blog_desc, is_blog_cat and is_blog columns
+    """
+    df['is_twitter'] = contains_any(df['raw_desc'], TWITTER_PATTERN)
+    df['is_blog_desc'] = contains_any(df['raw_desc'], BLOG_PATTERN)
+    df['is_blog_cat'] = (df['type'] == "Bloggers").astype('int8')
+    df['is_blog'] = np.maximum(df['is_blog_desc'], df['is_blog_cat'])
+    return df
+
+
+def filter_mask(df, start_date=START_DATE, end_date=END_DATE, truth_values=TRUTH_VALUES, categories=CATEGORIES):
+    """
+    One boolean mask for the date range (inclusive), truth value, category and twitter/blog filters
+
+    Args:
+        df: Links with flags, see `add_flags`
+    Returns:
+        Boolean numpy array aligned with `df`
+    """
+    dates = df['date']
+    return np.logical_and.reduce([((dates >= start_date) & (dates <= end_date)).to_numpy(),
+                                  df['truth_value'].isin(truth_values).to_numpy(),
+                                  ((df['is_twitter'] == 1) | (df['is_blog'] == 1)).to_numpy(),
+                                  category_mask(df['tags'], categories)])
+
+
+def filter_links(df, **kwargs):
+    """
+    Flags and filters links like step 2, keeping the original index
+
+    Args:
+        df: Links from `load_links`
+        kwargs: Passed to `filter_mask`
+    Returns:
+        Filtered copy of `df`
+    """
+    df = add_flags(df.copy())
+    return df[filter_mask(df, **kwargs)]
+
+
+def write_filtered(filtered_df, output_fn):
+    """
+    Writes `raw_{output_fn}` and `to_annotate_{output_fn}` like the notebook
+
+    An Arrow list column would be written as the numpy repr `['a' 'b']`, which `ast.literal_eval` silently reads as
+    `['ab']`, so tags are written as Python list literals like the notebook's files (and `annotated_filtered_tweets.csv`)
+    """
+    filtered_df = filtered_df.copy()
+    if 'tags' in filtered_df:
+        filtered_df['tags'] = pd.Series([list(x) if isinstance(x, (list, tuple, np.ndarray)) else None
+                                         for x in filtered_df['tags']], index=filtered_df.index, dtype=object)
+    filtered_df.to_csv(f"raw_{output_fn}")
+    for col in ['annotated_column', 'raw_url', 'twitter_handle', 'n_followers']:
+        filtered_df[col] = ''
+    filtered_df.to_csv(f"to_annotate_{output_fn}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-input_fn", "-i", help="Scraper csv or parquet from --save_parquet", required=True)
+    parser.add_argument("-output_fn", "-o", help="Writes raw_{output_fn} and to_annotate_{output_fn}", default=None)
+    parser.add_argument("--save_parquet", help="Save the links to this parquet file first", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    df = load_links(args.input_fn)
+    if args.save_parquet:
+        save_links(df, args.save_parquet)
+    start = time.perf_counter()
+    filtered_df = filter_links(df)
+    logging.info(f"""Kept {len(filtered_df)} of {len(df)} links in {1000 * (time.perf_counter() - start):.1f} ms""")
+    if args.output_fn:
+        write_filtered(filtered_df, args.output_fn)
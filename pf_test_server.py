@@ -0,0 +1,216 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Local stand-in for the PolitiFact pages `1_scrape_pf_links.py` visits, so the scraper can be run and
+checked offline. `check_pf_scraper.py` runs it from a thread.
+
+Pages:
+- `/factchecks/list/?page=N`: listing page N. With `pages_dir` these are the saved `page_{N}.html` files (as saved by
+  `bench_pf_parsing.py --fetch`), otherwise synthetic pages of `per_page` fact-checks in PolitiFact's markup, one
+  day apart every 7 items. Pages past the last one have no items, like the real site.
+- Any other path is an article with 1 to 4 `c-tag` tags and an ETag, answering `If-None-Match` with a 304
+- `/stats`: requests by kind ('list', 'article', 'article_304', 'error') as JSON
+
+`fail_pages` listing pages always get a 503, `bad_pages` listing pages have an item the scraper can't parse, and a
+share `missing_rate` of article paths get a 404, to exercise the scraper's failure paths. Every request waits `latency` seconds.
+
+Usage:
+    python pf_test_server.py --port 8765
+    python pf_test_server.py --pages_dir pf_pages --latency 0.2
+    python 1_scrape_pf_links.py --base_url http://127.0.0.1:8765 --earliest_date 2024-01-01 --workers 4
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+DESCS = ["stated on {d} in a post on X:", "stated on {d} in a tweet:", "stated on {d} in a blog post:",
+         "stated on {d} in a Facebook post:", "stated on {d} in an Instagram post:", "said on {d} in an interview:"]
+TRUTH_VALUES = ["false", "pants-fire", "barely-true", "half-true", "true", "mostly-true"]
+NAMES = ["Viral image", "Joe & Co", "Facebook posts"]
+
+
+def listing_item(i, start):
+    """
+    Html of synthetic fact-check `i`, dated one day earlier than `start` every 7 items
+    """
+    d = start - timedelta(days=i // 7)
+    date_str = f"""{d.strftime('%B')} {d.day}, {d.year}"""
+    slug = f"""/factchecks/{d.year}/{d.strftime('%b').lower()}/{d.day:02d}/claim-{i}/"""
+    name = NAMES[i % len(NAMES)]
+    return (f"""<li class="o-listicle__item"><article class="m-statement m-statement--is-medium">"""
+            f"""<div class="m-statement__author"><a class="m-statement__name" href="/personalities/p{i}/" """
+            f"""title="{name}">\n {name}\n</a>"""
+            f"""<div class="m-statement__desc">\n  {DESCS[i % len(DESCS)].format(d=date_str)}\n</div></div>"""
+            f"""<div class="m-statement__content"><div class="m-statement__body"><div class="m-statement__quote">"""
+            f"""\n<a href="{slug}">\nClaim number {i} &amp; “quoted”\n</a>\n</div>"""
+            f"""<div class="m-statement__meter"><div class="c-image"><img src="x.jpg" class="c-image__thumb" """
+            f"""alt="{TRUTH_VALUES[i % len(TRUTH_VALUES)]}"/></div></div>"""
+            f"""<footer class="m-statement__footer">\n By Author {i % 5} • {date_str}\n</footer>"""
+            f"""</div></div></article></li>\n""")
+
+
+def listing_page(items):
+    return (f"""<html><head><title>Fact-checks</title></head><body><nav>menu</nav><section class="o-listicle">"""
+            f"""<ul class="o-listicle__list">{items}</ul></section><footer>site</footer></body></html>""")
+
+
+def article_page(path):
+    """
+    Html of the article at `path`, with 1 to 4 tags that depend only on the path
+    """
+    n_tags = zlib.crc32(path.encode()) % 4 + 1
+    tags = "".join(f"""<li class="m-list__item"><a href="/t{t}/" class="c-tag" title="T{t}"><span>\nTag {t}\n"""
+                   f"""</span></a></li>""" for t in range(n_tags))
+    return f"""<html><body><article>{"x" * 20000}<ul class="m-list">{tags}</ul></article></body></html>"""
+
+
+class PFTestServer:
+    """
+    The stand-in site behind a ThreadingHTTPServer
+
+    Args:
+        pages_dir: Optional directory of saved `page_{N}.html` listing pages, otherwise pages are synthetic
+        n_pages: Synthetic listing pages with items
+        per_page: Items per synthetic listing page
+        start: Date of the newest synthetic fact-check
+        latency: Seconds every request waits before it is answered
+        fail_pages: Listing pages that always get a 503
+        missing_rate: Share of article paths that get a 404
+        bad_pages: Listing pages whose first item has no date
+    """
+
+    def __init__(self, pages_dir=None, n_pages=60, per_page=30, start=date(2024, 4, 1), latency=0.0, fail_pages=(),
+                 missing_rate=0.0, bad_pages=()):
+        self.pages_dir = pages_dir
+        self.n_pages = n_pages
+        self.per_page = per_page
+        self.start_date = start
+        self.latency = latency
+        self.fail_pages = set(fail_pages)
+        self.missing_rate = missing_rate
+        self.bad_pages = set(bad_pages)
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(['list', 'article', 'article_304', 'error'], 0)
+        self.server = None
+
+    def _count(self, kind):
+        with self.lock:
+            self.stats[kind] += 1
+
+    def listing(self, page):
+        """
+        Html of listing page `page`
+        """
+        if self.pages_dir:
+            fn = os.path.join(self.pages_dir, f"""page_{page}.html""")
+            if not os.path.exists(fn):
+                return listing_page("")
+            with open(fn, encoding="utf-8") as f:
+                return f.read()
+        if page > self.n_pages:
+            return listing_page("")
+        items = "".join(listing_item(i, self.start_date) for i in range((page - 1) * self.per_page, page * self.per_page))
+        if page in self.bad_pages:
+            items = items.replace(" • ", " ", 1)
+        return listing_page(items)
+
+    def is_missing(self, path):
+        return zlib.crc32(path.encode()) % 10000 < self.missing_rate * 10000
+
+    def handle(self, path, query, headers):
+        """
+        Answers one GET
+
+        Returns:
+            (status, body as text, response headers)
+        """
+        if path == '/stats':
+            with self.lock:
+                return 200, json.dumps(self.stats), {'Content-Type': 'application/json'}
+        if path == '/factchecks/list/':
+            page = int(query.get('page', ['1'])[0])
+            if page in self.fail_pages:
+                self._count('error')
+                return 503, "Service Unavailable", {}
+            self._count('list')
+            return 200, self.listing(page), {'Content-Type': 'text/html; charset=utf-8'}
+        if self.is_missing(path):
+            self._count('error')
+            return 404, "Not Found", {}
+        body = article_page(path)
+        etag = f'''"{hashlib.md5(body.encode()).hexdigest()}"'''
+        if headers.get('If-None-Match') == etag:
+            self._count('article_304')
+            return 304, "", {'ETag': etag}
+        self._count('article')
+        return 200, body, {'ETag': etag, 'Content-Type': 'text/html; charset=utf-8'}
+
+    def make_handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(site.latency)
+                url = urlsplit(self.path)
+                status, body, headers = site.handle(url.path, parse_qs(url.query), self.headers)
+                data = body.encode("utf-8")
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def serve(self, host='127.0.0.1', port=8765):
+        """
+        Serves forever on `host:port`
+        """
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.server.serve_forever()
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Serves from a background thread
+
+        Returns:
+            Base url of the server, e.g. http://127.0.0.1:8765
+        """
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"""http://{host}:{self.server.server_address[1]}"""
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="Host to bind")
+    parser.add_argument("--port", type=int, default=8765, help="Port to serve on (defaults to 8765)")
+    parser.add_argument("--pages_dir", default=None, help="Directory of saved page_{N}.html listing pages")
+    parser.add_argument("--n_pages", type=int, default=60, help="Synthetic listing pages (defaults to 60)")
+    parser.add_argument("--per_page", type=int, default=30, help="Items per synthetic listing page (defaults to 30)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per request")
+    parser.add_argument("--fail_pages", type=int, nargs="*", default=[], help="Listing pages that always get a 503")
+    parser.add_argument("--missing_rate", type=float, default=0.0, help="Share of articles that get a 404")
+    parser.add_argument("--bad_pages", type=int, nargs="*", default=[], help="Listing pages with an unparsable item")
+    args = parser.parse_args()
+    print(f"""PolitiFact test server on http://{args.host}:{args.port}""", flush=True)
+    PFTestServer(args.pages_dir, args.n_pages, args.per_page, latency=args.latency, fail_pages=args.fail_pages,
+                 missing_rate=args.missing_rate, bad_pages=args.bad_pages).serve(args.host, args.port)
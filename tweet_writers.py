@@ -0,0 +1,402 @@
+"""
+Author: Joshua Ashkinaze
+
+Description: Output backends for `get_tweet_data.py`, picked with `--output_format`.
+
+- 'jsonl' (the default) writes `{fn}_raw.jsonl` and `{fn}_processed.jsonl`, one JSON line per user, as before.
+- 'parquet' writes the processed tweets to `{fn}_processed.parquet` with one row per tweet and one row group per
+  (spreader, condition) block. `public_metrics` becomes one column per count, and the urls and `referenced_tweets`
+  become list columns, so analyses read only the columns they need and never parse JSON. Tweet fields without a
+  column of their own (entities, attachments, ...) are kept as a JSON string in `other_json`. The raw records go to
+  `{fn}_raw.jsonl.zst`, the same JSON lines in a zstd stream.
+- 'entities' splits the raw records into deduplicated tables of primary tweets, referenced tweets and users keyed by
+  id, plus `{fn}_records.parquet` with only the ids per user, see `EntityWriter`. `EntityStore` loads them with
+  dict lookups by tweet, user or author id and rebuilds any raw record.
+
+A user with no tweets (-9) or an error (-1) gets one row with that `status` and no tweet fields. Tweets have status
+0, or -1 if `parse_tweet` failed on them.
+
+Usage:
+    # Convert files from an earlier run
+    python tweet_writers.py --raw_fn pre_raw.jsonl --processed_fn pre_processed.jsonl --out pre \\
+        --success_fn pre_40_success.csv
+    # Or into the deduplicated entity tables
+    python tweet_writers.py --raw_fn pre_raw.jsonl --processed_fn pre_processed.jsonl --out pre \\
+        --output_format entities --success_fn pre_40_success.csv
+"""
+
+import argparse
+import io
+import json
+import logging
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+METRICS = ['retweet_count', 'reply_count', 'like_count', 'quote_count', 'bookmark_count', 'impression_count']
+
+TWEET_SCHEMA = pa.schema(
+    [('original_user_id', pa.string()), ('spreader_username', pa.string()), ('condition', pa.string()),
+     ('status', pa.int8()),
+     ('id', pa.string()), ('author_id', pa.string()), ('conversation_id', pa.string()),
+     ('created_at', pa.timestamp('ms', tz='UTC')), ('text', pa.string()), ('lang', pa.string()),
+     ('in_reply_to_user_id', pa.string()), ('reply_settings', pa.string()), ('source', pa.string())]
+    + [(m, pa.int64()) for m in METRICS]
+    + [('primary_urls', pa.list_(pa.string())), ('refd_urls', pa.list_(pa.string())),
+       ('all_urls', pa.list_(pa.string())),
+       ('ref_types', pa.list_(pa.string())), ('ref_ids', pa.list_(pa.string())),
+       ('ref_author_ids', pa.list_(pa.string())), ('ref_author_usernames', pa.list_(pa.string())),
+       ('ref_urls', pa.list_(pa.list_(pa.string()))),
+       ('other_json', pa.string())])
+
+_COLUMNS = {'id', 'author_id', 'conversation_id', 'created_at', 'text', 'lang', 'in_reply_to_user_id',
+            'reply_settings', 'source', 'public_metrics', 'primary_urls', 'refd_urls', 'all_urls',
+            'referenced_tweets'}
+
+
+def _parse_time(x):
+    return datetime.fromisoformat(x.replace('Z', '+00:00')) if x else None
+
+
+def flatten_tweet(tweet):
+    """
+    One processed tweet (from `parse_tweet`) as a dict of `TWEET_SCHEMA` tweet columns
+    """
+    metrics = tweet.get('public_metrics') or {}
+    refs = tweet.get('referenced_tweets') or []
+    row = {k: tweet.get(k) for k in ['id', 'author_id', 'conversation_id', 'text', 'lang', 'in_reply_to_user_id',
+                                     'reply_settings', 'source']}
+    row['created_at'] = _parse_time(tweet.get('created_at'))
+    row.update({m: metrics.get(m) for m in METRICS})
+    row.update({k: tweet.get(k, []) for k in ['primary_urls', 'refd_urls', 'all_urls']})
+    row.update({'ref_types': [r.get('type') for r in refs], 'ref_ids': [r.get('id') for r in refs],
+                'ref_author_ids': [r.get('ref_author_id') for r in refs],
+                'ref_author_usernames': [r.get('ref_author_username') for r in refs],
+                'ref_urls': [r.get('urls', []) for r in refs]})
+    other = {k: v for k, v in tweet.items() if k not in _COLUMNS}
+    row['other_json'] = json.dumps(other) if other else None
+    return row
+
+
+def processed_rows(processed, block=None):
+    """
+    Rows of `TWEET_SCHEMA` for one processed record of `get_tweet_data.process_tweets`
+
+    Args:
+        processed: Dict with `original_user_id` and `processed`, a list of tweets or -1 / -9
+        block: Optional (spreader_username, condition) of the user
+    """
+    spreader_username, condition = block if block else (None, None)
+    base = {'original_user_id': str(processed['original_user_id']), 'spreader_username': spreader_username,
+            'condition': condition}
+    tweets = processed['processed']
+    if not isinstance(tweets, list):
+        return [dict(base, status=tweets)]
+    rows = []
+    for tweet in tweets:
+        if isinstance(tweet, dict):
+            rows.append(dict(base, status=0, **flatten_tweet(tweet)))
+        else:
+            rows.append(dict(base, status=-1))
+    return rows
+
+
+class TweetWriter:
+    """
+    Base class of the output backends. `write` is called once per user, in order, and `close` once at the end.
+    """
+
+    def write(self, raw, processed, block=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JSONLWriter(TweetWriter):
+    """
+    The original `{fn}_raw.jsonl` and `{fn}_processed.jsonl` files
+    """
+
+    def __init__(self, fn):
+        self.raw_file = open(f"""{fn}_raw.jsonl""", "w")
+        self.processed_file = open(f"""{fn}_processed.jsonl""", "w")
+
+    def write(self, raw, processed, block=None):
+        self.raw_file.write(json.dumps(raw) + "\n")
+        self.processed_file.write(json.dumps(processed) + "\n")
+
+    def close(self):
+        self.raw_file.close()
+        self.processed_file.close()
+
+
+class ZstdJSONLStream:
+    """
+    Writes JSON lines to a zstd-compressed file
+    """
+
+    def __init__(self, fn):
+        self.stream = pa.CompressedOutputStream(fn, 'zstd')
+
+    def write(self, record):
+        self.stream.write((json.dumps(record) + "\n").encode("utf-8"))
+
+    def close(self):
+        self.stream.close()
+
+
+def read_zstd_jsonl(fn):
+    """
+    Yields the records of a `.jsonl.zst` file
+    """
+    with io.TextIOWrapper(io.BufferedReader(pa.input_stream(fn, compression='zstd')), encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class ParquetWriter(TweetWriter):
+    """
+    Processed tweets to `{fn}_processed.parquet`, one row group per block, and raw records to `{fn}_raw.jsonl.zst`
+
+    Args:
+        fn: Output prefix
+        rows_per_group: Without blocks, rows per row group
+    """
+
+    def __init__(self, fn, rows_per_group=100000):
+        self.processed_fn = f"""{fn}_processed.parquet"""
+        self.raw = ZstdJSONLStream(f"""{fn}_raw.jsonl.zst""")
+        self.writer = pq.ParquetWriter(self.processed_fn, TWEET_SCHEMA, compression='zstd')
+        self.rows_per_group = rows_per_group
+        self.rows = []
+        self.block = None
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=TWEET_SCHEMA),
+                                    row_group_size=len(self.rows))
+            self.rows = []
+
+    def write(self, raw, processed, block=None):
+        if block != self.block or len(self.rows) >= self.rows_per_group:
+            self.flush()
+            self.block = block
+        self.raw.write(raw)
+        self.rows.extend(processed_rows(processed, block))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.raw.close()
+
+
+ENTITY_SCHEMA = pa.schema([('id', pa.string()), ('author_id', pa.string()), ('username', pa.string()),
+                           ('json', pa.string())])
+
+RECORD_SCHEMA = pa.schema([('original_user_id', pa.string()), ('spreader_username', pa.string()),
+                           ('condition', pa.string()), ('status', pa.int8()), ('tweet_ids', pa.list_(pa.string())),
+                           ('ref_tweet_ids', pa.list_(pa.string())), ('user_ids', pa.list_(pa.string()))])
+
+# Raw record key -> (entity table, id list column of RECORD_SCHEMA)
+ENTITY_TABLES = {'data': ('tweets', 'tweet_ids'), 'includes_tweets': ('ref_tweets', 'ref_tweet_ids'),
+                 'includes_users': ('users', 'user_ids')}
+
+
+class _EntityTable:
+    # Appends entities not seen before to `{fn}_{name}.parquet`
+    def __init__(self, fn, rows_per_group):
+        self.writer = pq.ParquetWriter(fn, ENTITY_SCHEMA, compression='zstd')
+        self.rows_per_group = rows_per_group
+        self.seen = set()
+        self.rows = []
+
+    def add(self, entity):
+        entity_id = str(entity['id'])
+        if entity_id not in self.seen:
+            self.seen.add(entity_id)
+            self.rows.append({'id': entity_id, 'author_id': entity.get('author_id'),
+                              'username': entity.get('username'), 'json': json.dumps(entity)})
+            if len(self.rows) >= self.rows_per_group:
+                self.flush()
+        return entity_id
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=ENTITY_SCHEMA))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class EntityWriter(TweetWriter):
+    """
+    Raw records split into three deduplicated tables keyed by id, `{fn}_tweets.parquet` (primary tweets),
+    `{fn}_ref_tweets.parquet` (`includes_tweets`) and `{fn}_users.parquet` (`includes_users`), and one row per user in
+    `{fn}_records.parquet` holding only the ids. A spreader or viral tweet that every follower references is stored
+    once, so the tables grow with unique entities rather than with users. An entity keeps the first version we saw of
+    it. Load with `EntityStore`.
+
+    Args:
+        fn: Output prefix
+        rows_per_group: Rows per row group of each table
+    """
+
+    def __init__(self, fn, rows_per_group=50000):
+        self.tables = {key: _EntityTable(f"""{fn}_{name}.parquet""", rows_per_group)
+                       for key, (name, _) in ENTITY_TABLES.items()}
+        self.records = pq.ParquetWriter(f"""{fn}_records.parquet""", RECORD_SCHEMA, compression='zstd')
+        self.rows_per_group = rows_per_group
+        self.rows = []
+
+    def write(self, raw, processed, block=None):
+        spreader_username, condition = block if block else (None, None)
+        row = {'original_user_id': str(raw['original_user_id']), 'spreader_username': spreader_username,
+               'condition': condition}
+        if not isinstance(raw['data'], list):
+            row['status'] = raw['data']
+        else:
+            row['status'] = 0
+            for key, (_, column) in ENTITY_TABLES.items():
+                row[column] = [self.tables[key].add(entity) for entity in raw[key]]
+        self.rows.append(row)
+        if len(self.rows) >= self.rows_per_group:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.records.write_table(pa.Table.from_pylist(self.rows, schema=RECORD_SCHEMA))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.records.close()
+        for table in self.tables.values():
+            table.close()
+
+
+class EntityStore:
+    """
+    The tables of an `EntityWriter` run, with lookups by id in dicts. Entities stay JSON strings until accessed.
+
+    Args:
+        fn: Output prefix of the run
+    """
+
+    def __init__(self, fn):
+        self.entities = {}
+        for key, (name, _) in ENTITY_TABLES.items():
+            table = pq.read_table(f"""{fn}_{name}.parquet""", columns=['id', 'author_id', 'json']).to_pydict()
+            self.entities[key] = dict(zip(table['id'], table['json']))
+            if key == 'data':
+                self.author_tweet_ids = {}
+                for tweet_id, author_id in zip(table['id'], table['author_id']):
+                    self.author_tweet_ids.setdefault(author_id, []).append(tweet_id)
+        records = pq.read_table(f"""{fn}_records.parquet""").to_pylist()
+        self.records = {record['original_user_id']: record for record in records}
+
+    def tweet(self, tweet_id):
+        """
+        A primary tweet by id
+        """
+        return json.loads(self.entities['data'][tweet_id])
+
+    def ref_tweet(self, tweet_id):
+        """
+        A referenced tweet by id
+        """
+        return json.loads(self.entities['includes_tweets'][tweet_id])
+
+    def user(self, user_id):
+        """
+        A referenced user by id
+        """
+        return json.loads(self.entities['includes_users'][user_id])
+
+    def tweets_by_author(self, author_id):
+        """
+        The primary tweets of an author
+        """
+        return [self.tweet(tweet_id) for tweet_id in self.author_tweet_ids.get(author_id, [])]
+
+    def raw_record(self, original_user_id):
+        """
+        Rebuilds the raw record of a user as `get_tweet_data.process_tweets` returned it
+        """
+        record = self.records[original_user_id]
+        if record['status'] != 0:
+            status = record['status']
+            return {'original_user_id': original_user_id, 'data': status, 'includes_users': status,
+                    'includes_tweets': status}
+        raw = {'original_user_id': original_user_id}
+        for key, (_, column) in ENTITY_TABLES.items():
+            raw[key] = [json.loads(self.entities[key][entity_id]) for entity_id in record[column]]
+        return raw
+
+
+WRITERS = {'jsonl': JSONLWriter, 'parquet': ParquetWriter, 'entities': EntityWriter}
+
+
+def open_writer(output_format, fn):
+    """
+    The writer for `output_format`, one of `WRITERS`, with output prefix `fn`
+    """
+    if output_format not in WRITERS:
+        raise ValueError(f"""Unknown output format {output_format}, use one of {list(WRITERS)}""")
+    return WRITERS[output_format](fn)
+
+
+def load_tweets(fn, columns=None):
+    """
+    Reads `{fn}_processed.parquet` into a dataframe, optionally only some columns
+    """
+    return pd.read_parquet(f"""{fn}_processed.parquet""", columns=columns)
+
+
+def convert_jsonl(raw_fn, processed_fn, out_fn, output_format='parquet', success_fn=None):
+    """
+    Rewrites the JSONL files of an earlier run with another writer
+
+    Args:
+        raw_fn: `{fn}_raw.jsonl` of the run
+        processed_fn: `{fn}_processed.jsonl` of the run
+        out_fn: Output prefix
+        output_format: One of `WRITERS`
+        success_fn: Optional `{fn}_{n}_success.csv` of the run, for the (spreader, condition) blocks
+    Returns:
+        Number of users converted
+    """
+    blocks = {}
+    if success_fn:
+        success = pd.read_csv(success_fn, dtype=str)
+        blocks = dict(zip(success['follower_id'], zip(success['spreader_username'], success['condition'])))
+    n = 0
+    with open(raw_fn) as raw_file, open(processed_fn) as processed_file, open_writer(output_format, out_fn) as writer:
+        for raw_line, processed_line in zip(raw_file, processed_file):
+            raw, processed = json.loads(raw_line), json.loads(processed_line)
+            writer.write(raw, processed, blocks.get(str(processed['original_user_id'])))
+            n += 1
+    logging.info(f"""Converted {n} users from {processed_fn} to {output_format} at {out_fn}""")
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--raw_fn", required=True, help="{fn}_raw.jsonl of an earlier run")
+    parser.add_argument("--processed_fn", required=True, help="{fn}_processed.jsonl of an earlier run")
+    parser.add_argument("--out", required=True, help="Output prefix")
+    parser.add_argument("--output_format", default="parquet", choices=list(WRITERS), help="Defaults to parquet")
+    parser.add_argument("--success_fn", default=None, help="Optional success csv of the run, for the blocks")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    convert_jsonl(args.raw_fn, args.processed_fn, args.out, args.output_format, args.success_fn)